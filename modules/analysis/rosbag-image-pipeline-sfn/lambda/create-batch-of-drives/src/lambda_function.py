@@ -88,7 +88,7 @@ def get_drive_files(src_bucket: str, src_prefix: str, file_suffix: str, s3_clien
         )
         file_next_continuation = file_response.get("NextContinuationToken")
 
-        files += [x["Key"] for x in file_response.get("Contents", [])]
+        files += [x["Key"] for x in file_response.get("Contents", []) if x["Key"].endswith(file_suffix)]
         logger.info(files)
 
     return files
@@ -47,6 +47,7 @@ desired_encoding = os.getenv(_param("DESIRED_ENCODING"), "bgr8")
 yolo_model = os.getenv(_param("YOLO_MODEL"), "yolov5s")
 image_topics = os.getenv(_param("IMAGE_TOPICS"))
 sensor_topics = os.getenv(_param("SENSOR_TOPICS"))
+combined_extraction = os.getenv(_param("COMBINED_EXTRACTION"), "False").lower() in ["true", "yes", "1"]
 
 
 if not png_batch_job_def_arn:
@@ -151,6 +152,7 @@ CfnOutput(
             "YoloModel": yolo_model,
             "ImageTopics": json.loads(image_topics),  # type: ignore
             "SensorTopics": json.loads(sensor_topics),  # type: ignore
+            "CombinedExtraction": combined_extraction,
         }
     ),
 )
@@ -1,9 +1,14 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import concurrent.futures
+import json
 import logging
 import typing
 
+BAG_INDEX_SUFFIX = ".index.json"
+BAG_INDEX_WORKERS = 16
+
 logger = logging.getLogger("airflow")
 logger.setLevel("DEBUG")
 
@@ -14,9 +19,13 @@ def add_drives_to_batch(
     drives_to_process: typing.Dict[str, dict],
     file_suffix: str,
     s3_client,
+    topics: typing.Optional[typing.List[str]] = None,
 ):
     """Lists files with file_suffix for each prefix in drives_to_process and adds each file to dynamodb for tracking
 
+    With `topics`, files whose sidecar bag index (written next to the bag by the sensor extraction jobs or at ingest)
+    shows none of the topics are left out of the batch, without opening the bags.
+
     @param table: dynamo tracking table
     @param batch_id: dag run id
     @param drives_to_process: {
@@ -27,6 +36,7 @@ def add_drives_to_batch(
     }
     @param file_suffix: ".bag"
     @param s3_client: type boto3.client('s3')
+    @param topics: topics the batch extracts, e.g. ["/imu_raw", "/flir_adk/rgb_front_left/image_raw"]
     @return:
     """
 
@@ -39,6 +49,12 @@ def add_drives_to_batch(
             file_suffix=file_suffix,
             s3_client=s3_client,
         )
+        if topics:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=BAG_INDEX_WORKERS) as executor:
+                has_topics = list(
+                    executor.map(lambda file: bag_has_topics(s3_path["bucket"], file, topics, s3_client), files)
+                )
+            files = [file for file, keep in zip(files, has_topics) if keep]
 
         drives_and_files[drive_id] = {"files": files, "bucket": s3_path["bucket"]}
         files_in_batch += len(files)
@@ -74,11 +90,36 @@ def get_drive_files(src_bucket, src_prefix, file_suffix, s3_client):
             ContinuationToken=file_next_continuation,
         )
         file_next_continuation = file_response.get("NextContinuationToken")
-        files += [x["Key"] for x in file_response.get("Contents", [])]
+        files += [x["Key"] for x in file_response.get("Contents", []) if x["Key"].endswith(file_suffix)]
         logger.info(files)
     return files
 
 
+def bag_has_topics(bucket, key, topics, s3_client):
+    """Whether the bag holds messages of any of `topics` according to its sidecar index.
+
+    True when the index is missing, stale or cannot be read, so a bag is only left out when its index says so.
+
+    @param bucket:
+    @param key: key of the bag
+    @param topics:
+    @param s3_client:
+    @return:
+    """
+    try:
+        index = json.loads(s3_client.get_object(Bucket=bucket, Key=key + BAG_INDEX_SUFFIX)["Body"].read())
+        # An index built from an overwritten bag is ignored
+        if index.get("etag") != s3_client.head_object(Bucket=bucket, Key=key)["ETag"]:
+            return True
+        if any(topic in index["topics"] for topic in topics):
+            return True
+    except Exception as e:
+        logger.info(f"Including s3://{bucket}/{key}, its index could not be read: {e}")
+        return True
+    logger.info(f"Skipping s3://{bucket}/{key}, its index shows none of {topics}")
+    return False
+
+
 def batch_write_files_to_dynamo(table, drives_and_files, batch_id):
     with table.batch_writer() as batch:
         idx = 0
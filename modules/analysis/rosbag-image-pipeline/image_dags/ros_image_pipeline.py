@@ -61,6 +61,8 @@ IMAGE_TOPICS = module_metadata["ImageTopics"]
 
 PARQUET_JOB_DEFINITION_ARN = module_metadata["ParquetBatchJobDefArn"]
 SENSOR_TOPICS = module_metadata["SensorTopics"]
+# Extract images and sensor topics with a single png job reading each bag once
+COMBINED_EXTRACTION = module_metadata.get("CombinedExtraction", False)
 
 YOLO_IMAGE_URI = module_metadata["ObjectDetectionImageUri"]
 YOLO_ROLE = module_metadata["ObjectDetectionRole"]
@@ -196,6 +198,7 @@ def create_batch_of_drives(ti, **kwargs):
         batch_id=batch_id,
         file_suffix=FILE_SUFFIX,
         s3_client=s3_client,
+        topics=IMAGE_TOPICS + SENSOR_TOPICS,
     )
     assert files_in_batch <= 10000, "AWS Batch Array Size cannot exceed 10000"
     return files_in_batch
@@ -215,6 +218,16 @@ def png_batch_operation(**kwargs):
     batch_id = kwargs["dag_run"].run_id
     context = get_current_context()
 
+    environment = [
+        {"name": "TABLE_NAME", "value": DYNAMODB_TABLE},
+        {"name": "BATCH_ID", "value": batch_id},
+        {"name": "IMAGE_TOPICS", "value": json.dumps(IMAGE_TOPICS)},
+        {"name": "DESIRED_ENCODING", "value": DESIRED_ENCODING},
+        {"name": "TARGET_BUCKET", "value": TARGET_BUCKET},
+    ]
+    if COMBINED_EXTRACTION:
+        environment.append({"name": "SENSOR_TOPICS", "value": json.dumps(SENSOR_TOPICS)})
+
     op = BatchOperator(
         task_id="submit_batch_job_op",
         job_name=get_job_name("png"),
@@ -222,16 +235,7 @@ def png_batch_operation(**kwargs):
         aws_conn_id="aws_default",
         job_definition=PNG_JOB_DEFINITION_ARN,
         array_properties={"size": int(array_size)},
-        overrides={
-            "environment": [
-                {"name": "TABLE_NAME", "value": DYNAMODB_TABLE},
-                {"name": "BATCH_ID", "value": batch_id},
-                {"name": "DEBUG", "value": "true"},
-                {"name": "IMAGE_TOPICS", "value": json.dumps(IMAGE_TOPICS)},
-                {"name": "DESIRED_ENCODING", "value": DESIRED_ENCODING},
-                {"name": "TARGET_BUCKET", "value": TARGET_BUCKET},
-            ],
-        },
+        overrides={"environment": environment},
     )
 
     op.execute(context)
@@ -506,8 +510,13 @@ with DAG(
     # Start Task Group definition
     with TaskGroup(group_id="sensor-extraction") as extract_task_group:
         submit_png_job = PythonOperator(task_id="image-extraction-batch-job", python_callable=png_batch_operation)
-        submit_parquet_job = PythonOperator(task_id="parquet-extraction-batch-job", python_callable=parquet_operation)
-        create_batch_of_drives_task >> [submit_parquet_job, submit_png_job]
+        if COMBINED_EXTRACTION:
+            create_batch_of_drives_task >> submit_png_job
+        else:
+            submit_parquet_job = PythonOperator(
+                task_id="parquet-extraction-batch-job", python_callable=parquet_operation
+            )
+            create_batch_of_drives_task >> [submit_parquet_job, submit_png_job]
 
     with TaskGroup(group_id="image-labelling") as image_labelling_task_group:
         submit_yolo_job = PythonOperator(
@@ -47,6 +47,14 @@ def test_app(stack_defaults):
     import app  # noqa: F401
 
 
+def test_app_combined_extraction(stack_defaults):
+    os.environ["SEEDFARMER_PARAMETER_COMBINED_EXTRACTION"] = "true"
+    import app
+
+    assert app.combined_extraction
+    del os.environ["SEEDFARMER_PARAMETER_COMBINED_EXTRACTION"]
+
+
 def test_png_batch_job_def_arn(stack_defaults):
     del os.environ["SEEDFARMER_PARAMETER_PNG_BATCH_JOB_DEF_ARN"]
 
@@ -1,3 +1,5 @@
+from botocore.exceptions import ClientError
+
 from image_dags.batch_creation_and_tracking import *
 
 
@@ -32,3 +34,45 @@ def test_add_drives_to_batch(moto_dynamodb, moto_s3):
         file_suffix=".bag",
         s3_client=moto_s3,
     )
+
+
+def test_bag_has_topics(moto_s3):
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file1.bag", Body=b"bag")
+    assert bag_has_topics("mybucket", "drive1/file1.bag", ["/imu_raw"], moto_s3)
+
+    etag = moto_s3.head_object(Bucket="mybucket", Key="drive1/file1.bag")["ETag"]
+    index = {"etag": etag, "topics": {"/vehicle/gps/fix": {"message_count": 10}}}
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file1.bag.index.json", Body=json.dumps(index))
+    assert not bag_has_topics("mybucket", "drive1/file1.bag", ["/imu_raw"], moto_s3)
+    assert bag_has_topics("mybucket", "drive1/file1.bag", ["/imu_raw", "/vehicle/gps/fix"], moto_s3)
+
+
+def test_bag_has_topics_unreadable_index(moto_s3):
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file1.bag", Body=b"bag")
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file1.bag.index.json", Body=b"not json")
+    assert bag_has_topics("mybucket", "drive1/file1.bag", ["/imu_raw"], moto_s3)
+
+    class ForbiddenS3Client:
+        def get_object(self, Bucket, Key):
+            raise ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "GetObject")
+
+    assert bag_has_topics("mybucket", "drive1/file1.bag", ["/imu_raw"], ForbiddenS3Client())
+
+
+def test_add_drives_to_batch_with_topics(moto_dynamodb, moto_s3):
+    for name in ["file1.bag", "file2.bag", "file3.bag"]:
+        moto_s3.put_object(Bucket="mybucket", Key=f"drive1/{name}", Body=b"bag")
+    etag = moto_s3.head_object(Bucket="mybucket", Key="drive1/file2.bag")["ETag"]
+    index = {"etag": etag, "topics": {"/vehicle/gps/fix": {"message_count": 10}}}
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file2.bag.index.json", Body=json.dumps(index))
+    moto_s3.put_object(Bucket="mybucket", Key="drive1/file3.bag.index.json", Body=b"not json")
+
+    files_in_batch = add_drives_to_batch(
+        table=moto_dynamodb.Table("mytable"),
+        batch_id=1010,
+        drives_to_process={"drive1": {"bucket": "mybucket", "prefix": "drive1/"}},
+        file_suffix=".bag",
+        s3_client=moto_s3,
+        topics=["/imu_raw"],
+    )
+    assert files_in_batch == 2
@@ -0,0 +1,146 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+BAG_SUFFIX = ".bag"
+LOCK_SUFFIX = ".lock"
+PARTIAL_SUFFIX = ".part"
+
+
+def lock(path, operation):
+    """Open the lock file `path` and `flock` it with `operation`, or return `None` when a non-blocking lock is taken.
+
+    Eviction removes the lock files of removed entries while holding them, so a lock taken on a file that was removed
+    meanwhile is retried on the current one.
+    """
+    while True:
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, operation)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+def unlock(lock_file):
+    # Unlock before closing, as forked worker processes share the lock through their copy of the descriptor
+    if not lock_file.closed:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+class BagCache:
+    """Node-local cache of downloaded bags, shared by the extraction jobs running on the same host.
+
+    Entries are named after the SHA-256 of `bucket/key/ETag`, so a bag that is overwritten in S3 is never served from
+    an older copy. A job holds a shared `flock` on the entry's lock file while using it, and an exclusive one on the
+    lock file of its partial download while filling it: concurrent jobs for the same bag wait for a single download
+    rather than for each other, and eviction, which removes the least recently used entries once the cache would
+    exceed `max_size_gb`, skips entries that are in use.
+    """
+
+    def __init__(self, cache_dir, max_size_gb):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_gb * 1024**3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def acquire(self, bucket_name, key, etag, size):
+        """Lock and return the `BagCacheEntry` of a bag.
+
+        When the bag is not cached yet, the entry holds its download and space is reserved for it.
+        """
+        name = hashlib.sha256(f"{bucket_name}/{key}/{etag}".encode()).hexdigest()
+        entry = BagCacheEntry(os.path.join(self.cache_dir, name + BAG_SUFFIX))
+        if not os.path.exists(entry.path):
+            # Waits for another job downloading the same bag, which may publish it
+            entry.download_lock = lock(entry.partial_path + LOCK_SUFFIX, fcntl.LOCK_EX)
+        if os.path.exists(entry.path):
+            entry.hit = True
+            entry.release_download()
+            os.utime(entry.path)
+            logger.info(f"Bag cache hit for s3://{bucket_name}/{key}: {entry.path}")
+        else:
+            logger.info(f"Bag cache miss for s3://{bucket_name}/{key}")
+            self.evict(reserve_bytes=size)
+        return entry
+
+    def evict(self, reserve_bytes=0):
+        """Remove least recently used entries not in use until `reserve_bytes` more fit in the cache.
+
+        Partial downloads count towards the size of the cache. Those left by jobs that died are removed first, and so
+        are the lock files of entries that no longer exist.
+        """
+        with open(os.path.join(self.cache_dir, ".evict" + LOCK_SUFFIX), "a") as evict_lock:
+            fcntl.flock(evict_lock, fcntl.LOCK_EX)
+            entries = []
+            for path in glob.glob(os.path.join(self.cache_dir, "*" + BAG_SUFFIX + "*")):
+                if path.endswith(LOCK_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries) + reserve_bytes
+            for _, size, path in entries:
+                if path.endswith(PARTIAL_SUFFIX) and self._remove(path):
+                    total -= size
+                    logger.info(f"Removed the partial download {path} ({size} bytes) from the bag cache")
+            for _, size, path in sorted(entries):
+                if total <= self.max_size_bytes:
+                    break
+                if path.endswith(BAG_SUFFIX) and self._remove(path):
+                    total -= size
+                    logger.info(f"Evicted {path} ({size} bytes) from the bag cache")
+            for lock_path in glob.glob(os.path.join(self.cache_dir, "*" + LOCK_SUFFIX)):
+                if not os.path.exists(lock_path[: -len(LOCK_SUFFIX)]):
+                    self._remove(lock_path[: -len(LOCK_SUFFIX)])
+
+    def _remove(self, path):
+        """Remove `path` and its lock file unless the lock is held, returning whether they were removed"""
+        lock_path = path + LOCK_SUFFIX
+        lock_file = lock(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock_file is None:
+            return False
+        with lock_file:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            os.remove(lock_path)
+        return True
+
+
+class BagCacheEntry:
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + PARTIAL_SUFFIX
+        self.hit = False
+        self.lock_file = lock(path + LOCK_SUFFIX, fcntl.LOCK_SH)
+        self.download_lock = None
+
+    def commit(self):
+        """Publish the completely downloaded `partial_path` as the cached bag, letting waiting jobs read it"""
+        os.replace(self.partial_path, self.path)
+        self.hit = True
+        self.release_download()
+
+    def release_download(self):
+        if self.download_lock is not None:
+            unlock(self.download_lock)
+
+    def release(self):
+        self.release_download()
+        unlock(self.lock_file)
@@ -0,0 +1,459 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import io
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+
+import genpy
+import genpy.dynamic
+import rosbag
+from bag_index import (
+    BAG_VERSION_LINE,
+    OP_CHUNK,
+    OP_CONNECTION,
+    OP_FILE_HEADER,
+    OP_MESSAGE_DATA,
+    get_bag_index,
+    get_topic_chunks,
+    parse_header,
+    read_record,
+)
+from job_metrics import metrics
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 1024 * 1024
+MESSAGE_TYPES: dict = {}
+
+
+class RangedBagDownload:
+    """Download an S3 object to `local_path` with parallel ranged GETs, while allowing it to be read.
+
+    The local file is preallocated at full size and fetched in `part_size_mb` parts by `workers` threads, requested in
+    file order. Reads through `open()` block only until the bytes they need have arrived, so a `StreamingBag` can parse
+    the first chunks while the rest of the bag is still downloading. Every part is requested with the ETag of the
+    object so a concurrent overwrite fails the download instead of mixing versions. `on_complete()` is called from a
+    download thread as soon as every part is on disk.
+    """
+
+    def __init__(self, client, bucket_name, key, local_path, part_size_mb=32, workers=8, retries=3, on_complete=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.local_path = local_path
+        self.part_size = int(part_size_mb * 1024 * 1024)
+        self.workers = workers
+        self.retries = retries
+        self.size = None
+        self.etag = None
+        self.parts = 0
+        self.done = set()
+        self.contiguous_end = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.executor = None
+        self.start_time = None
+        self.on_complete = on_complete
+
+    def start(self, head=None):
+        """Start downloading, using the `head_object` response `head` of the object when already fetched"""
+        head = head or self.client.head_object(Bucket=self.bucket_name, Key=self.key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self.parts = -(-self.size // self.part_size)
+        self.start_time = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self.local_path)), exist_ok=True)
+        with open(self.local_path, "wb") as f:
+            f.truncate(self.size)
+        logger.info(f"Downloading s3://{self.bucket_name}/{self.key} ({self.size} bytes) in {self.parts} parts")
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        for part in range(self.parts):
+            self.executor.submit(self._download_part_with_retries, part)
+        if self.parts == 0:
+            self._complete()
+        return self
+
+    def _download_part_with_retries(self, part):
+        for attempt in range(self.retries + 1):
+            if self.error is not None:
+                return
+            try:
+                with metrics.timer("download", min(self.part_size, self.size - part * self.part_size)):
+                    self._download_part(part)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Failed to download part {part} of {self.key}: {e}")
+                    with self.condition:
+                        self.error = e
+                        self.condition.notify_all()
+                    return
+                time.sleep(2**attempt)
+        with self.condition:
+            self.done.add(part)
+            while self.contiguous_end < self.size and self.contiguous_end // self.part_size in self.done:
+                self.contiguous_end = min(self.contiguous_end + self.part_size, self.size)
+            self.condition.notify_all()
+            complete = len(self.done) == self.parts
+        if complete:
+            self._complete()
+
+    def _complete(self):
+        if self.on_complete is None:
+            return
+        try:
+            self.on_complete()
+        except Exception as e:
+            logger.error(f"Failed to complete the download of {self.key}: {e}")
+            self.error = e
+
+    def _download_part(self, part):
+        start = part * self.part_size
+        end = min(start + self.part_size, self.size) - 1
+        body = self.client.get_object(
+            Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}", IfMatch=self.etag
+        )["Body"]
+        fd = os.open(self.local_path, os.O_WRONLY)
+        try:
+            offset = start
+            for data in body.iter_chunks(READ_BUFFER_SIZE):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+        finally:
+            os.close(fd)
+        if offset != end + 1:
+            raise IOError(f"Part {part} of {self.key} ended at byte {offset}, expected {end + 1}")
+
+    def wait_for(self, position):
+        """Block until the part holding byte `position` is on disk and return how many bytes from there are"""
+        if position >= self.size:
+            return 0
+        if position < self.contiguous_end:
+            return self.contiguous_end - position
+        part = position // self.part_size
+        with self.condition:
+            while part not in self.done:
+                if self.error is not None:
+                    raise self.error
+                self.condition.wait()
+            while part + 1 < self.parts and part + 1 in self.done:
+                part += 1
+        return min((part + 1) * self.part_size, self.size) - position
+
+    def wait(self):
+        """Block until the whole object is on disk, raising the error of a failed part"""
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        if self.error is not None:
+            raise self.error
+        elapsed = time.time() - self.start_time
+        logger.info(
+            f"Downloaded {self.size} bytes in {elapsed:.1f}s ({self.size / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)"
+        )
+
+    def cancel(self):
+        """Stop requesting parts and wait for those in flight"""
+        with self.condition:
+            self.error = self.error or RuntimeError(f"Download of {self.key} cancelled")
+            self.condition.notify_all()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def open(self):
+        """A buffered binary file of the object whose reads wait for the download to reach them"""
+        return io.BufferedReader(_DownloadingFile(self), buffer_size=READ_BUFFER_SIZE)
+
+
+class _DownloadingFile(io.RawIOBase):
+    mode = "rb"
+
+    def __init__(self, download):
+        self.download = download
+        self.file = open(download.local_path, "rb", buffering=0)
+        self.name = download.local_path
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def readinto(self, buffer):
+        available = self.download.wait_for(self.file.tell())
+        with memoryview(buffer) as view:
+            return self.file.readinto(view[: min(len(view), available)])
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_bag(bag):
+    """`rosbag.Bag` of a bag path, or `bag` itself when it is already an opened bag such as a `StreamingBag`"""
+    return rosbag.Bag(bag) if isinstance(bag, str) else bag
+
+
+@contextlib.contextmanager
+def fetch_bag(
+    client,
+    bucket_name,
+    key,
+    local_path,
+    cache=None,
+    stream=True,
+    topics=None,
+    max_indexed_fraction=0.5,
+    **download_options,
+):
+    """Download a bag with `RangedBagDownload` and yield it for reading, the download being complete on exit.
+
+    With `stream`, a `StreamingBag` is yielded as soon as the download starts, otherwise the path of the complete bag.
+    With a `BagCache`, a cached copy is yielded by path when there is one, and a downloaded bag is added to the cache.
+    Otherwise, when the sidecar index of the bag shows that `topics` are stored in at most `max_indexed_fraction` of
+    its bytes, an `IndexedBag` fetching only their chunks is yielded instead of downloading the whole bag. The index
+    also lets a `StreamingBag` yield messages in time order.
+    """
+    head = client.head_object(Bucket=bucket_name, Key=key)
+    entry = cache.acquire(bucket_name, key, head["ETag"], head["ContentLength"]) if cache is not None else None
+    try:
+        if entry is not None and entry.hit:
+            yield entry.path
+            return
+        index = None
+        if stream or (topics is not None and max_indexed_fraction > 0):
+            index = get_bag_index(client, bucket_name, key, head)
+        if index is not None and topics is not None and max_indexed_fraction > 0:
+            selected = sum(chunk["length"] for chunk in get_topic_chunks(index, topics))
+            logger.info(f"{topics} are stored in {selected} of the {index['size']} bytes of the bag")
+            if selected <= max_indexed_fraction * index["size"]:
+                if entry is not None:
+                    # Nothing gets cached, so other jobs for this bag need not wait for this one
+                    entry.release()
+                yield IndexedBag(client, bucket_name, key, index, workers=download_options.get("workers", 8))
+                return
+        # The cache entry is published as soon as the download completes, while this job may still be reading it
+        path = entry.partial_path if entry is not None else local_path
+        on_complete = entry.commit if entry is not None else None
+        download = RangedBagDownload(client, bucket_name, key, path, on_complete=on_complete, **download_options)
+        download.start(head)
+        if stream:
+            try:
+                with StreamingBag(download.open(), index=index) as bag:
+                    yield bag
+            except BaseException:
+                download.cancel()
+                raise
+            download.wait()
+        else:
+            download.wait()
+            yield entry.path if entry is not None else path
+    finally:
+        if entry is not None:
+            entry.release()
+
+
+def _get_message_type(datatype, md5sum, definition):
+    key = (datatype, md5sum)
+    message_type = MESSAGE_TYPES.get(key)
+    if message_type is None:
+        message_type = MESSAGE_TYPES[key] = genpy.dynamic.generate_dynamic(datatype, definition)[datatype]
+    return message_type
+
+
+def get_later_start_times(chunks):
+    """Map the offset of each of `chunks`, in file order, to the earliest start time of the chunks after it"""
+    later_start_times = {}
+    earliest = None
+    for chunk in reversed(chunks):
+        later_start_times[chunk["offset"]] = earliest
+        earliest = chunk["start_time"] if earliest is None else min(earliest, chunk["start_time"])
+    return later_start_times
+
+
+def merge_by_time(chunks):
+    """Yield the `(topic, msg, t)` of `(later start time, messages)` chunks in time order, ties in file order.
+
+    Chunks overlap in time when messages were recorded out of order. Messages are held back until no later chunk can
+    start before them, as told by `later start time`, the earliest start time of the chunks after each one (`None` for
+    the last one).
+    """
+    heap = []
+    sequence = itertools.count()
+    for later_start_time, messages in chunks:
+        for topic, msg, t in messages:
+            heapq.heappush(heap, (t.secs, t.nsecs, next(sequence), topic, msg, t))
+        # Start times are float seconds, so only messages strictly before one are known to come first
+        while heap and (later_start_time is None or heap[0][5].to_sec() < later_start_time):
+            *_, topic, msg, t = heapq.heappop(heap)
+            yield topic, msg, t
+
+
+class StreamingBag:
+    """Read the messages of a ROS bag v2.0 front to back, one chunk record at a time, without loading its index.
+
+    `rosbag.Bag` loads the index stored after every chunk before returning the first message, so it needs the whole
+    file. This reader only needs the bytes up to the chunk being read, which makes it suitable for a bag that is still
+    being downloaded with `RangedBagDownload.open()`. Messages are yielded as `(topic, msg, t)` in time order like
+    `rosbag.Bag.read_messages` when `index`, the sidecar index of the bag, gives the start time of its chunks, and in
+    file order otherwise.
+    """
+
+    def __init__(self, f, index=None):
+        self.file = f
+        self.later_start_times = get_later_start_times(index["chunks"]) if index is not None else None
+        if f.readline() != BAG_VERSION_LINE:
+            raise ValueError("Only ROS bag v2.0 files can be streamed")
+
+    def read_messages(self, topics=None):
+        chunks = self._read_chunks(set(topics) if topics is not None else None)
+        if self.later_start_times is not None:
+            yield from merge_by_time(chunks)
+            return
+        for _, messages in chunks:
+            yield from messages
+
+    def _read_chunks(self, wanted):
+        """Yield `(later start time, messages)` of every chunk in file order"""
+        connections = {}
+        index_pos = None
+        while index_pos is None or index_pos == 0 or self.file.tell() < index_pos:
+            offset = self.file.tell()
+            record = read_record(self.file)
+            if record is None:
+                break
+            header, data = record
+            op = header["op"][0]
+            if op == OP_FILE_HEADER:
+                (index_pos,) = struct.unpack("<Q", header["index_pos"])
+            elif op == OP_CHUNK:
+                later_start_time = self.later_start_times.get(offset) if self.later_start_times is not None else None
+                yield later_start_time, self._read_chunk(header, data, wanted, connections)
+            elif op == OP_CONNECTION:
+                self._add_connection(header, data, wanted, connections)
+
+    def _read_chunk(self, header, data, wanted, connections):
+        compression = header["compression"].decode()
+        with metrics.timer("decompress", len(data)):
+            if compression == "bz2":
+                data = bz2.decompress(data)
+            elif compression == "lz4":
+                import roslz4
+
+                data = roslz4.decompress(data)
+            elif compression != "none":
+                raise ValueError(f"Unsupported bag chunk compression: {compression}")
+        chunk = io.BytesIO(data)
+        for record_header, record_data in iter(lambda: read_record(chunk), None):
+            op = record_header["op"][0]
+            if op == OP_CONNECTION:
+                self._add_connection(record_header, record_data, wanted, connections)
+            elif op == OP_MESSAGE_DATA:
+                connection = connections.get(struct.unpack("<I", record_header["conn"])[0])
+                if connection is not None:
+                    topic, message_type = connection
+                    secs, nsecs = struct.unpack("<II", record_header["time"])
+                    msg = message_type()
+                    msg.deserialize(record_data)
+                    yield topic, msg, genpy.Time(secs, nsecs)
+
+    def _add_connection(self, header, data, wanted, connections):
+        (conn,) = struct.unpack("<I", header["conn"])
+        topic = header["topic"].decode()
+        if conn in connections or (wanted is not None and topic not in wanted):
+            return
+        connection = parse_header(data)
+        connections[conn] = (
+            topic,
+            _get_message_type(
+                connection["type"].decode(), connection["md5sum"].decode(), connection["message_definition"].decode()
+            ),
+        )
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IndexedBag(StreamingBag):
+    """Read the messages of a bag in S3 by fetching only the chunks holding the wanted topics, using its sidecar index.
+
+    Chunks are fetched with ranged GETs by `workers` threads, at most `workers` chunks ahead of the one being read,
+    and their messages are yielded in time order like `rosbag.Bag.read_messages`.
+    """
+
+    def __init__(self, client, bucket_name, key, index, workers=8):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.index = index
+        self.workers = workers
+
+    def _fetch_chunk(self, chunk):
+        byte_range = "bytes={}-{}".format(chunk["offset"], chunk["offset"] + chunk["length"] - 1)
+        with metrics.timer("download", chunk["length"]):
+            response = self.client.get_object(
+                Bucket=self.bucket_name, Key=self.key, Range=byte_range, IfMatch=self.index["etag"]
+            )
+            return response["Body"].read()
+
+    def read_messages(self, topics=None):
+        wanted = set(topics) if topics is not None else {c["topic"] for c in self.index["connections"]}
+        connections = {
+            c["id"]: (c["topic"], _get_message_type(c["type"], c["md5sum"], c["message_definition"]))
+            for c in self.index["connections"]
+            if c["topic"] in wanted
+        }
+        yield from merge_by_time(self._read_chunks(get_topic_chunks(self.index, wanted), wanted, connections))
+
+    def _read_chunks(self, chunks, wanted, connections):
+        """Yield `(later start time, messages)` of `chunks` in file order as they are fetched"""
+        later_start_times = get_later_start_times(chunks)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+
+            def read_next():
+                chunk, future = pending.popleft()
+                messages = self._read_fetched_chunk(future.result(), wanted, connections)
+                return later_start_times[chunk["offset"]], messages
+
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(self._fetch_chunk, chunk)))
+                if len(pending) < self.workers:
+                    continue
+                yield read_next()
+            while pending:
+                yield read_next()
+
+    def _read_fetched_chunk(self, data, wanted, connections):
+        header, chunk_data = read_record(io.BytesIO(data))
+        if header["op"][0] != OP_CHUNK:
+            raise ValueError(f"Expected a chunk record in {self.key}, the bag index is inconsistent")
+        yield from self._read_chunk(header, chunk_data, wanted, connections)
+
+    def close(self):
+        pass
@@ -0,0 +1,235 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Sidecar index of a ROS bag v2.0 stored next to it in S3 as `<bag key>.index.json`.
+
+The index is built from the index section at the end of the bag, fetched with ranged GETs, so indexing a bag never
+downloads its chunks. It records, for the ETag of the bag it was built from:
+
+- `connections`: id, topic, type, md5sum and message definition of every connection
+- `topics`: type, message count and the start/end time of the chunks holding each topic
+- `chunks`: byte `offset` and `length` of every chunk record, its start/end time and message count per connection
+
+so readers can range-GET only the chunks holding their topics and planners can see what a bag contains without
+opening it. Run at ingest time to index every bag under a prefix:
+
+python3 bag_index.py --bucket <bucket> --prefix <prefix>
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import struct
+
+import boto3
+from botocore.exceptions import ClientError
+from job_metrics import metrics
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+
+BAG_VERSION_LINE = b"#ROSBAG V2.0\n"
+FILE_HEADER_READ_SIZE = 8192
+OP_MESSAGE_DATA = 0x02
+OP_FILE_HEADER = 0x03
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+
+def parse_header(data):
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        (length,) = struct.unpack_from("<I", data, pos)
+        name, _, value = data[pos + 4 : pos + 4 + length].partition(b"=")
+        fields[name.decode()] = value
+        pos += 4 + length
+    return fields
+
+
+def read_record(f):
+    """Return `(header fields, data)` of the next record of `f`, or `None` at the end of the file"""
+    header_length = f.read(4)
+    if len(header_length) < 4:
+        return None
+    header = parse_header(f.read(struct.unpack("<I", header_length)[0]))
+    (data_length,) = struct.unpack("<I", f.read(4))
+    return header, f.read(data_length)
+
+
+def _to_sec(data):
+    secs, nsecs = struct.unpack("<II", data)
+    return secs + nsecs / 1e9
+
+
+def read_index_pos(header_data):
+    """Offset of the index section of a bag from its first bytes, 0 when the bag has none (interrupted recording)"""
+    f = io.BytesIO(header_data)
+    if f.readline() != BAG_VERSION_LINE:
+        raise ValueError("Only ROS bag v2.0 files can be indexed")
+    header, _ = read_record(f)
+    if header["op"][0] != OP_FILE_HEADER:
+        raise ValueError("The bag does not start with a file header record")
+    return struct.unpack("<Q", header["index_pos"])[0]
+
+
+def parse_bag_index(index_data, index_pos, size, etag):
+    """Build the index of a bag from its index section `index_data`, which starts at byte `index_pos`"""
+    connections = {}
+    chunks = []
+    f = io.BytesIO(index_data)
+    for record_header, record_data in iter(lambda: read_record(f), None):
+        op = record_header["op"][0]
+        if op == OP_CONNECTION:
+            (conn,) = struct.unpack("<I", record_header["conn"])
+            fields = parse_header(record_data)
+            connections[conn] = {
+                "id": conn,
+                "topic": record_header["topic"].decode(),
+                "type": fields["type"].decode(),
+                "md5sum": fields["md5sum"].decode(),
+                "message_definition": fields["message_definition"].decode(),
+            }
+        elif op == OP_CHUNK_INFO:
+            (count,) = struct.unpack("<I", record_header["count"])
+            counts = struct.unpack("<{}I".format(2 * count), record_data[: 8 * count])
+            chunks.append(
+                {
+                    "offset": struct.unpack("<Q", record_header["chunk_pos"])[0],
+                    "start_time": _to_sec(record_header["start_time"]),
+                    "end_time": _to_sec(record_header["end_time"]),
+                    "message_counts": {str(counts[i]): counts[i + 1] for i in range(0, len(counts), 2)},
+                }
+            )
+
+    chunks.sort(key=lambda chunk: chunk["offset"])
+    for chunk, next_chunk in zip(chunks, chunks[1:] + [None]):
+        chunk["length"] = (next_chunk["offset"] if next_chunk else index_pos) - chunk["offset"]
+
+    topics = {}
+    for chunk in chunks:
+        for conn, count in chunk["message_counts"].items():
+            connection = connections[int(conn)]
+            topic = topics.setdefault(
+                connection["topic"],
+                {
+                    "type": connection["type"],
+                    "message_count": 0,
+                    "start_time": chunk["start_time"],
+                    "end_time": chunk["end_time"],
+                },
+            )
+            topic["message_count"] += count
+            topic["start_time"] = min(topic["start_time"], chunk["start_time"])
+            topic["end_time"] = max(topic["end_time"], chunk["end_time"])
+
+    return {
+        "version": INDEX_VERSION,
+        "etag": etag,
+        "size": size,
+        "index_pos": index_pos,
+        "start_time": min((chunk["start_time"] for chunk in chunks), default=None),
+        "end_time": max((chunk["end_time"] for chunk in chunks), default=None),
+        "connections": sorted(connections.values(), key=lambda connection: connection["id"]),
+        "topics": topics,
+        "chunks": chunks,
+    }
+
+
+def build_bag_index(client, bucket_name, key, head=None):
+    """Build the index of a bag in S3 from ranged GETs of its file header and index section"""
+    head = head or client.head_object(Bucket=bucket_name, Key=key)
+    size = head["ContentLength"]
+    etag = head["ETag"]
+
+    def get_range(start, end):
+        response = client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)
+        return response["Body"].read()
+
+    index_pos = read_index_pos(get_range(0, min(FILE_HEADER_READ_SIZE, size) - 1))
+    if index_pos == 0:
+        logger.info(f"s3://{bucket_name}/{key} has no index section")
+        return None
+    with metrics.timer("bag_index", size - index_pos):
+        index = parse_bag_index(get_range(index_pos, size - 1), index_pos, size, etag)
+    logger.info(
+        f"Indexed s3://{bucket_name}/{key}: {len(index['chunks'])} chunks, {len(index['topics'])} topics, "
+        f"{size - index_pos} index bytes read"
+    )
+    return index
+
+
+def read_bag_file_index(path):
+    """Build the index of a local bag from its file header and index section, or `None` when it has none"""
+    with open(path, "rb") as f:
+        index_pos = read_index_pos(f.read(FILE_HEADER_READ_SIZE))
+        if index_pos == 0:
+            return None
+        f.seek(index_pos)
+        return parse_bag_index(f.read(), index_pos, os.fstat(f.fileno()).st_size, None)
+
+
+def load_bag_index(client, bucket_name, key, etag):
+    """The sidecar index of a bag, or `None` when there is none or it was built from another version of the bag"""
+    try:
+        body = client.get_object(Bucket=bucket_name, Key=key + INDEX_SUFFIX)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            # Such as AccessDenied on the sidecar or a KMS error, the job builds the index or reads the bag without it
+            logger.warning(f"Could not load the index of s3://{bucket_name}/{key}: {e}")
+        return None
+    index = json.loads(body)
+    if index.get("version") != INDEX_VERSION or index.get("etag") != etag:
+        logger.info(f"Ignoring stale index of s3://{bucket_name}/{key}")
+        return None
+    return index
+
+
+def save_bag_index(client, bucket_name, key, index):
+    try:
+        client.put_object(
+            Bucket=bucket_name,
+            Key=key + INDEX_SUFFIX,
+            Body=json.dumps(index).encode(),
+            ContentType="application/json",
+        )
+    except ClientError as e:
+        # The index only speeds up later reads, a job that cannot write next to the bag carries on without it
+        logger.warning(f"Could not save the index of s3://{bucket_name}/{key}: {e}")
+
+
+def get_bag_index(client, bucket_name, key, head=None, save=True):
+    """Load the sidecar index of a bag, building and saving it first when it is missing or stale"""
+    head = head or client.head_object(Bucket=bucket_name, Key=key)
+    index = load_bag_index(client, bucket_name, key, head["ETag"])
+    if index is None:
+        index = build_bag_index(client, bucket_name, key, head)
+        if index is not None and save:
+            save_bag_index(client, bucket_name, key, index)
+    return index
+
+
+def get_topic_chunks(index, topics):
+    """The chunks of `index` holding messages of any of `topics`, in file order"""
+    connections = {str(c["id"]) for c in index["connections"] if c["topic"] in topics}
+    return [chunk for chunk in index["chunks"] if connections.intersection(chunk["message_counts"])]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Write the sidecar index of every bag under an S3 prefix")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--suffix", default=".bag")
+    args = parser.parse_args()
+
+    s3 = boto3.client("s3")
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=args.bucket, Prefix=args.prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(args.suffix):
+                get_bag_index(s3, args.bucket, obj["Key"])
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import decimal
+import json
+import random
+import sys
+import threading
+import time
+
+
+class StageTimer:
+    def __init__(self, metrics, stage, nbytes=0):
+        self.metrics = metrics
+        self.stage = stage
+        self.bytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.metrics.record(self.stage, time.perf_counter() - self.start, self.bytes)
+
+
+class StageMetrics:
+    """Thread-safe count, byte total and latency distribution of each stage of an extraction job.
+
+    Every `record` (or `timer` block) is one operation of a stage, e.g. one downloaded part or one encoded image.
+    Latencies are kept in a reservoir of at most `max_samples` per stage, from which p50/p95 are computed, so memory
+    stays bounded whatever the size of the bag. Metrics recorded in worker processes are returned to the parent and
+    combined with `merge`. The summary is stored in the tracking table with `to_item` and printed as CloudWatch
+    Embedded Metric Format lines by `log_emf`.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, {"count": 0, "bytes": 0, "seconds": 0.0, "samples": []})
+
+    def record(self, stage, seconds, nbytes=0, count=1):
+        with self.lock:
+            entry = self._stage(stage)
+            entry["count"] += count
+            entry["bytes"] += nbytes
+            entry["seconds"] += seconds
+            self._sample(entry, seconds)
+
+    def _sample(self, entry, seconds):
+        if len(entry["samples"]) < self.max_samples:
+            entry["samples"].append(seconds)
+        else:
+            slot = random.randrange(entry["count"])
+            if slot < self.max_samples:
+                entry["samples"][slot] = seconds
+
+    def timer(self, stage, nbytes=0):
+        """Context manager recording the duration of its block; set `bytes` on it to record a byte count"""
+        return StageTimer(self, stage, nbytes)
+
+    def merge(self, other):
+        with self.lock:
+            for stage, other_entry in other.stages.items():
+                entry = self._stage(stage)
+                entry["count"] += other_entry["count"]
+                entry["bytes"] += other_entry["bytes"]
+                entry["seconds"] += other_entry["seconds"]
+                for seconds in other_entry["samples"]:
+                    self._sample(entry, seconds)
+
+    def summary(self):
+        """`{stage: {"count", "bytes", "seconds", "p50_ms", "p95_ms"}}`, `seconds` being the total time of the stage"""
+        with self.lock:
+            summary = {}
+            for stage, entry in sorted(self.stages.items()):
+                samples = sorted(entry["samples"])
+                summary[stage] = {
+                    "count": entry["count"],
+                    "bytes": entry["bytes"],
+                    "seconds": round(entry["seconds"], 3),
+                    "p50_ms": round(_percentile(samples, 50) * 1000, 3),
+                    "p95_ms": round(_percentile(samples, 95) * 1000, 3),
+                }
+            return summary
+
+    def emf_records(self, namespace, dimensions):
+        """One CloudWatch Embedded Metric Format record per stage, with a `Stage` dimension next to `dimensions`"""
+        records = []
+        timestamp = int(time.time() * 1000)
+        for stage, values in self.summary().items():
+            records.append(
+                {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": namespace,
+                                "Dimensions": [list(dimensions) + ["Stage"]],
+                                "Metrics": [
+                                    {"Name": "Count", "Unit": "Count"},
+                                    {"Name": "Bytes", "Unit": "Bytes"},
+                                    {"Name": "Seconds", "Unit": "Seconds"},
+                                    {"Name": "P50", "Unit": "Milliseconds"},
+                                    {"Name": "P95", "Unit": "Milliseconds"},
+                                ],
+                            }
+                        ],
+                    },
+                    **dimensions,
+                    "Stage": stage,
+                    "Count": values["count"],
+                    "Bytes": values["bytes"],
+                    "Seconds": values["seconds"],
+                    "P50": values["p50_ms"],
+                    "P95": values["p95_ms"],
+                }
+            )
+        return records
+
+    def log_emf(self, namespace, dimensions, stream=None):
+        """Print the EMF records as single JSON lines.
+
+        Only an EMF-aware log shipper, such as the CloudWatch agent or FireLens, turns them into metrics; the `awslogs`
+        driver of Batch jobs stores them as plain log events.
+        """
+        stream = stream or sys.stdout
+        for record in self.emf_records(namespace, dimensions):
+            stream.write(json.dumps(record) + "\n")
+        stream.flush()
+
+    def to_item(self):
+        """The summary as a DynamoDB map attribute, whose numbers must be `Decimal`"""
+        return {
+            stage: {name: decimal.Decimal(str(value)) for name, value in values.items()}
+            for stage, values in self.summary().items()
+        }
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+# Metrics of the running job, shared by the modules of this process
+metrics = StageMetrics()
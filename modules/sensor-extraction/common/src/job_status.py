@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import functools
+import logging
+import os
+import random
+import time
+
+import requests
+from botocore.exceptions import ClientError
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = {
+    "InternalServerError",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+    "TransactionConflictException",
+    "TransactionInProgressException",
+}
+RETRYABLE_CANCELLATION_REASONS = {"ThrottlingError", "TransactionConflict", "ProvisionedThroughputExceeded"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_log_path(retries=3):
+    """`(region, log stream)` of this job's container, fetched once from the ECS task metadata endpoint"""
+    for attempt in range(retries + 1):
+        try:
+            response = requests.get(f"{os.environ['ECS_CONTAINER_METADATA_URI_V4']}", timeout=5)
+            response.raise_for_status()
+            break
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Retrying the container metadata lookup after error: {e}")
+            time.sleep(2**attempt * 0.1)
+    log_options = response.json()["LogOptions"]
+    return log_options["awslogs-region"], log_options["awslogs-stream"].replace("/", "$252F")
+
+
+def get_job_urls():
+    """Console URLs of this AWS Batch job and of its CloudWatch logs"""
+    job_region, log_path = get_log_path()
+    job_url = (
+        f"https://{job_region}.console.aws.amazon.com/batch/home?region={job_region}#jobs/detail/"
+        f"{os.environ['AWS_BATCH_JOB_ID']}"
+    )
+    job_cloudwatch_logs = (
+        f"https://{job_region}.console.aws.amazon.com/cloudwatch/home?region={job_region}#"
+        f"logsV2:log-groups/log-group/$252Faws$252Fbatch$252Fjob/log-events/{log_path}"
+    )
+    return job_url, job_cloudwatch_logs
+
+
+class JobStatusWriter:
+    """Coalesce the attribute updates a job makes to its items of the tracking table into single transactions.
+
+    Updates are collected per item with `set` and written by `flush` with one `TransactWriteItems` call covering
+    every item, e.g. the drive/file and batch/index items of an array child, instead of one `update_item` call per
+    item and step. Throttled or conflicting transactions are retried up to `retries` times with exponential backoff
+    and full jitter, which spreads the writes of array children that finish together.
+    """
+
+    def __init__(self, table, keys, retries=8, base_delay=0.1, max_delay=20):
+        self.table = table
+        self.keys = keys
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.updates = [{} for _ in keys]
+
+    def set(self, attributes, key=None):
+        """Queue `attributes` for the item `key`, or for every item when `key` is None"""
+        for item_key, updates in zip(self.keys, self.updates):
+            if key is None or key == item_key:
+                updates.update(attributes)
+
+    def set_job_urls(self, stages):
+        """Queue the console URLs of this job and its logs as `<stage>_batch_job` and `<stage>_job_logs`"""
+        job_url, job_cloudwatch_logs = get_job_urls()
+        for stage in stages:
+            self.set({f"{stage}_batch_job": job_url, f"{stage}_job_logs": job_cloudwatch_logs})
+
+    def _update(self, key, attributes):
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        values = {f":v{i}": value for i, value in enumerate(attributes.values())}
+        # The client of a table resource serializes plain Python values, as `update_item` does
+        return {
+            "Update": {
+                "TableName": self.table.name,
+                "Key": key,
+                "UpdateExpression": "SET " + ", ".join(f"#a{i} = :v{i}" for i in range(len(attributes))),
+                "ExpressionAttributeNames": names,
+                "ExpressionAttributeValues": values,
+            }
+        }
+
+    def flush(self):
+        items = [self._update(key, updates) for key, updates in zip(self.keys, self.updates) if updates]
+        if not items:
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                self.table.meta.client.transact_write_items(TransactItems=items)
+                break
+            except ClientError as e:
+                if attempt == self.retries or not self._retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+                logger.warning(f"Retrying the status write in {delay:.2f}s after error: {e}")
+                time.sleep(delay)
+        self.updates = [{} for _ in self.keys]
+
+    @staticmethod
+    def _retryable(error):
+        code = error.response["Error"]["Code"]
+        if code == "TransactionCanceledException":
+            reasons = {reason.get("Code") for reason in error.response.get("CancellationReasons", [])}
+            return bool(reasons & RETRYABLE_CANCELLATION_REASONS)
+        return code in RETRYABLE_ERRORS
@@ -0,0 +1,307 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Parquet conversion of sensor topics, shared by ros-to-parquet and the combined extraction of ros-to-png."""
+
+import collections
+import functools
+import logging
+import operator
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from job_metrics import metrics
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+ROS_ARROW_TYPES = {
+    "bool": pa.bool_(),
+    "int8": pa.int8(),
+    "byte": pa.int8(),
+    "uint8": pa.uint8(),
+    "char": pa.uint8(),
+    "int16": pa.int16(),
+    "uint16": pa.uint16(),
+    "int32": pa.int32(),
+    "uint32": pa.uint32(),
+    "int64": pa.int64(),
+    "uint64": pa.uint64(),
+    "float32": pa.float32(),
+    "float64": pa.float64(),
+    "string": pa.string(),
+}
+ROS_TIME_TYPES = {"time": pa.uint32(), "duration": pa.int32()}
+SLOT_TYPE_PATTERN = re.compile(r"^(?P<base>[^\[]+)(\[(?P<length>\d*)\])?$")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_slot_type(slot_type):
+    """Split a ROS slot type such as `float64[9]` into `(base type, is array, fixed length or None)`"""
+    match = SLOT_TYPE_PATTERN.match(slot_type)
+    length = match.group("length")
+    return match.group("base"), match.group(2) is not None, int(length) if length else None
+
+
+class FlatteningPlan:
+    """Column layout of a ROS message type, compiled once and reused for every message of that type.
+
+    Columns follow the bagpy CSV layout: nested messages and time/duration fields are flattened with `_` separated
+    names, fixed-size numeric arrays are expanded into `<name>_<i>` columns, variable-size numeric arrays become list
+    columns, byte arrays become binary columns and arrays of messages are stored as their string representation.
+    `schema` is the resulting Arrow schema, tagged with the ROS type and md5sum, and `extract(msg)` returns the column
+    values of a message with a single `attrgetter` call plus the per-column conversions.
+    """
+
+    def __init__(self, msg_class):
+        self.type = msg_class._type
+        self.md5sum = msg_class._md5sum
+        self.fields = []
+        self.paths = []
+        self.converters = []
+        self._compile(msg_class(), "", "")
+        self.schema = pa.schema(self.fields, metadata={"ros_type": self.type, "ros_md5sum": self.md5sum})
+        if len(self.paths) > 1:
+            self.getter = operator.attrgetter(*self.paths)
+        elif self.paths:
+            getter = operator.attrgetter(self.paths[0])
+            self.getter = lambda msg: (getter(msg),)
+        else:
+            self.getter = lambda msg: ()
+
+    def _add(self, name, arrow_type, path, converter=None):
+        self.fields.append(pa.field(name, arrow_type))
+        self.paths.append(path)
+        self.converters.append(converter)
+
+    def _compile(self, msg, name_prefix, path_prefix):
+        for slot, slot_type in zip(msg.__slots__, msg._slot_types):
+            name = name_prefix + slot
+            path = path_prefix + slot
+            base, is_array, length = parse_slot_type(slot_type)
+            if not is_array:
+                if base in ROS_ARROW_TYPES:
+                    self._add(name, ROS_ARROW_TYPES[base], path)
+                elif base in ROS_TIME_TYPES:
+                    self._add(name + "_secs", ROS_TIME_TYPES[base], path + ".secs")
+                    self._add(name + "_nsecs", ROS_TIME_TYPES[base], path + ".nsecs")
+                else:
+                    self._compile(getattr(msg, slot), name + "_", path + ".")
+            elif base in ["uint8", "char"]:
+                self._add(name, pa.binary(), path, bytes)
+            elif base in ROS_ARROW_TYPES and length is not None:
+                for i in range(length):
+                    self._add(f"{name}_{i}", ROS_ARROW_TYPES[base], path, operator.itemgetter(i))
+            elif base in ROS_ARROW_TYPES:
+                self._add(name, pa.list_(ROS_ARROW_TYPES[base]), path, list)
+            else:
+                self._add(name, pa.string(), path, str)
+
+    def extract(self, msg):
+        return [
+            value if converter is None else converter(value)
+            for value, converter in zip(self.getter(msg), self.converters)
+        ]
+
+
+FLATTENING_PLANS: dict = {}
+
+
+def get_flattening_plan(msg):
+    """The `FlatteningPlan` of the type of `msg`, shared by every topic and bag carrying the same type and md5sum"""
+    key = (msg._type, msg._md5sum)
+    plan = FLATTENING_PLANS.get(key)
+    if plan is None:
+        logger.debug("Compiling flattening plan for %s (%s)", *key)
+        plan = FLATTENING_PLANS[key] = FlatteningPlan(type(msg))
+    return plan
+
+
+class ParquetFileWriter:
+    """Append flattened rows to one parquet file, flushing a row group every `row_group_size` rows.
+
+    Rows are buffered column-wise, so memory stays bounded by a single row group whatever the size of the bag. With
+    `sort_by_time` every row group is sorted by header timestamp (bag record time for messages without a header),
+    which keeps the min/max statistics of each row group tight enough for query engines to skip row groups by time.
+    """
+
+    def __init__(
+        self,
+        path,
+        plan,
+        drive_id,
+        file_id,
+        row_group_size=100000,
+        compression="snappy",
+        use_dictionary=True,
+        sort_by_time=False,
+    ):
+        self.path = path
+        self.drive_id = drive_id
+        self.file_id = file_id
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.use_dictionary = use_dictionary
+        self.sort_by_time = sort_by_time
+        self.schema = pa.schema(
+            [
+                pa.field("Time", pa.float64()),
+                *plan.schema,
+                pa.field("drive_id", pa.string()),
+                pa.field("file_id", pa.string()),
+            ],
+            metadata=plan.schema.metadata,
+        )
+        self.writer = None
+        self.columns = [[] for _ in range(len(self.schema) - 2)]
+        self.buffered_rows = 0
+        self.rows = 0
+
+    def append(self, values):
+        for column, value in zip(self.columns, values):
+            column.append(value)
+        self.buffered_rows += 1
+        if self.buffered_rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        with metrics.timer("parquet_write"):
+            self._write_row_group()
+
+    def _write_row_group(self):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(self.columns, self.schema)]
+        arrays.append(pa.array([self.drive_id] * self.buffered_rows, type=pa.string()))
+        arrays.append(pa.array([self.file_id] * self.buffered_rows, type=pa.string()))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        if self.sort_by_time:
+            sort_columns = (
+                ["header_stamp_secs", "header_stamp_nsecs", "Time"]
+                if "header_stamp_secs" in self.schema.names
+                else ["Time"]
+            )
+            table = table.sort_by([(column, "ascending") for column in sort_columns])
+        if self.writer is None:
+            logger.info("Write parquet to {}".format(self.path))
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(
+                self.path,
+                self.schema,
+                compression=self.compression,
+                use_dictionary=self.use_dictionary,
+                write_statistics=True,
+            )
+        self.writer.write_table(table, row_group_size=self.buffered_rows)
+        self.rows += self.buffered_rows
+        self.columns = [[] for _ in self.columns]
+        self.buffered_rows = 0
+
+    def close(self):
+        if self.buffered_rows:
+            self._flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def get_message_time(msg, t):
+    """Header timestamp of `msg` in seconds, or the bag record time `t` when the message has no stamped header"""
+    header = getattr(msg, "header", None)
+    stamp = getattr(header, "stamp", None)
+    if stamp is not None and (stamp.secs or stamp.nsecs):
+        return stamp.to_sec()
+    return t.to_sec()
+
+
+class ParquetTopicSink:
+    """Stream the flattened messages of one topic to `<output_path>/<clean topic>/data.parquet`.
+
+    With `partition_seconds`, rows are instead split by header timestamp into Hive style partitions
+    `<output_path>/<clean topic>/time_bucket=<bucket start epoch seconds>/data.parquet`. Files are only created
+    once rows are flushed to them, and `files` lists those written once the sink is closed. At most
+    `max_open_partitions` partitions are buffered at a time, so memory does not grow with the number of partitions.
+    """
+
+    def __init__(
+        self, topic, output_path, drive_id, file_id, partition_seconds=None, max_open_partitions=4, **writer_options
+    ):
+        self.topic = topic
+        self.drive_id = drive_id
+        self.file_id = file_id
+        self.partition_seconds = partition_seconds
+        self.max_open_partitions = max(max_open_partitions, 1)
+        self.writer_options = writer_options
+        clean_topic = topic.replace("/", "_")
+        self.output_dir = os.path.join(output_path, clean_topic)
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        self.file = {
+            "local_parquet_path": os.path.join(self.output_dir, "data.parquet"),
+            "topic": clean_topic,
+            "partition": None,
+        }
+        self.files = []
+        # Open writers by partition, least recently written first
+        self.writers = collections.OrderedDict()
+        self.partition_files = collections.Counter()
+        self.rows = 0
+        self.plan = None
+
+    def write(self, msg, t):
+        plan = get_flattening_plan(msg)
+        if self.plan is None:
+            self.plan = plan
+        elif plan is not self.plan:
+            raise ValueError(f"Topic {self.topic} mixes message types {self.plan.type} and {plan.type}")
+        partition = None
+        if self.partition_seconds:
+            bucket = int(get_message_time(msg, t) // self.partition_seconds * self.partition_seconds)
+            partition = "time_bucket={}".format(bucket)
+        writer = self.writers.get(partition)
+        if writer is None:
+            writer = self._open_writer(partition, plan)
+        elif partition is not None:
+            self.writers.move_to_end(partition)
+        writer.append([t.to_sec(), *plan.extract(msg)])
+
+    def _open_writer(self, partition, plan):
+        """Open a writer for `partition`, first closing the least recently written one if too many are open.
+
+        Messages arrive roughly in time order, so a closed partition seldom gets rows again. When it does, they go to
+        another file of the partition, `data-<n>.parquet`.
+        """
+        if len(self.writers) >= self.max_open_partitions:
+            self._close_writer(*self.writers.popitem(last=False))
+        count = self.partition_files[partition]
+        self.partition_files[partition] += 1
+        name = "data-{}.parquet".format(count) if count else "data.parquet"
+        path = os.path.join(self.output_dir, partition or "", name)
+        writer = self.writers[partition] = ParquetFileWriter(
+            path, plan, self.drive_id, self.file_id, **self.writer_options
+        )
+        return writer
+
+    def _close_writer(self, partition, writer):
+        writer.close()
+        self.rows += writer.rows
+        if writer.rows:
+            self.files.append({**self.file, "local_parquet_path": writer.path, "partition": partition})
+
+    def close(self):
+        while self.writers:
+            self._close_writer(*self.writers.popitem(last=False))
+        self.files.sort(key=lambda file: file["local_parquet_path"])
+        if self.rows == 0:
+            logger.info("No data found for {topic}".format(topic=self.topic))
+        else:
+            logger.info(
+                "Wrote {rows} rows in {files} file(s) for {topic}".format(
+                    rows=self.rows, files=len(self.files), topic=self.topic
+                )
+            )
+
+
+def get_parquet_target(drive_id, file_id, file):
+    """Return `(target prefix, object key)` of a parquet file in the target bucket"""
+    target_prefix = os.path.join(drive_id, file_id.replace(".bag", ""), file["topic"])
+    name = os.path.basename(file["local_parquet_path"])
+    return target_prefix, os.path.join(target_prefix, file.get("partition") or "", name)
@@ -0,0 +1,250 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Synthetic ROS bags and a filesystem S3 stand-in, to benchmark the extraction jobs without a recorded bag or AWS.
+
+The bags hold camera topics of `sensor_msgs/Image` and sensor topics of `sensor_msgs/Imu`. The message classes are
+generated from their definitions with `genpy`, so they have the md5sums of the real types without needing the
+`sensor_msgs` package.
+"""
+
+import datetime
+import glob
+import hashlib
+import io
+import math
+import os
+import shutil
+
+import genpy.dynamic
+import numpy as np
+import rosbag
+import rospy
+from botocore.exceptions import ClientError
+
+HEADER_DEFINITION = """
+================================================================================
+MSG: std_msgs/Header
+uint32 seq
+time stamp
+string frame_id
+"""
+
+IMAGE_DEFINITION = (
+    """std_msgs/Header header
+uint32 height
+uint32 width
+string encoding
+uint8 is_bigendian
+uint32 step
+uint8[] data
+"""
+    + HEADER_DEFINITION
+)
+
+IMU_DEFINITION = (
+    """std_msgs/Header header
+geometry_msgs/Quaternion orientation
+float64[9] orientation_covariance
+geometry_msgs/Vector3 angular_velocity
+float64[9] angular_velocity_covariance
+geometry_msgs/Vector3 linear_acceleration
+float64[9] linear_acceleration_covariance
+"""
+    + HEADER_DEFINITION
+    + """
+================================================================================
+MSG: geometry_msgs/Quaternion
+float64 x
+float64 y
+float64 z
+float64 w
+
+================================================================================
+MSG: geometry_msgs/Vector3
+float64 x
+float64 y
+float64 z
+"""
+)
+
+START_TIME = 1650000000
+DISTINCT_FRAMES = 8
+
+
+def message_class(datatype, definition):
+    return genpy.dynamic.generate_dynamic(datatype, definition)[datatype]
+
+
+def synthetic_image_data(width, height, count, seed=0):
+    """Raw `bgr8` bytes of `count` gradient frames with a moving shape and sensor noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        frame = np.stack(
+            [(x + i * 3) % 256, (y + i * 5) % 256, ((x + y) // 2 + i * 7) % 256],
+            axis=-1,
+        ).astype(np.int16)
+        cx, cy = (i * 37) % width, (i * 23) % height
+        frame[max(cy - height // 8, 0) : cy + height // 8, max(cx - width // 8, 0) : cx + width // 8] //= 2
+        frame += rng.normal(0, 4, size=frame.shape).astype(np.int16)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8).tobytes())
+    return frames
+
+
+def get_duration_for_size(size_mb, image_topics, width, height, image_rate):
+    """Seconds of recording after which the camera topics hold about `size_mb` of raw frames"""
+    bytes_per_second = max(image_topics * width * height * 3 * image_rate, 1)
+    return size_mb * 1024**2 / bytes_per_second
+
+
+def write_synthetic_bag(
+    path,
+    duration=10.0,
+    image_topics=2,
+    width=1920,
+    height=1080,
+    image_rate=10.0,
+    sensor_topics=1,
+    sensor_rate=100.0,
+    compression="none",
+    chunk_threshold=768 * 1024,
+):
+    """Write a bag of `duration` seconds with `image_topics` cameras and `sensor_topics` IMUs at the given rates.
+
+    Returns a description of the bag with its topics, message counts and size.
+    """
+    image_class = message_class("sensor_msgs/Image", IMAGE_DEFINITION)
+    imu_class = message_class("sensor_msgs/Imu", IMU_DEFINITION)
+    image_data = synthetic_image_data(width, height, DISTINCT_FRAMES) if image_topics else []
+    image_names = [f"/cam/{i}/image_raw" for i in range(image_topics)]
+    sensor_names = [f"/imu/{i}/data_raw" for i in range(sensor_topics)]
+
+    events = []
+    for rate, names in [(image_rate, image_names), (sensor_rate, sensor_names)]:
+        for seq in range(int(duration * rate) if names else 0):
+            events.extend((seq / rate, seq, name) for name in names)
+    events.sort()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with rosbag.Bag(path, "w", compression=compression, chunk_threshold=chunk_threshold) as bag:
+        for offset, seq, topic in events:
+            stamp = rospy.Time.from_sec(START_TIME + offset)
+            if topic in image_names:
+                msg = image_class()
+                msg.height, msg.width, msg.encoding, msg.step = height, width, "bgr8", width * 3
+                msg.data = image_data[seq % len(image_data)]
+            else:
+                msg = imu_class()
+                msg.orientation.w = 1.0
+                msg.angular_velocity.z = math.sin(offset)
+                msg.linear_acceleration.x = math.cos(offset)
+                msg.linear_acceleration.z = 9.81
+            msg.header.seq = seq
+            msg.header.stamp = stamp
+            msg.header.frame_id = topic.split("/")[2]
+            bag.write(topic, msg, stamp)
+
+    return {
+        "size_bytes": os.path.getsize(path),
+        "duration_s": duration,
+        "compression": compression,
+        "image_topics": image_names,
+        "sensor_topics": sensor_names,
+        "image_messages": sum(1 for _, _, topic in events if topic in image_names),
+        "sensor_messages": sum(1 for _, _, topic in events if topic in sensor_names),
+        "resolution": f"{width}x{height}",
+        "image_rate_hz": image_rate,
+        "sensor_rate_hz": sensor_rate,
+    }
+
+
+class FileSystemS3Client:
+    """The S3 calls the extraction jobs make, served from `<root>/<bucket>/<key>` files.
+
+    It stands in for the boto3 client in benchmarks so their numbers measure the extraction itself rather than the
+    network or an S3 emulator. Ranged GETs, ETags and `IfMatch` behave as in S3.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket_name, key):
+        return os.path.join(self.root, bucket_name, key)
+
+    def _etag(self, path):
+        stat = os.stat(path)
+        return '"{}"'.format(hashlib.md5(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest())
+
+    def _missing(self, operation, bucket_name, key):
+        return ClientError({"Error": {"Code": "NoSuchKey", "Message": f"{bucket_name}/{key}"}}, operation)
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise self._missing("HeadObject", Bucket, Key)
+        return {"ContentLength": os.path.getsize(path), "ETag": self._etag(path)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise self._missing("GetObject", Bucket, Key)
+        if IfMatch is not None and IfMatch != self._etag(path):
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": Key}}, "GetObject")
+        with open(path, "rb") as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, end = (int(value) for value in Range[len("bytes=") :].split("-"))
+                f.seek(start)
+                data = f.read(end - start + 1)
+        return {"Body": FileSystemBody(data), "ContentLength": len(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.upload_fileobj(io.BytesIO(Body), Bucket, Key)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(Fileobj, f)
+
+    def get_paginator(self, operation):
+        return FileSystemPaginator(self)
+
+    def list_keys(self, bucket_name, prefix=""):
+        bucket_path = os.path.join(self.root, bucket_name)
+        paths = glob.glob(os.path.join(bucket_path, "**"), recursive=True)
+        keys = sorted(os.path.relpath(path, bucket_path) for path in paths if os.path.isfile(path))
+        return [key for key in keys if key.startswith(prefix)]
+
+
+class FileSystemBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.stream.read(chunk_size), b"")
+
+
+class FileSystemPaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix=""):
+        contents = []
+        for key in self.client.list_keys(Bucket, Prefix):
+            mtime = os.path.getmtime(self.client._path(Bucket, key))
+            contents.append(
+                {"Key": key, "LastModified": datetime.datetime.fromtimestamp(mtime, tz=datetime.timezone.utc)}
+            )
+        yield {"Contents": contents}
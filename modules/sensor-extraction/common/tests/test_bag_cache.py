@@ -0,0 +1,88 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import pytest
+from bag_cache import BagCache
+
+BUCKET = "raw"
+SIZE = 100
+
+
+@pytest.fixture(scope="function")
+def cache(tmp_path):
+    # Room for two bags of SIZE bytes
+    return BagCache(str(tmp_path / "cache"), max_size_gb=(2.5 * SIZE) / 1024**3)
+
+
+def add_bag(cache, key, mtime):
+    """Download `key` into the cache like `fetch_bag` does, dated `mtime`"""
+    entry = cache.acquire(BUCKET, key, "etag", SIZE)
+    assert not entry.hit
+    with open(entry.partial_path, "wb") as f:
+        f.write(b"x" * SIZE)
+    entry.commit()
+    entry.release()
+    os.utime(entry.path, (mtime, mtime))
+    return entry.path
+
+
+def test_cached_bag_is_a_hit(cache):
+    path = add_bag(cache, "drive/a.bag", 1)
+    entry = cache.acquire(BUCKET, "drive/a.bag", "etag", SIZE)
+    try:
+        assert entry.hit
+        assert entry.path == path
+        assert entry.download_lock is None
+    finally:
+        entry.release()
+
+
+def test_overwritten_bag_is_a_miss(cache):
+    path = add_bag(cache, "drive/a.bag", 1)
+    entry = cache.acquire(BUCKET, "drive/a.bag", "another etag", SIZE)
+    try:
+        assert not entry.hit
+        assert entry.path != path
+    finally:
+        entry.release()
+
+
+def test_evicts_least_recently_used_bags(cache):
+    a = add_bag(cache, "drive/a.bag", 1)
+    b = add_bag(cache, "drive/b.bag", 2)
+    c = add_bag(cache, "drive/c.bag", 3)
+    assert not os.path.exists(a)
+    assert os.path.exists(b)
+    assert os.path.exists(c)
+    assert not os.path.exists(a + ".lock")
+
+
+def test_keeps_bags_in_use(cache):
+    b = add_bag(cache, "drive/b.bag", 2)
+    c = add_bag(cache, "drive/c.bag", 3)
+    entry = cache.acquire(BUCKET, "drive/b.bag", "etag", SIZE)
+    try:
+        os.utime(b, (2, 2))
+        add_bag(cache, "drive/d.bag", 4)
+        assert os.path.exists(b)
+        assert not os.path.exists(c)
+    finally:
+        entry.release()
+
+
+def test_removes_stale_partial_downloads_only(cache):
+    downloading = cache.acquire(BUCKET, "drive/a.bag", "etag", SIZE)
+    try:
+        with open(downloading.partial_path, "wb") as f:
+            f.write(b"x" * SIZE)
+        # Left behind by a job that died while downloading
+        stale = os.path.join(cache.cache_dir, "stale.bag.part")
+        with open(stale, "wb") as f:
+            f.write(b"x" * SIZE)
+        cache.evict()
+        assert not os.path.exists(stale)
+        assert os.path.exists(downloading.partial_path)
+    finally:
+        downloading.release()
@@ -0,0 +1,138 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import os
+
+import pytest
+
+# The bag readers need the ROS packages of the container image
+rosbag = pytest.importorskip("rosbag")
+
+import rospy  # noqa: E402
+from bag_download import IndexedBag, StreamingBag, fetch_bag  # noqa: E402
+from bag_index import get_bag_index, read_bag_file_index  # noqa: E402
+from synthetic_bag import (  # noqa: E402
+    IMU_DEFINITION,
+    START_TIME,
+    FileSystemS3Client,
+    message_class,
+    write_synthetic_bag,
+)
+
+BUCKET = "raw"
+KEY = "drive1/file1.bag"
+IMAGE_TOPIC = "/cam/0/image_raw"
+SENSOR_TOPIC = "/imu/0/data_raw"
+
+
+@pytest.fixture(scope="function")
+def client(tmp_path):
+    return FileSystemS3Client(str(tmp_path / "s3"))
+
+
+@pytest.fixture(scope="function", params=["none", "bz2"])
+def bag_path(client, request):
+    path = client._path(BUCKET, KEY)
+    write_synthetic_bag(
+        path,
+        duration=2.0,
+        image_topics=1,
+        width=32,
+        height=24,
+        image_rate=10.0,
+        sensor_rate=50.0,
+        compression=request.param,
+        chunk_threshold=8 * 1024,
+    )
+    return path
+
+
+@pytest.fixture(scope="function")
+def out_of_order_bag_path(client):
+    """A bag of two IMU topics, one of them recorded late, so that its chunks overlap in time"""
+    path = client._path(BUCKET, KEY)
+    os.makedirs(os.path.dirname(path))
+    imu_class = message_class("sensor_msgs/Imu", IMU_DEFINITION)
+    with rosbag.Bag(path, "w", chunk_threshold=2 * 1024) as bag:
+        for seq in range(200):
+            for topic, delay in [("/imu/0/data_raw", 0.0), ("/imu/1/data_raw", 0.25 if seq % 3 else 0.0)]:
+                msg = imu_class()
+                msg.header.seq = seq
+                msg.header.stamp = rospy.Time.from_sec(START_TIME + seq * 0.01 - delay)
+                bag.write(topic, msg, msg.header.stamp)
+    return path
+
+
+def summarize(messages):
+    return [(topic, msg.header.seq, t.secs, t.nsecs) for topic, msg, t in messages]
+
+
+def serialize(msg):
+    buff = io.BytesIO()
+    msg.serialize(buff)
+    return buff.getvalue()
+
+
+def read_with_rosbag(path, topics=None):
+    with rosbag.Bag(path) as bag:
+        return summarize(bag.read_messages(topics=topics))
+
+
+def in_time_order(messages):
+    return sorted(messages, key=lambda message: message[2:])
+
+
+@pytest.mark.parametrize("topics", [None, [SENSOR_TOPIC], [IMAGE_TOPIC, SENSOR_TOPIC]])
+def test_streaming_bag_reads_like_rosbag(bag_path, topics):
+    with StreamingBag(open(bag_path, "rb")) as bag:
+        assert summarize(bag.read_messages(topics)) == read_with_rosbag(bag_path, topics)
+    with StreamingBag(open(bag_path, "rb"), index=read_bag_file_index(bag_path)) as bag:
+        assert summarize(bag.read_messages(topics)) == read_with_rosbag(bag_path, topics)
+
+
+def test_streaming_bag_deserializes_messages(bag_path):
+    with rosbag.Bag(bag_path) as expected, StreamingBag(open(bag_path, "rb")) as bag:
+        for (_, expected_msg, _), (_, msg, _) in zip(expected.read_messages(), bag.read_messages()):
+            assert serialize(msg) == serialize(expected_msg)
+
+
+def test_streaming_bag_reads_out_of_order_bags_in_time_order(out_of_order_bag_path):
+    expected = in_time_order(read_with_rosbag(out_of_order_bag_path))
+    with StreamingBag(open(out_of_order_bag_path, "rb"), index=read_bag_file_index(out_of_order_bag_path)) as bag:
+        messages = summarize(bag.read_messages())
+    assert sorted(messages) == sorted(expected)
+    assert [message[2:] for message in messages] == [message[2:] for message in expected]
+
+
+@pytest.mark.parametrize("topics", [[SENSOR_TOPIC], [IMAGE_TOPIC, SENSOR_TOPIC]])
+def test_indexed_bag_reads_like_rosbag(client, bag_path, topics):
+    index = get_bag_index(client, BUCKET, KEY)
+    with IndexedBag(client, BUCKET, KEY, index, workers=2) as bag:
+        assert summarize(bag.read_messages(topics)) == read_with_rosbag(bag_path, topics)
+
+
+def test_indexed_bag_reads_out_of_order_bags_in_time_order(client, out_of_order_bag_path):
+    expected = in_time_order(read_with_rosbag(out_of_order_bag_path))
+    index = get_bag_index(client, BUCKET, KEY)
+    with IndexedBag(client, BUCKET, KEY, index, workers=2) as bag:
+        messages = summarize(bag.read_messages())
+    assert sorted(messages) == sorted(expected)
+    assert [message[2:] for message in messages] == [message[2:] for message in expected]
+
+
+@pytest.mark.parametrize("max_indexed_fraction", [0, 1])
+def test_fetch_bag_streams_the_download(tmp_path, client, bag_path, max_indexed_fraction):
+    local_path = str(tmp_path / "ros.bag")
+    with fetch_bag(
+        client,
+        BUCKET,
+        KEY,
+        local_path,
+        topics=[SENSOR_TOPIC],
+        max_indexed_fraction=max_indexed_fraction,
+        part_size_mb=0.01,
+        workers=2,
+    ) as bag:
+        assert isinstance(bag, IndexedBag if max_indexed_fraction else StreamingBag)
+        assert summarize(bag.read_messages([SENSOR_TOPIC])) == read_with_rosbag(bag_path, [SENSOR_TOPIC])
@@ -0,0 +1,210 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import json
+import logging
+import struct
+
+import pytest
+from bag_index import (
+    BAG_VERSION_LINE,
+    INDEX_VERSION,
+    get_topic_chunks,
+    load_bag_index,
+    parse_bag_index,
+    read_bag_file_index,
+    read_index_pos,
+)
+from botocore.exceptions import ClientError
+
+START_TIME = 1650000000
+CONNECTIONS = {
+    0: ("/cam/0/image_raw", "sensor_msgs/Image"),
+    1: ("/imu/0/data_raw", "sensor_msgs/Imu"),
+}
+
+
+def header(fields):
+    return b"".join(
+        struct.pack("<I", len(name) + 1 + len(value)) + name.encode() + b"=" + value for name, value in fields.items()
+    )
+
+
+def record(fields, data=b""):
+    record_header = header(fields)
+    return struct.pack("<I", len(record_header)) + record_header + struct.pack("<I", len(data)) + data
+
+
+def time_field(offset):
+    """Bag time of `offset` seconds after START_TIME"""
+    return struct.pack("<II", START_TIME + int(offset), round((offset - int(offset)) * 1e9))
+
+
+def connection_record(conn):
+    topic, datatype = CONNECTIONS[conn]
+    data = header({"topic": topic.encode(), "type": datatype.encode(), "md5sum": b"0" * 32, "message_definition": b""})
+    return record({"op": b"\x07", "conn": struct.pack("<I", conn), "topic": topic.encode()}, data)
+
+
+def write_bag(path, chunks, indexed=True):
+    """Write a ROS bag v2.0 of `chunks`, lists of `(conn, seconds after START_TIME)` messages.
+
+    The records are those `rosbag` writes, less the per-chunk index data and the padding of the file header.
+    Returns the offsets of the chunk records and of the index section.
+    """
+    file_header_length = len(
+        record({"op": b"\x03", "index_pos": bytes(8), "conn_count": bytes(4), "chunk_count": bytes(4)})
+    )
+    body = b""
+    offsets = []
+    chunk_infos = []
+    for messages in chunks:
+        offsets.append(len(BAG_VERSION_LINE) + file_header_length + len(body))
+        data = b"".join(connection_record(conn) for conn in sorted({conn for conn, _ in messages}))
+        for conn, offset in messages:
+            fields = {"op": b"\x02", "conn": struct.pack("<I", conn), "time": time_field(offset)}
+            data += record(fields, b"payload")
+        body += record({"op": b"\x05", "compression": b"none", "size": struct.pack("<I", len(data))}, data)
+        counts = {conn: sum(1 for c, _ in messages if c == conn) for conn, _ in messages}
+        times = [offset for _, offset in messages]
+        chunk_infos.append(
+            record(
+                {
+                    "op": b"\x06",
+                    "ver": struct.pack("<I", 1),
+                    "chunk_pos": struct.pack("<Q", offsets[-1]),
+                    "start_time": time_field(min(times)),
+                    "end_time": time_field(max(times)),
+                    "count": struct.pack("<I", len(counts)),
+                },
+                b"".join(struct.pack("<II", conn, count) for conn, count in sorted(counts.items())),
+            )
+        )
+    index_pos = len(BAG_VERSION_LINE) + file_header_length + len(body)
+    file_header = {
+        "op": b"\x03",
+        "index_pos": struct.pack("<Q", index_pos if indexed else 0),
+        "conn_count": struct.pack("<I", len(CONNECTIONS)),
+        "chunk_count": struct.pack("<I", len(chunks)),
+    }
+    with open(path, "wb") as f:
+        f.write(BAG_VERSION_LINE + record(file_header) + body)
+        if indexed:
+            f.write(b"".join(connection_record(conn) for conn in CONNECTIONS) + b"".join(chunk_infos))
+    return offsets, index_pos
+
+
+@pytest.fixture(scope="function")
+def bag(tmp_path):
+    path = str(tmp_path / "ros.bag")
+    chunks = [
+        [(0, 0.0), (1, 0.01), (1, 0.02)],
+        [(1, 0.03), (1, 0.04)],
+        [(0, 0.1), (1, 0.05)],
+    ]
+    offsets, index_pos = write_bag(path, chunks)
+    return path, offsets, index_pos
+
+
+def test_read_index_pos(bag):
+    path, _, index_pos = bag
+    with open(path, "rb") as f:
+        assert read_index_pos(f.read(8192)) == index_pos
+
+
+def test_read_index_pos_of_an_unindexed_bag(tmp_path):
+    path = str(tmp_path / "ros.bag")
+    write_bag(path, [[(0, 0.0)]], indexed=False)
+    with open(path, "rb") as f:
+        assert read_index_pos(f.read(8192)) == 0
+    assert read_bag_file_index(path) is None
+
+
+def test_read_index_pos_rejects_other_bag_versions():
+    with pytest.raises(ValueError):
+        read_index_pos(b"#ROSBAG V1.2\n")
+
+
+def test_parse_bag_index(bag):
+    path, offsets, index_pos = bag
+    with open(path, "rb") as f:
+        data = f.read()
+    index = parse_bag_index(data[index_pos:], index_pos, len(data), '"etag"')
+
+    assert index["etag"] == '"etag"'
+    assert index["size"] == len(data)
+    assert index["index_pos"] == index_pos
+    assert [(c["id"], c["topic"], c["type"]) for c in index["connections"]] == [
+        (0, "/cam/0/image_raw", "sensor_msgs/Image"),
+        (1, "/imu/0/data_raw", "sensor_msgs/Imu"),
+    ]
+    assert [chunk["offset"] for chunk in index["chunks"]] == offsets
+    assert [chunk["length"] for chunk in index["chunks"]] == [
+        offsets[1] - offsets[0],
+        offsets[2] - offsets[1],
+        index_pos - offsets[2],
+    ]
+    assert [chunk["message_counts"] for chunk in index["chunks"]] == [{"0": 1, "1": 2}, {"1": 2}, {"0": 1, "1": 1}]
+    assert index["chunks"][2]["start_time"] == pytest.approx(START_TIME + 0.05, abs=1e-6)
+    assert index["chunks"][2]["end_time"] == pytest.approx(START_TIME + 0.1, abs=1e-6)
+    assert index["start_time"] == START_TIME
+    assert index["end_time"] == pytest.approx(START_TIME + 0.1, abs=1e-6)
+    assert index["topics"]["/cam/0/image_raw"]["message_count"] == 2
+    assert index["topics"]["/imu/0/data_raw"]["message_count"] == 5
+    assert index["topics"]["/imu/0/data_raw"]["end_time"] == pytest.approx(START_TIME + 0.1, abs=1e-6)
+
+
+def test_each_chunk_record_is_at_its_offset(bag):
+    path, _, _ = bag
+    index = read_bag_file_index(path)
+    assert index["etag"] is None
+    with open(path, "rb") as f:
+        data = f.read()
+    for chunk in index["chunks"]:
+        # The op field of a chunk record header comes first after its length
+        assert data[chunk["offset"] + 4 : chunk["offset"] + 12] == struct.pack("<I", 4) + b"op=\x05"
+
+
+def test_get_topic_chunks(bag):
+    path, offsets, _ = bag
+    index = read_bag_file_index(path)
+    assert [chunk["offset"] for chunk in get_topic_chunks(index, ["/cam/0/image_raw"])] == [offsets[0], offsets[2]]
+    assert [chunk["offset"] for chunk in get_topic_chunks(index, ["/imu/0/data_raw"])] == offsets
+    assert get_topic_chunks(index, ["/missing"]) == []
+
+
+class SidecarClient:
+    """S3 client stub serving the sidecar index `body`, or failing with the error `code`"""
+
+    def __init__(self, body=None, code=None):
+        self.body = body
+        self.code = code
+
+    def get_object(self, Bucket, Key):
+        assert Key == "drive1/ros.bag.index.json"
+        if self.code is not None:
+            raise ClientError({"Error": {"Code": self.code, "Message": self.code}}, "GetObject")
+        return {"Body": io.BytesIO(self.body)}
+
+
+def test_load_bag_index():
+    index = {"version": INDEX_VERSION, "etag": '"etag"', "chunks": []}
+    client = SidecarClient(json.dumps(index).encode())
+    assert load_bag_index(client, "bucket", "drive1/ros.bag", '"etag"') == index
+    # An index built from another version of the bag is ignored
+    assert load_bag_index(client, "bucket", "drive1/ros.bag", '"other"') is None
+
+
+@pytest.mark.parametrize("code", ["NoSuchKey", "404"])
+def test_load_bag_index_when_there_is_none(caplog, code):
+    with caplog.at_level(logging.WARNING):
+        assert load_bag_index(SidecarClient(code=code), "bucket", "drive1/ros.bag", '"etag"') is None
+    assert not caplog.records
+
+
+@pytest.mark.parametrize("code", ["AccessDenied", "403", "KMS.DisabledException"])
+def test_load_bag_index_carries_on_without_an_unreadable_index(caplog, code):
+    with caplog.at_level(logging.WARNING):
+        assert load_bag_index(SidecarClient(code=code), "bucket", "drive1/ros.bag", '"etag"') is None
+    assert "Could not load the index of s3://bucket/drive1/ros.bag" in caplog.text
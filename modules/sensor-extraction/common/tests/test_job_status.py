@@ -0,0 +1,101 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("requests")
+
+import job_status  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from job_status import JobStatusWriter  # noqa: E402
+
+DRIVE_KEY = {"pk": "drive1", "sk": "file1.bag"}
+BATCH_KEY = {"pk": "batch1", "sk": "0"}
+
+
+class FakeClient:
+    """`transact_write_items` raising `errors` in turn before succeeding"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.calls = []
+
+    def transact_write_items(self, TransactItems):
+        self.calls.append(TransactItems)
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def client_error(code, reasons=None):
+    response = {"Error": {"Code": code, "Message": code}}
+    if reasons is not None:
+        response["CancellationReasons"] = [{"Code": reason} for reason in reasons]
+    return ClientError(response, "TransactWriteItems")
+
+
+@pytest.fixture(scope="function")
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(job_status.time, "sleep", delays.append)
+    return delays
+
+
+def get_writer(client, retries=8):
+    table = SimpleNamespace(name="tracking", meta=SimpleNamespace(client=client))
+    return JobStatusWriter(table, [DRIVE_KEY, BATCH_KEY], retries=retries)
+
+
+def test_flush_writes_every_item_in_one_transaction(delays):
+    client = FakeClient()
+    writer = get_writer(client)
+    writer.set({"image_extraction_status": "success"})
+    writer.set({"drive_id": "drive1"}, key=DRIVE_KEY)
+    writer.flush()
+    writer.flush()
+
+    assert len(client.calls) == 1
+    drive_update, batch_update = (item["Update"] for item in client.calls[0])
+    assert drive_update["Key"] == DRIVE_KEY
+    assert sorted(drive_update["ExpressionAttributeNames"].values()) == ["drive_id", "image_extraction_status"]
+    assert batch_update["Key"] == BATCH_KEY
+    assert list(batch_update["ExpressionAttributeNames"].values()) == ["image_extraction_status"]
+    assert delays == []
+
+
+def test_flush_retries_throttled_and_conflicting_transactions(delays):
+    client = FakeClient(
+        [
+            client_error("ThrottlingException"),
+            client_error("TransactionCanceledException", ["None", "TransactionConflict"]),
+        ]
+    )
+    writer = get_writer(client)
+    writer.set({"image_extraction_status": "success"})
+    writer.flush()
+
+    assert len(client.calls) == 3
+    assert client.calls[0] == client.calls[2]
+    assert len(delays) == 2
+    assert all(0 <= delay <= writer.base_delay * 2**attempt for attempt, delay in enumerate(delays))
+
+
+def test_flush_raises_other_errors(delays):
+    client = FakeClient([client_error("TransactionCanceledException", ["ConditionalCheckFailed"])])
+    writer = get_writer(client)
+    writer.set({"image_extraction_status": "success"})
+    with pytest.raises(ClientError):
+        writer.flush()
+    assert len(client.calls) == 1
+    assert delays == []
+
+
+def test_flush_raises_after_the_last_retry(delays):
+    client = FakeClient([client_error("ThrottlingException")] * 3)
+    writer = get_writer(client, retries=2)
+    writer.set({"image_extraction_status": "success"})
+    with pytest.raises(ClientError):
+        writer.flush()
+    assert len(client.calls) == 3
+    assert len(delays) == 2
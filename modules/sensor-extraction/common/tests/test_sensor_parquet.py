@@ -0,0 +1,272 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+import pyarrow.parquet as pq  # noqa: E402
+from sensor_parquet import (  # noqa: E402
+    FlatteningPlan,
+    ParquetFileWriter,
+    ParquetTopicSink,
+    get_flattening_plan,
+    get_parquet_target,
+)
+
+
+class Time:
+    """The fields and `to_sec()` of a `genpy.Time` or `genpy.Duration`"""
+
+    def __init__(self, secs=0, nsecs=0):
+        self.secs = secs
+        self.nsecs = nsecs
+
+    def to_sec(self):
+        return self.secs + self.nsecs / 1e9
+
+
+class Message:
+    """A message class as `genpy` generates them, with every slot set from `values` or to its type's default"""
+
+    __slots__ = ()
+    _slot_types = []
+
+    def __init__(self, **values):
+        for slot, slot_type in zip(self.__slots__, self._slot_types):
+            setattr(self, slot, values[slot] if slot in values else default_value(slot_type))
+
+    def __repr__(self):
+        return "{}({})".format(self._type, ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in self.__slots__))
+
+
+class Header(Message):
+    _type = "std_msgs/Header"
+    _md5sum = "2176decaecbce78abc3b96ef049fabed"
+    __slots__ = ["seq", "stamp", "frame_id"]
+    _slot_types = ["uint32", "time", "string"]
+
+
+class Vector3(Message):
+    _type = "geometry_msgs/Vector3"
+    _md5sum = "4a842b65f413084dc2b10fb484ea7f17"
+    __slots__ = ["x", "y", "z"]
+    _slot_types = ["float64", "float64", "float64"]
+
+
+class Sample(Message):
+    _type = "test_msgs/Sample"
+    _md5sum = "0123456789abcdef0123456789abcdef"
+    __slots__ = ["header", "position", "covariance", "ranges", "data", "points", "label", "age"]
+    _slot_types = [
+        "std_msgs/Header",
+        "geometry_msgs/Vector3",
+        "float64[3]",
+        "float32[]",
+        "uint8[]",
+        "geometry_msgs/Vector3[]",
+        "string",
+        "duration",
+    ]
+
+
+class Scalar(Message):
+    _type = "test_msgs/Scalar"
+    _md5sum = "fedcba9876543210fedcba9876543210"
+    __slots__ = ["value"]
+    _slot_types = ["int64"]
+
+
+MESSAGE_CLASSES = {cls._type: cls for cls in [Header, Vector3]}
+
+
+def default_value(slot_type):
+    if slot_type in ["time", "duration"]:
+        return Time()
+    if slot_type in MESSAGE_CLASSES:
+        return MESSAGE_CLASSES[slot_type]()
+    if slot_type == "uint8[]":
+        return b""
+    if slot_type.endswith("[3]"):
+        return [0.0] * 3
+    if slot_type.endswith("[]"):
+        return []
+    return "" if slot_type == "string" else 0
+
+
+def get_sample(seq, secs, nsecs=0):
+    return Sample(
+        header=Header(seq=seq, stamp=Time(secs, nsecs), frame_id="imu"),
+        position=Vector3(x=1.0, y=2.0, z=float(seq)),
+        covariance=[0.1, 0.2, 0.3],
+        ranges=[float(i) for i in range(seq % 3)],
+        data=bytes([seq % 256, 1]),
+        points=[Vector3(x=0.5)],
+        label=f"sample {seq}",
+        age=Time(-1, 500),
+    )
+
+
+def test_flattening_plan_schema():
+    plan = FlatteningPlan(Sample)
+    assert plan.schema == pa.schema(
+        [
+            ("header_seq", pa.uint32()),
+            ("header_stamp_secs", pa.uint32()),
+            ("header_stamp_nsecs", pa.uint32()),
+            ("header_frame_id", pa.string()),
+            ("position_x", pa.float64()),
+            ("position_y", pa.float64()),
+            ("position_z", pa.float64()),
+            ("covariance_0", pa.float64()),
+            ("covariance_1", pa.float64()),
+            ("covariance_2", pa.float64()),
+            ("ranges", pa.list_(pa.float32())),
+            ("data", pa.binary()),
+            ("points", pa.string()),
+            ("label", pa.string()),
+            ("age_secs", pa.int32()),
+            ("age_nsecs", pa.int32()),
+        ]
+    )
+    assert plan.schema.metadata == {b"ros_type": b"test_msgs/Sample", b"ros_md5sum": Sample._md5sum.encode()}
+
+
+def test_flattening_plan_extract():
+    plan = FlatteningPlan(Sample)
+    msg = get_sample(2, 1650000000, 250)
+    values = plan.extract(msg)
+    assert values == [
+        2,
+        1650000000,
+        250,
+        "imu",
+        1.0,
+        2.0,
+        2.0,
+        0.1,
+        0.2,
+        0.3,
+        [0.0, 1.0],
+        b"\x02\x01",
+        str(msg.points),
+        "sample 2",
+        -1,
+        500,
+    ]
+    # The values convert to the column types of the schema
+    table = pa.Table.from_pylist([dict(zip(plan.schema.names, values))], plan.schema)
+    assert table.to_pylist()[0]["covariance_2"] == 0.3
+
+
+def test_flattening_plan_of_a_message_with_a_single_field():
+    plan = FlatteningPlan(Scalar)
+    assert plan.schema == pa.schema([("value", pa.int64())])
+    assert plan.extract(Scalar(value=7)) == [7]
+
+
+def test_get_flattening_plan_is_compiled_once_per_type():
+    plan = get_flattening_plan(get_sample(0, 1))
+    assert get_flattening_plan(get_sample(1, 2)) is plan
+    assert get_flattening_plan(Vector3()) is not plan
+
+
+def test_parquet_file_writer_flushes_row_groups(tmp_path):
+    plan = FlatteningPlan(Sample)
+    path = str(tmp_path / "topic" / "data.parquet")
+    writer = ParquetFileWriter(path, plan, "drive1", "file1.bag", row_group_size=4)
+    for seq in range(10):
+        msg = get_sample(seq, 1650000000 + seq)
+        writer.append([msg.header.stamp.to_sec(), *plan.extract(msg)])
+    writer.close()
+
+    assert writer.rows == 10
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.num_row_groups == 3
+    assert [parquet_file.metadata.row_group(i).num_rows for i in range(3)] == [4, 4, 2]
+    assert parquet_file.metadata.num_rows == 10
+    table = parquet_file.read()
+    assert table.schema.names == ["Time", *plan.schema.names, "drive_id", "file_id"]
+    assert table.column("header_seq").to_pylist() == list(range(10))
+    assert set(table.column("drive_id").to_pylist()) == {"drive1"}
+    assert set(table.column("file_id").to_pylist()) == {"file1.bag"}
+
+
+def test_parquet_file_writer_without_rows_writes_no_file(tmp_path):
+    path = tmp_path / "topic" / "data.parquet"
+    writer = ParquetFileWriter(str(path), FlatteningPlan(Sample), "drive1", "file1.bag")
+    writer.close()
+    assert writer.rows == 0
+    assert not path.exists()
+
+
+def test_parquet_topic_sink_without_partitions(tmp_path):
+    sink = ParquetTopicSink("/imu/0/data_raw", str(tmp_path), "drive1", "file1.bag")
+    for seq in range(3):
+        sink.write(get_sample(seq, 1650000000 + seq), Time(1650000000 + seq))
+    sink.close()
+
+    assert sink.rows == 3
+    assert sink.files == [
+        {
+            "local_parquet_path": str(tmp_path / "_imu_0_data_raw" / "data.parquet"),
+            "topic": "_imu_0_data_raw",
+            "partition": None,
+        }
+    ]
+    assert get_parquet_target("drive1", "file1.bag", sink.files[0]) == (
+        "drive1/file1/_imu_0_data_raw",
+        "drive1/file1/_imu_0_data_raw/data.parquet",
+    )
+
+
+def test_parquet_topic_sink_partitions_reopen_and_sort(tmp_path):
+    start = 1650000000
+    sink = ParquetTopicSink(
+        "/imu/0/data_raw",
+        str(tmp_path),
+        "drive1",
+        "file1.bag",
+        partition_seconds=10,
+        max_open_partitions=2,
+        sort_by_time=True,
+    )
+    # Seconds after start of the header stamps: with two open partitions, each return to an earlier bucket closes
+    # the least recently written one and reopens the bucket in a new file
+    offsets = [5, 15, 25, 6, 16, 26, 8, 7]
+    for seq, offset in enumerate(offsets):
+        # Bag record times run opposite to the header stamps, which the partitions and sort order follow
+        sink.write(get_sample(seq, start + offset), Time(start + 100 - seq))
+    sink.close()
+
+    topic_dir = tmp_path / "_imu_0_data_raw"
+    expected_files = [
+        ("time_bucket=1650000000", "data-1.parquet", [6]),
+        ("time_bucket=1650000000", "data-2.parquet", [7, 8]),
+        ("time_bucket=1650000000", "data.parquet", [5]),
+        ("time_bucket=1650000010", "data-1.parquet", [16]),
+        ("time_bucket=1650000010", "data.parquet", [15]),
+        ("time_bucket=1650000020", "data-1.parquet", [26]),
+        ("time_bucket=1650000020", "data.parquet", [25]),
+    ]
+    assert sink.files == [
+        {"local_parquet_path": str(topic_dir / partition / name), "topic": "_imu_0_data_raw", "partition": partition}
+        for partition, name, _ in expected_files
+    ]
+    assert sink.rows == len(offsets)
+    for file, (_, _, file_offsets) in zip(sink.files, expected_files):
+        table = pq.read_table(file["local_parquet_path"])
+        assert table.column("header_stamp_secs").to_pylist() == [start + offset for offset in file_offsets]
+        assert table.column("Time").to_pylist() == [start + 100 - offsets.index(offset) for offset in file_offsets]
+
+    assert get_parquet_target("drive1", "file1.bag", sink.files[1]) == (
+        "drive1/file1/_imu_0_data_raw",
+        "drive1/file1/_imu_0_data_raw/time_bucket=1650000000/data-2.parquet",
+    )
+
+
+def test_parquet_topic_sink_rejects_mixed_message_types(tmp_path):
+    sink = ParquetTopicSink("/imu/0/data_raw", str(tmp_path), "drive1", "file1.bag")
+    sink.write(get_sample(0, 1650000000), Time(1650000000))
+    with pytest.raises(ValueError):
+        sink.write(Vector3(), Time(1650000001))
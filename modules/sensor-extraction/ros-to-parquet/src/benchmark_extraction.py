@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Measure the parquet conversion of a synthetic bag read from and uploaded to a filesystem S3 stand-in.
+
+The sensor topics of the bag are downloaded, converted and uploaded as by a job, camera topics only adding the bulk
+of a recorded bag, and the run reports messages/s, MB/s of bag read, peak RSS of the conversion and of its worker
+processes, and the per-stage metrics of the job. Compare the JSON results of two builds to spot regressions:
+
+python3 benchmark_extraction.py --duration 600 --sensor-topics 8 --sensor-rate 200 --image-topics 2 --json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from bag_download import fetch_bag
+from job_metrics import metrics
+from main import extract_parquet, upload_file
+from synthetic_bag import FileSystemS3Client, write_synthetic_bag
+
+SOURCE_BUCKET = "raw"
+TARGET_BUCKET = "extracted"
+DRIVE_ID = "benchmark"
+FILE_ID = "synthetic.bag"
+
+
+def extract(work_dir, bag, options, connection):
+    """Run one conversion like `main` does and send its results through `connection`"""
+    metrics.reset()
+    client = FileSystemS3Client(os.path.join(work_dir, "s3"))
+    topics = bag["sensor_topics"]
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options["upload_workers"]) as uploader, fetch_bag(
+        client,
+        SOURCE_BUCKET,
+        os.path.join(DRIVE_ID, FILE_ID),
+        os.path.join(work_dir, "ros.bag"),
+        stream=options["conversion_workers"] <= 1,
+        topics=topics,
+        max_indexed_fraction=options["indexed_read_max_fraction"],
+        workers=options["download_workers"],
+    ) as bag_reader:
+        upload_futures = []
+
+        def upload_files(files):
+            upload_futures.extend(
+                uploader.submit(upload_file, client, TARGET_BUCKET, DRIVE_ID, FILE_ID, file) for file in files
+            )
+
+        files = extract_parquet(
+            bag_path=bag_reader,
+            topics=topics,
+            output_path=os.path.join(work_dir, "output"),
+            drive_id=DRIVE_ID,
+            file_id=FILE_ID,
+            workers=options["conversion_workers"],
+            on_files=upload_files,
+            **options["writer_options"],
+        )
+    for future in upload_futures:
+        future.result()
+    seconds = time.perf_counter() - start
+
+    messages = bag["sensor_messages"]
+    connection.send(
+        {
+            "seconds": round(seconds, 3),
+            "messages": messages,
+            "messages_per_s": round(messages / seconds, 2),
+            "mb_per_s": round(bag["size_bytes"] / 1024**2 / seconds, 2),
+            "parquet_mb": round(sum(os.path.getsize(file["local_parquet_path"]) for file in files) / 1024**2, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "stages": metrics.summary(),
+        }
+    )
+
+
+def benchmark(work_dir, bag, options):
+    """Convert `bag` in a fresh process, so its peak RSS is that of the conversion alone"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=extract, args=(work_dir, bag, options, sender))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"The conversion process failed with exit code {process.exitcode}") from None
+    finally:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parquet conversion of a synthetic bag")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of recording")
+    parser.add_argument("--sensor-topics", type=int, default=4)
+    parser.add_argument("--sensor-rate", type=float, default=200.0, help="messages per second of each sensor")
+    parser.add_argument("--image-topics", type=int, default=0)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--rate", type=float, default=10.0, help="frames per second of each camera")
+    parser.add_argument("--compression", default="none", choices=["none", "bz2", "lz4"])
+    parser.add_argument("--conversion-workers", type=int, default=1)
+    parser.add_argument("--upload-workers", type=int, default=10)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--indexed-read-max-fraction", type=float, default=0.0)
+    parser.add_argument("--row-group-size", type=int, default=100000)
+    parser.add_argument("--parquet-compression", default="snappy")
+    parser.add_argument("--sort-by-time", action="store_true")
+    parser.add_argument("--partition-seconds", type=int)
+    parser.add_argument("--work-dir", help="directory of the bag and outputs (default: a temporary directory)")
+    parser.add_argument("--output", help="append the results as a JSON line to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    options = {
+        "conversion_workers": args.conversion_workers,
+        "upload_workers": args.upload_workers,
+        "download_workers": args.download_workers,
+        "indexed_read_max_fraction": args.indexed_read_max_fraction,
+        "writer_options": {
+            "row_group_size": args.row_group_size,
+            "compression": args.parquet_compression,
+            "sort_by_time": args.sort_by_time,
+            "partition_seconds": args.partition_seconds,
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        bag = write_synthetic_bag(
+            os.path.join(work_dir, "s3", SOURCE_BUCKET, DRIVE_ID, FILE_ID),
+            duration=args.duration,
+            image_topics=args.image_topics,
+            width=args.width,
+            height=args.height,
+            image_rate=args.rate,
+            sensor_topics=args.sensor_topics,
+            sensor_rate=args.sensor_rate,
+            compression=args.compression,
+        )
+        results = {"benchmark": "ros-to-parquet", "bag": bag, "options": options, **benchmark(work_dir, bag, options)}
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            f"{results['messages']} messages of {bag['size_bytes'] / 1024**2:.1f} MB in {results['seconds']}s - "
+            f"{results['messages_per_s']} messages/s, {results['mb_per_s']} MB/s, "
+            f"peak RSS {results['peak_rss_mb']} MB (worker processes {results['peak_worker_rss_mb']} MB)"
+        )
+        print(f"{'stage':<14} {'count':>8} {'MB':>10} {'seconds':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for stage, values in results["stages"].items():
+            print(
+                f"{stage:<14} {values['count']:>8} {values['bytes'] / 1024**2:>10.1f} {values['seconds']:>9} "
+                f"{values['p50_ms']:>9} {values['p95_ms']:>9}"
+            )
@@ -2,16 +2,21 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import concurrent.futures
 import json
 import logging
 import os
 import sys
+import time
 
 import boto3
-import fastparquet
-import pandas as pd
-import requests
-from bagpy import bagreader
+from bag_cache import BagCache
+from bag_download import fetch_bag, open_bag
+from bag_index import read_bag_file_index
+from botocore.config import Config
+from job_metrics import metrics
+from job_status import JobStatusWriter
+from sensor_parquet import ParquetTopicSink, get_parquet_target
 
 DEBUG_LOGGING_FORMAT = "[%(asctime)s][%(filename)-13s:%(lineno)3d][%(levelname)s][%(threadName)s] %(message)s"
 debug = os.environ.get("DEBUG", "False").lower() in [
@@ -30,86 +35,98 @@ if debug:
     logging.getLogger("s3transfer").setLevel(logging.CRITICAL)
 
 
-class ParquetFromBag:
-    def __init__(self, bag_path, topic, output_path, drive_id, file_id):
-        clean_topic = topic.replace("/", "_")
-        output_dir = os.path.join(output_path, clean_topic)
-        os.makedirs(output_dir, exist_ok=True)
+class ParquetsFromBag:
+    """Convert several topics to parquet with a single read of the bag, dispatching each message to its topic sink.
 
-        local_parquet_name = os.path.join(output_dir, "data.parquet")
+    `bag_path` can also be an opened bag, e.g. a `StreamingBag` reading a bag that is still downloading.
+    """
 
-        bag = bagreader(bag_path)
-        data = bag.message_by_topic(topic)
-        logger.info("Write parquet to {}".format(local_parquet_name))
-
-        self.file = {
-            "local_parquet_path": local_parquet_name,
-            "topic": clean_topic,
+    def __init__(self, bag_path, topics, output_path, drive_id, file_id, **writer_options):
+        self.sinks = {
+            topic: ParquetTopicSink(topic, output_path, drive_id, file_id, **writer_options) for topic in topics
         }
 
-        if data is None:
-            logging.info("No data found for {topic}".format(topic=topic))
-        else:
-            logging.info("Reading data found for {topic}".format(topic=topic))
-            df_out = pd.read_csv(data)
-            df_out.columns = [x.replace(".", "_") for x in df_out.columns]
+        with open_bag(bag_path) as bag:
+            for topic, msg, t in bag.read_messages(topics=list(self.sinks)):
+                self.sinks[topic].write(msg, t)
 
-            df_out["drive_id"] = drive_id
-            df_out["file_id"] = file_id
+        self.files = []
+        for sink in self.sinks.values():
+            sink.close()
+            self.files.extend(sink.files)
 
-            fastparquet.write(local_parquet_name, df_out)
 
+class ParquetFromBag(ParquetsFromBag):
+    def __init__(self, bag_path, topic, output_path, drive_id, file_id, **writer_options):
+        super().__init__(bag_path, [topic], output_path, drive_id, file_id, **writer_options)
+        self.file = self.sinks[topic].file
 
-def upload(client, bucket_name, drive_id, file_id, files):
-    target_prefixes = set()
-    for file in files:
-        clean_topic = file["topic"]
-        target_prefix = os.path.join(drive_id, file_id.replace(".bag", ""), clean_topic)
-        target = os.path.join(target_prefix, "data.parquet")
-        client.upload_file(file["local_parquet_path"], bucket_name, target)
-        target_prefixes.add(target_prefix)
-    return list(target_prefixes)
 
+def plan_topic_groups(bag_path, topics, workers):
+    """Split `topics` into at most `workers` groups with similar message counts.
 
-def get_log_path():
-    response = requests.get(f"{os.environ['ECS_CONTAINER_METADATA_URI_V4']}")
-    task_region = response.json()["LogOptions"]["awslogs-region"]
-    return task_region, response.json()["LogOptions"]["awslogs-stream"].replace("/", "$252F")
+    The counts come from the chunk infos of the index section of the bag, which are read without loading the index
+    records stored after every chunk as opening it with `rosbag.Bag` does.
+    """
+    index = read_bag_file_index(bag_path)
+    topic_info = index["topics"] if index is not None else {}
+    counts = {topic: topic_info[topic]["message_count"] if topic in topic_info else 0 for topic in topics}
+    groups = [[] for _ in range(max(min(workers, len(topics)), 1))]
+    loads = [0] * len(groups)
+    for topic in sorted(topics, key=lambda topic: counts[topic], reverse=True):
+        lightest = loads.index(min(loads))
+        groups[lightest].append(topic)
+        loads[lightest] += counts[topic]
+    return [group for group in groups if group]
 
 
-def save_job_url_and_logs(table, drive_id, file_id, batch_id, index):
-    job_region, log_path = get_log_path()
-    job_url = (
-        f"https://{job_region}.console.aws.amazon.com/batch/home?region={job_region}#jobs/detail/"
-        f"{os.environ['AWS_BATCH_JOB_ID']}"
-    )
+def convert_topics(bag_path, topics, output_path, drive_id, file_id, **writer_options):
+    with metrics.timer("convert"):
+        return ParquetsFromBag(bag_path, topics, output_path, drive_id, file_id, **writer_options).files
 
-    job_cloudwatch_logs = (
-        f"https://{job_region}.console.aws.amazon.com/cloudwatch/home?region={job_region}#"
-        f"logsV2:log-groups/log-group/$252Faws$252Fbatch$252Fjob/log-events/{log_path}"
-    )
 
-    table.update_item(
-        Key={"pk": drive_id, "sk": file_id},
-        UpdateExpression="SET "
-        "parquet_extraction_batch_job = :batch_url, "
-        "parquet_extraction_job_logs = :cloudwatch_logs",
-        ExpressionAttributeValues={
-            ":cloudwatch_logs": job_cloudwatch_logs,
-            ":batch_url": job_url,
-        },
-    )
+def convert_topics_in_worker(*args, **kwargs):
+    """Run `convert_topics` in a worker process and return its files with the metrics recorded there"""
+    # A forked worker starts with a copy of the parent's metrics, which the parent already holds
+    metrics.reset()
+    return convert_topics(*args, **kwargs), metrics
 
-    table.update_item(
-        Key={"pk": batch_id, "sk": index},
-        UpdateExpression="SET "
-        "parquet_extraction_batch_job = :batch_url, "
-        "parquet_extraction_job_logs = :cloudwatch_logs",
-        ExpressionAttributeValues={
-            ":cloudwatch_logs": job_cloudwatch_logs,
-            ":batch_url": job_url,
-        },
-    )
+
+def extract_parquet(bag_path, topics, output_path, drive_id, file_id, workers=1, on_files=None, **writer_options):
+    """Convert `topics` with up to `workers` processes, each reading the bag once for its own group of topics.
+
+    `on_files(files)` is called in this process as soon as a group is converted, so uploads can start while the other
+    groups are still converting. An opened bag, e.g. an `IndexedBag`, is converted in this process. Returns all
+    converted files.
+    """
+    groups = plan_topic_groups(bag_path, topics, workers) if workers > 1 and isinstance(bag_path, str) else [topics]
+    all_files = []
+    if len(groups) == 1:
+        all_files = convert_topics(bag_path, topics, output_path, drive_id, file_id, **writer_options)
+        if on_files is not None:
+            on_files(all_files)
+        return all_files
+
+    logger.info(f"Converting topic groups {groups} with {len(groups)} workers")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [
+            executor.submit(convert_topics_in_worker, bag_path, group, output_path, drive_id, file_id, **writer_options)
+            for group in groups
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            files, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            all_files.extend(files)
+            if on_files is not None:
+                on_files(files)
+    return all_files
+
+
+def upload_file(client, bucket_name, drive_id, file_id, file):
+    target_prefix, target = get_parquet_target(drive_id, file_id, file)
+    with metrics.timer("upload", os.path.getsize(file["local_parquet_path"])):
+        client.upload_file(file["local_parquet_path"], bucket_name, target)
+    return target_prefix
 
 
 def main(table_name, index, batch_id, topics, target_bucket) -> int:
@@ -119,6 +136,38 @@ def main(table_name, index, batch_id, topics, target_bucket) -> int:
     logger.info("topics: %s", topics)
     logger.info("target_bucket: %s", target_bucket)
 
+    row_group_size = int(os.environ.get("PARQUET_ROW_GROUP_SIZE", "100000"))
+    compression = os.environ.get("PARQUET_COMPRESSION", "snappy").lower()
+    use_dictionary = os.environ.get("PARQUET_DICTIONARY", "True").lower() in ["true", "yes", "1"]
+    logger.info("row_group_size: %s", row_group_size)
+    logger.info("compression: %s", compression)
+    sort_by_time = os.environ.get("PARQUET_SORT_BY_TIME", "False").lower() in ["true", "yes", "1"]
+    partition_seconds = int(os.environ.get("PARQUET_TIME_PARTITION_SECONDS", "0")) or None
+    logger.info("use_dictionary: %s", use_dictionary)
+    logger.info("sort_by_time: %s", sort_by_time)
+    logger.info("partition_seconds: %s", partition_seconds)
+    max_open_partitions = int(os.environ.get("PARQUET_MAX_OPEN_PARTITIONS", "4"))
+    logger.info("max_open_partitions: %s", max_open_partitions)
+
+    conversion_workers = int(os.environ.get("CONVERSION_WORKERS", "1"))
+    upload_workers = int(os.environ.get("UPLOAD_WORKERS", "10"))
+    logger.info("conversion_workers: %s", conversion_workers)
+    logger.info("upload_workers: %s", upload_workers)
+    download_workers = int(os.environ.get("DOWNLOAD_WORKERS", "8"))
+    download_part_size_mb = float(os.environ.get("DOWNLOAD_PART_SIZE_MB", "32"))
+    logger.info("download_workers: %s", download_workers)
+    logger.info("download_part_size_mb: %s", download_part_size_mb)
+    bag_cache_dir = os.environ.get("BAG_CACHE_DIR")
+    bag_cache_max_gb = float(os.environ.get("BAG_CACHE_MAX_GB", "100"))
+    logger.info("bag_cache_dir: %s", bag_cache_dir)
+    logger.info("bag_cache_max_gb: %s", bag_cache_max_gb)
+    bag_cache = BagCache(bag_cache_dir, bag_cache_max_gb) if bag_cache_dir else None
+    indexed_read_max_fraction = float(os.environ.get("INDEXED_READ_MAX_FRACTION", "0.5"))
+    logger.info("indexed_read_max_fraction: %s", indexed_read_max_fraction)
+    metrics_namespace = os.environ.get("METRICS_NAMESPACE", "SensorExtraction")
+    logger.info("metrics_namespace: %s", metrics_namespace)
+    job_start = time.perf_counter()
+
     # Getting Item to Process
     dynamodb = boto3.resource("dynamodb")
     table = dynamodb.Table(table_name)
@@ -133,61 +182,72 @@ def main(table_name, index, batch_id, topics, target_bucket) -> int:
 
     drive_id = item["drive_id"]
     file_id = item["file_id"]
-    s3 = boto3.client("s3")
+    s3 = boto3.client("s3", config=Config(max_pool_connections=max(upload_workers, download_workers, 10)))
 
-    save_job_url_and_logs(table, drive_id, file_id, batch_id, index)
+    status = JobStatusWriter(table, [{"pk": drive_id, "sk": file_id}, {"pk": batch_id, "sk": index}])
+    status.set_job_urls(["parquet_extraction"])
+    status.flush()
 
     bag_path = "/tmp/ros.bag"
     local_output_path = "/tmp/output"
 
-    logger.info("Downloading Bag")
-    s3.download_file(item["s3_bucket"], item["s3_key"], bag_path)
-    logger.info(f"Bag downloaded to {bag_path}")
-
     # save_metadata_to_dynamo(bag, s3_prefix, local_file_name, s3_bucket)
 
-    all_files = []
-    for topic in topics:
-        logger.info(f"Getting data from topic: {topic}")
-        bag_obj = ParquetFromBag(
-            topic=topic,
-            bag_path=bag_path,
+    logger.info(f"Getting data from topics: {topics}")
+    logger.info(f"Uploading results - {target_bucket}")
+    # Worker processes open the bag by path through its index, which needs the complete file, unless the sensor
+    # topics are read from their chunks alone in this process
+    with concurrent.futures.ThreadPoolExecutor(max_workers=upload_workers) as uploader, fetch_bag(
+        s3,
+        item["s3_bucket"],
+        item["s3_key"],
+        bag_path,
+        cache=bag_cache,
+        stream=conversion_workers <= 1,
+        topics=topics,
+        max_indexed_fraction=indexed_read_max_fraction,
+        part_size_mb=download_part_size_mb,
+        workers=download_workers,
+    ) as bag:
+        upload_futures = []
+
+        def upload_files(files):
+            upload_futures.extend(
+                uploader.submit(upload_file, s3, target_bucket, drive_id, file_id, file) for file in files
+            )
+
+        extract_parquet(
+            bag_path=bag,
+            topics=topics,
             output_path=local_output_path,
             drive_id=drive_id,
             file_id=file_id,
+            workers=conversion_workers,
+            on_files=upload_files,
+            row_group_size=row_group_size,
+            compression=compression,
+            use_dictionary=use_dictionary,
+            sort_by_time=sort_by_time,
+            partition_seconds=partition_seconds,
+            max_open_partitions=max_open_partitions,
         )
-        all_files.append(bag_obj.file)
-
-    # Sync results
-    logger.info(f"Uploading results - {target_bucket}")
-    uploaded_directories = upload(s3, target_bucket, drive_id, file_id, all_files)
+    uploaded_directories = sorted({future.result() for future in upload_futures})
     logger.info("Uploaded results")
 
+    metrics.record("job", time.perf_counter() - job_start)
+    logger.info("Stage metrics: %s", metrics.summary())
+    metrics.log_emf(metrics_namespace, {"Module": "ros-to-parquet"})
+
     logger.info("Writing job status to DynamoDB")
-    table.update_item(
-        Key={"pk": item["drive_id"], "sk": item["file_id"]},
-        UpdateExpression="SET "
-        "parquet_extraction_status = :parquet_status, "
-        "raw_parquet_dirs = :raw_parquet_dirs, "
-        "raw_parquet_bucket = :raw_parquet_bucket",
-        ExpressionAttributeValues={
-            ":parquet_status": "success",
-            ":raw_parquet_dirs": uploaded_directories,
-            ":raw_parquet_bucket": target_bucket,
-        },
-    )
-    table.update_item(
-        Key={"pk": batch_id, "sk": index},
-        UpdateExpression="SET "
-        "parquet_extraction_status = :parquet_status, "
-        "raw_parquet_dirs = :raw_parquet_dirs, "
-        "raw_parquet_bucket = :raw_parquet_bucket",
-        ExpressionAttributeValues={
-            ":parquet_status": "success",
-            ":raw_parquet_dirs": uploaded_directories,
-            ":raw_parquet_bucket": target_bucket,
-        },
+    status.set(
+        {
+            "parquet_extraction_status": "success",
+            "parquet_extraction_metrics": metrics.to_item(),
+            "raw_parquet_dirs": uploaded_directories,
+            "raw_parquet_bucket": target_bucket,
+        }
     )
+    status.flush()
     return 0
 
 
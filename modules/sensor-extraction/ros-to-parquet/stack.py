@@ -3,6 +3,8 @@
 
 import logging
 import os
+import shutil
+import tempfile
 from typing import Any, cast
 
 import aws_cdk.aws_batch as batch
@@ -18,6 +20,30 @@ from constructs import Construct, IConstruct
 
 _logger: logging.Logger = logging.getLogger(__name__)
 
+# The sources shared by the sensor extraction images, next to this module in the repository and in the `dataFiles` of
+# the module once bundled by seedfarmer, which places them under the project path next to the module directory
+COMMON_SOURCE_PATHS = [
+    os.path.join("..", "common", "src"),
+    os.path.join("..", "modules", "sensor-extraction", "common", "src"),
+]
+
+
+def get_image_directory() -> str:
+    """Stage the Docker build context of the image: the `src` directory of this module and the shared sources"""
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    common_dirs = [os.path.join(module_dir, path) for path in COMMON_SOURCE_PATHS]
+    common_dir = next((path for path in common_dirs if os.path.isdir(path)), None)
+    if common_dir is None:
+        raise ValueError("modules/sensor-extraction/common/src is missing, add it to the dataFiles of the module")
+    image_dir = tempfile.mkdtemp(prefix="ros-to-parquet-image-")
+    shutil.copytree(
+        os.path.join(module_dir, "src"), image_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns("__pycache__")
+    )
+    for name in os.listdir(common_dir):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(common_dir, name), image_dir)
+    return image_dir
+
 
 class RosToParquetBatchJob(Stack):
     def __init__(
@@ -57,7 +83,7 @@ class RosToParquetBatchJob(Stack):
         local_image = DockerImageAsset(
             self,
             "RosToParquet",
-            directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"),
+            directory=get_image_directory(),
         )
 
         image_uri = f"{repo.repository_uri}:latest"
@@ -113,6 +139,7 @@ class RosToParquetBatchJob(Stack):
                     "AWS_DEFAULT_REGION": self.region,
                     "AWS_ACCOUNT_ID": self.account,
                     "DEBUG": "true",
+                    "CONVERSION_WORKERS": str(vcpus),
                 },
                 job_role=role,
                 execution_role=role,
@@ -129,11 +156,21 @@ class RosToParquetBatchJob(Stack):
                     "AWS_DEFAULT_REGION": self.region,
                     "AWS_ACCOUNT_ID": self.account,
                     "DEBUG": "true",
+                    "CONVERSION_WORKERS": str(vcpus),
+                    "BAG_CACHE_DIR": "/mnt/ebs/bag-cache",
                 },
                 job_role=role,
                 execution_role=role,
                 memory=Size.mebibytes(memory_limit_mib),
                 cpu=vcpus,
+                volumes=[
+                    batch.EcsVolume.host(
+                        name="scratch",
+                        container_path="/mnt/ebs",
+                        host_path="/mnt/ebs",
+                        readonly=False,
+                    ),
+                ],
             ),
             job_definition_name=repo.repository_name,
             retry_attempts=retries,
@@ -6,7 +6,7 @@ import sys
 
 import aws_cdk as cdk
 import pytest
-from aws_cdk.assertions import Template
+from aws_cdk.assertions import Match, Template
 
 
 @pytest.fixture(scope="function")
@@ -60,6 +60,7 @@ def test_synthesize_stack(stack_defaults):
         props={
             "ContainerProperties": {
                 "Command": ["bash", "entrypoint.sh"],
+                "Environment": Match.array_with([{"Name": "CONVERSION_WORKERS", "Value": "2"}]),
                 "ReadonlyRootFilesystem": False,
                 "ResourceRequirements": [
                     {"Type": "MEMORY", "Value": "8192"},
@@ -71,3 +72,51 @@ def test_synthesize_stack(stack_defaults):
             "Timeout": {"AttemptDurationSeconds": 1800},
         },
     )
+
+
+def test_synthesize_stack_ec2(stack_defaults):
+    import stack
+
+    app = cdk.App()
+    project_name = "test-project"
+    dep_name = "test-deployment"
+    mod_name = "test-module"
+
+    ros_to_parquet = stack.RosToParquetBatchJob(
+        scope=app,
+        id=f"{project_name}-{dep_name}-{mod_name}",
+        project_name=project_name,
+        deployment_name=dep_name,
+        module_name=mod_name,
+        platform="EC2",
+        ecr_repository_arn="arn:aws:ecr:us-east-1:123456789012:repository/addf-docker-repository",
+        s3_access_policy="'arn:aws:iam::123456789012:policy/addf-buckets-us-west-2-123-full-access",
+        retries=1,
+        timeout_seconds=1800,
+        vcpus=2,
+        memory_limit_mib=8192,
+        stack_description="Testing",
+        env=cdk.Environment(
+            account=os.environ["CDK_DEFAULT_ACCOUNT"],
+            region=os.environ["CDK_DEFAULT_REGION"],
+        ),
+    )
+
+    template = Template.from_stack(ros_to_parquet)
+    template.has_resource_properties(
+        type="AWS::Batch::JobDefinition",
+        props={
+            "ContainerProperties": {
+                "Environment": Match.array_with([{"Name": "BAG_CACHE_DIR", "Value": "/mnt/ebs/bag-cache"}]),
+                "MountPoints": [
+                    {
+                        "ContainerPath": "/mnt/ebs",
+                        "ReadOnly": False,
+                        "SourceVolume": "scratch",
+                    }
+                ],
+                "Volumes": [{"Name": "scratch", "Host": {"SourcePath": "/mnt/ebs"}}],
+            },
+            "PlatformCapabilities": ["EC2"],
+        },
+    )
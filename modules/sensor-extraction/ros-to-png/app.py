@@ -24,6 +24,7 @@ vcpus = int(os.getenv(_param("VCPUS"), 4))
 memory_limit_mib = int(os.getenv(_param("MEMORY_MIB"), 16384))
 resized_width = os.getenv(_param("RESIZED_WIDTH"))
 resized_height = os.getenv(_param("RESIZED_HEIGHT"))
+resize_targets = os.getenv(_param("RESIZE_TARGETS"))
 
 batch_config = {
     "retries": retries,
@@ -38,6 +39,9 @@ if resized_width:
 if resized_height:
     batch_config["resized_height"] = int(resized_height)
 
+if resize_targets:
+    batch_config["resize_targets"] = resize_targets
+
 if not ecr_repository_arn:
     raise ValueError("ECR Repository ARN is missing.")
 
@@ -0,0 +1,193 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Measure the image extraction of a synthetic bag read from and uploaded to a filesystem S3 stand-in.
+
+The bag is downloaded, extracted and uploaded as by a job, and the run reports frames/s, MB/s of bag read, peak RSS
+of the extraction and of its encoder processes, and the per-stage metrics of the job. Compare the JSON results of two
+builds to spot regressions:
+
+python3 benchmark_extraction.py --size-mb 500 --image-topics 2 --width 1920 --height 1080 --rate 10 --json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from bag_download import fetch_bag
+from job_metrics import metrics
+from main import (
+    StreamingUploader,
+    extract_images,
+    get_parquet_target,
+    get_resize_targets,
+    get_upload_target,
+)
+from sensor_parquet import ParquetTopicSink
+from synthetic_bag import FileSystemS3Client, get_duration_for_size, write_synthetic_bag
+
+SOURCE_BUCKET = "raw"
+TARGET_BUCKET = "extracted"
+DRIVE_ID = "benchmark"
+FILE_ID = "synthetic.bag"
+
+
+def extract(work_dir, bag, options, connection):
+    """Run one extraction like `main` does and send its results through `connection`"""
+    metrics.reset()
+    client = FileSystemS3Client(os.path.join(work_dir, "s3"))
+    output_path = os.path.join(work_dir, "output")
+    sensor_sinks = {}
+    if options["combined"]:
+        sensor_sinks = {
+            topic: ParquetTopicSink(topic, os.path.join(output_path, "parquet"), DRIVE_ID, FILE_ID)
+            for topic in bag["sensor_topics"]
+        }
+
+    def upload_frame(files, buffers):
+        for idx, file in enumerate(files):
+            target = get_upload_target(DRIVE_ID, FILE_ID, file)
+            if buffers is None:
+                uploader.submit(file["local_image_path"], target)
+            else:
+                uploader.submit_bytes(buffers[idx], target)
+
+    start = time.perf_counter()
+    with StreamingUploader(
+        client, TARGET_BUCKET, options["upload_workers"], options["max_pending_uploads"]
+    ) as uploader, fetch_bag(
+        client,
+        SOURCE_BUCKET,
+        os.path.join(DRIVE_ID, FILE_ID),
+        os.path.join(work_dir, "ros.bag"),
+        topics=bag["image_topics"] + list(sensor_sinks),
+        max_indexed_fraction=options["indexed_read_max_fraction"],
+        workers=options["download_workers"],
+    ) as bag_reader:
+        files_by_topic = extract_images(
+            bag_reader,
+            bag["image_topics"],
+            options["resize_targets"],
+            "bgr8",
+            os.path.join(output_path, "images"),
+            options["encode_workers"],
+            options["max_pending_frames"],
+            on_frame_written=upload_frame,
+            in_memory=options["in_memory"],
+            image_format=options["image_format"],
+            sensor_sinks=sensor_sinks,
+        )
+        for sink in sensor_sinks.values():
+            for file in sink.files:
+                uploader.submit(file["local_parquet_path"], get_parquet_target(DRIVE_ID, FILE_ID, file)[1])
+    seconds = time.perf_counter() - start
+    uploaded_bytes = uploader.uploaded_bytes
+
+    frames = sum(1 for topic, files in files_by_topic.items() for file in files if file["topic"] == topic)
+    connection.send(
+        {
+            "seconds": round(seconds, 3),
+            "frames": frames,
+            "frames_per_s": round(frames / seconds, 2),
+            "mb_per_s": round(bag["size_bytes"] / 1024**2 / seconds, 2),
+            "uploaded_mb": round(uploaded_bytes / 1024**2, 2),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "stages": metrics.summary(),
+        }
+    )
+
+
+def benchmark(work_dir, bag, options):
+    """Extract `bag` in a fresh process, so its peak RSS is that of the extraction alone"""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=extract, args=(work_dir, bag, options, sender))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"The extraction process failed with exit code {process.exitcode}") from None
+    finally:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image extraction of a synthetic bag")
+    parser.add_argument("--size-mb", type=float, help="size of raw frames in the bag, overrides --duration")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of recording")
+    parser.add_argument("--image-topics", type=int, default=2)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--rate", type=float, default=10.0, help="frames per second of each camera")
+    parser.add_argument("--sensor-topics", type=int, default=1)
+    parser.add_argument("--sensor-rate", type=float, default=100.0)
+    parser.add_argument("--compression", default="none", choices=["none", "bz2", "lz4"])
+    parser.add_argument("--combined", action="store_true", help="also convert the sensor topics to parquet")
+    parser.add_argument("--resized-width", type=int, default=1280)
+    parser.add_argument("--resized-height", type=int, default=720)
+    parser.add_argument("--image-format", default="png")
+    parser.add_argument("--encode-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-pending-frames", type=int)
+    parser.add_argument("--upload-workers", type=int, default=100)
+    parser.add_argument("--max-pending-uploads", type=int, default=1000)
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--in-memory", action="store_true")
+    parser.add_argument("--indexed-read-max-fraction", type=float, default=0.0)
+    parser.add_argument("--work-dir", help="directory of the bag and outputs (default: a temporary directory)")
+    parser.add_argument("--output", help="append the results as a JSON line to this file")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    options = {
+        "combined": args.combined,
+        "resize_targets": get_resize_targets(args.resized_width, args.resized_height),
+        "image_format": args.image_format,
+        "encode_workers": args.encode_workers,
+        "max_pending_frames": args.max_pending_frames,
+        "upload_workers": args.upload_workers,
+        "max_pending_uploads": args.max_pending_uploads,
+        "download_workers": args.download_workers,
+        "in_memory": args.in_memory,
+        "indexed_read_max_fraction": args.indexed_read_max_fraction,
+    }
+    duration = args.duration
+    if args.size_mb is not None:
+        duration = get_duration_for_size(args.size_mb, args.image_topics, args.width, args.height, args.rate)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.work_dir or temp_dir
+        bag = write_synthetic_bag(
+            os.path.join(work_dir, "s3", SOURCE_BUCKET, DRIVE_ID, FILE_ID),
+            duration=duration,
+            image_topics=args.image_topics,
+            width=args.width,
+            height=args.height,
+            image_rate=args.rate,
+            sensor_topics=args.sensor_topics,
+            sensor_rate=args.sensor_rate,
+            compression=args.compression,
+        )
+        results = {"benchmark": "ros-to-png", "bag": bag, "options": options, **benchmark(work_dir, bag, options)}
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            f"{results['frames']} frames of {bag['size_bytes'] / 1024**2:.1f} MB in {results['seconds']}s - "
+            f"{results['frames_per_s']} frames/s, {results['mb_per_s']} MB/s, peak RSS {results['peak_rss_mb']} MB "
+            f"(encoder processes {results['peak_worker_rss_mb']} MB)"
+        )
+        print(f"{'stage':<14} {'count':>8} {'MB':>10} {'seconds':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for stage, values in results["stages"].items():
+            print(
+                f"{stage:<14} {values['count']:>8} {values['bytes'] / 1024**2:>10.1f} {values['seconds']:>9} "
+                f"{values['p50_ms']:>9} {values['p95_ms']:>9}"
+            )
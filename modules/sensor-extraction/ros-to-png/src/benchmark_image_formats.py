@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Report encode time and size per frame of each supported image format on synthetic camera-like frames.
+
+python3 benchmark_image_formats.py --width 1920 --height 1080 --frames 20 png png:1 png:6 webp jpg:95 npy
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from image_formats import encode_image, parse_image_format
+
+DEFAULT_FORMATS = ["png", "png:0", "png:1", "png:3", "png:6", "png:9", "webp", "jpg:95", "jpg:90", "npy"]
+
+
+def synthetic_frames(width, height, count, seed=0):
+    """Smooth gradients with moving shapes and sensor noise, which compress roughly like real camera frames"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        base = np.stack(
+            [
+                (x * 255 // max(width - 1, 1) + i * 3) % 256,
+                (y * 255 // max(height - 1, 1) + i * 5) % 256,
+                ((x + y) * 255 // max(width + height - 2, 1) + i * 7) % 256,
+            ],
+            axis=-1,
+        ).astype(np.int16)
+        cx, cy = (i * 37) % width, (i * 23) % height
+        base[max(cy - height // 8, 0) : cy + height // 8, max(cx - width // 8, 0) : cx + width // 8] //= 2
+        noise = rng.normal(0, 4, size=base.shape).astype(np.int16)
+        frames.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def benchmark(frames, specs):
+    results = []
+    for spec in specs:
+        extension, params = parse_image_format(spec)
+        encode_image(frames[0], extension, params)  # warm up
+        total_bytes = 0
+        start = time.perf_counter()
+        for frame in frames:
+            total_bytes += len(encode_image(frame, extension, params))
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "format": spec,
+                "encode_ms_per_frame": round(elapsed * 1000 / len(frames), 2),
+                "bytes_per_frame": total_bytes // len(frames),
+                "compression_ratio": round(frames[0].nbytes * len(frames) / total_bytes, 2),
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark image formats")
+    parser.add_argument("formats", nargs="*", default=DEFAULT_FORMATS)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = benchmark(synthetic_frames(args.width, args.height, args.frames), args.formats)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'format':<10} {'ms/frame':>10} {'bytes/frame':>12} {'ratio':>7}")
+        for r in results:
+            print(
+                f"{r['format']:<10} {r['encode_ms_per_frame']:>10} {r['bytes_per_frame']:>12} "
+                f"{r['compression_ratio']:>7}"
+            )
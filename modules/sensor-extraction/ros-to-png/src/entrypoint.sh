@@ -10,10 +10,17 @@ env
 
 echo "[$(date)] Start Image Extraction - batch $BATCH_ID, index: $AWS_BATCH_JOB_ARRAY_INDEX"
 echo "[$(date)] Start Image Extraction - $IMAGE_TOPICS"
+# With SENSOR_TOPICS set, the same pass over the bag also converts those topics to parquet
+SENSOR_ARGS=()
+if [ -n "$SENSOR_TOPICS" ]; then
+    echo "[$(date)] Start Parquet Extraction - $SENSOR_TOPICS"
+    SENSOR_ARGS=(--sensortopics "$SENSOR_TOPICS")
+fi
 python3 main.py \
     --tablename $TABLE_NAME \
     --index $AWS_BATCH_JOB_ARRAY_INDEX \
     --batchid $BATCH_ID \
     --imagetopics "$IMAGE_TOPICS" \
     --desiredencoding $DESIRED_ENCODING \
-    --targetbucket $TARGET_BUCKET
+    --targetbucket $TARGET_BUCKET \
+    "${SENSOR_ARGS[@]}"
@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import json
+import logging
+import os
+import tarfile
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".index.json"
+
+
+class FrameArchiveWriter:
+    """Pack encoded frames of one output directory into tar shards, each with a JSON index of frame offsets.
+
+    Shards are named `shard-000000.tar`, `shard-000001.tar`, ... and a shard is closed once it reaches
+    `max_shard_bytes`. Its sidecar `shard-000000.tar.index.json` lists every frame as
+    `{"name": ..., "offset": ..., "size": ...}`, where `offset` is the byte offset of the frame data inside the
+    shard, so a single frame can be fetched with a ranged GET. `on_shard_closed(shard_path, index_path)` is called
+    for every completed shard.
+    """
+
+    def __init__(self, output_dir, max_shard_bytes, on_shard_closed=None):
+        self.output_dir = output_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.on_shard_closed = on_shard_closed
+        self.shard_count = 0
+        self.shard_path = None
+        self.tar = None
+        self.index = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, name, data):
+        if self.tar is None:
+            self.shard_path = os.path.join(self.output_dir, "shard-{:06d}.tar".format(self.shard_count))
+            self.tar = tarfile.open(self.shard_path, "w", format=tarfile.USTAR_FORMAT)
+            self.index = []
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+        self.index.append({"name": name, "offset": offset, "size": info.size})
+        if self.tar.offset >= self.max_shard_bytes:
+            self._close_shard()
+
+    def _close_shard(self):
+        self.tar.close()
+        self.tar = None
+        index_path = self.shard_path + INDEX_SUFFIX
+        with open(index_path, "w") as f:
+            json.dump({"shard": os.path.basename(self.shard_path), "frames": self.index}, f)
+        logger.info(f"Closed shard {self.shard_path} with {len(self.index)} frames")
+        self.shard_count += 1
+        if self.on_shard_closed is not None:
+            self.on_shard_closed(self.shard_path, index_path)
+
+    def close(self):
+        if self.tar is not None:
+            self._close_shard()
+
+
+def read_frame(client, bucket_name, shard_key, frame):
+    """Fetch a single frame from a shard in S3 with a ranged GET, `frame` being an entry of the shard's index"""
+    byte_range = "bytes={}-{}".format(frame["offset"], frame["offset"] + frame["size"] - 1)
+    return client.get_object(Bucket=bucket_name, Key=shard_key, Range=byte_range)["Body"].read()
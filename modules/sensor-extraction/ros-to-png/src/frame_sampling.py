@@ -0,0 +1,31 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+
+class FrameSampler:
+    """Decide from the header stamp whether a frame is extracted, before it is decoded.
+
+    Frames outside of all `time_windows` (`[start, end]` pairs in epoch seconds, inclusive) are dropped, then only
+    every `stride`-th remaining frame is kept, and finally frames closer than `1 / target_hz` seconds (within 5%
+    to absorb timestamp jitter) to the previously kept frame are dropped.
+    """
+
+    def __init__(self, stride=1, target_hz=None, time_windows=None):
+        self.stride = max(1, int(stride or 1))
+        self.min_period = 0.95 / target_hz if target_hz else None
+        self.time_windows = time_windows or []
+        self.count = 0
+        self.last_kept = None
+
+    def keep(self, stamp):
+        stamp_secs = stamp.to_sec()
+        if self.time_windows and not any(start <= stamp_secs <= end for start, end in self.time_windows):
+            return False
+        self.count += 1
+        if (self.count - 1) % self.stride != 0:
+            return False
+        if self.min_period is not None and self.last_kept is not None:
+            if stamp_secs - self.last_kept < self.min_period:
+                return False
+        self.last_kept = stamp_secs
+        return True
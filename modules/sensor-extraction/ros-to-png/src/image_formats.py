@@ -0,0 +1,48 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+
+import cv2
+import numpy as np
+
+DEFAULT_IMAGE_FORMAT = "png"
+
+
+def parse_image_format(spec):
+    """Return `(extension, imencode params)` for a format spec of the form `<format>[:<level>]`
+
+    - `png[:0-9]`: lossless PNG with the given zlib compression level (OpenCV default when omitted)
+    - `webp[:1-101]`: WebP, lossless at the default quality of 101, lossy below
+    - `jpg[:0-100]`: JPEG with the given quality (default 95)
+    - `npy`: the raw decoded array in NumPy format
+    """
+    name, _, level = (spec or DEFAULT_IMAGE_FORMAT).lower().partition(":")
+    if name == "png":
+        return ".png", [cv2.IMWRITE_PNG_COMPRESSION, parse_level(spec, level, 0, 9)] if level else []
+    if name == "webp":
+        return ".webp", [cv2.IMWRITE_WEBP_QUALITY, parse_level(spec, level, 1, 101) if level else 101]
+    if name in ["jpg", "jpeg"]:
+        return ".jpg", [cv2.IMWRITE_JPEG_QUALITY, parse_level(spec, level, 0, 100) if level else 95]
+    if name == "npy" and not level:
+        return ".npy", []
+    raise ValueError(f"Unsupported image format: {spec}")
+
+
+def parse_level(spec, level, minimum, maximum):
+    """The compression level or quality of a format spec, which must be an integer from `minimum` to `maximum`"""
+    if not level.isdigit() or not minimum <= int(level) <= maximum:
+        raise ValueError(f"Invalid level in image format {spec}, expected an integer from {minimum} to {maximum}")
+    return int(level)
+
+
+def encode_image(image, extension, params):
+    """Encode `image` with a format returned by `parse_image_format` and return the bytes"""
+    if extension == ".npy":
+        buffer = io.BytesIO()
+        np.save(buffer, image)
+        return buffer.getvalue()
+    success, buffer = cv2.imencode(extension, image, params)
+    if not success:
+        raise RuntimeError(f"Could not encode image as {extension}")
+    return buffer.tobytes()
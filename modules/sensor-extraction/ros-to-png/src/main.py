@@ -2,20 +2,36 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-import concurrent
+import collections
+import concurrent.futures
+import functools
+import io
 import json
 import logging
+import multiprocessing
 import os
 import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 import boto3
+import botocore.config
 import cv2
-import requests
 import rosbag
 import rospy
+from bag_cache import BagCache
+from bag_download import fetch_bag, open_bag
+from boto3.s3.transfer import TransferConfig
 from cv_bridge import CvBridge
+from frame_archive import FrameArchiveWriter
+from frame_sampling import FrameSampler
+from image_formats import encode_image, parse_image_format
+from job_metrics import StageMetrics, metrics
+from job_status import JobStatusWriter
+from sensor_parquet import ParquetTopicSink, get_parquet_target
 
 DEBUG_LOGGING_FORMAT = "[%(asctime)s][%(filename)-13s:%(lineno)3d][%(levelname)s][%(threadName)s] %(message)s"
 debug = os.environ.get("DEBUG", "False").lower() in [
@@ -34,19 +50,435 @@ if debug:
     logging.getLogger("s3transfer").setLevel(logging.CRITICAL)
 
 
+FFMPEG_PIX_FMTS = {
+    "bgr8": "bgr24",
+    "rgb8": "rgb24",
+    "bgra8": "bgra",
+    "rgba8": "rgba",
+    "mono8": "gray",
+    "mono16": "gray16le",
+}
+
+
+class VideoWriter:
+    """Encode decoded frames into a video by streaming them as raw frames into an ffmpeg subprocess.
+
+    ffmpeg is started on the first frame, once the frame size is known, and encodes concurrently with the bag reader.
+    Its messages go to a temporary file rather than a pipe nobody reads while frames are written, and are reported
+    when ffmpeg fails. Only the encodings of `FFMPEG_PIX_FMTS` can be encoded, others raise a `ValueError`.
+    """
+
+    def __init__(self, video_path, encoding, codec="libx264", crf=25, frame_rate=20):
+        if encoding not in FFMPEG_PIX_FMTS:
+            raise ValueError(
+                f"Cannot encode {encoding} frames into a video, supported encodings: {sorted(FFMPEG_PIX_FMTS)}"
+            )
+        self.video_path = video_path
+        self.pix_fmt = FFMPEG_PIX_FMTS[encoding]
+        self.codec = codec
+        self.crf = crf
+        self.frame_rate = frame_rate
+        self.process = None
+        self.stderr = None
+        self.frames = 0
+
+    def _start(self, width, height):
+        os.makedirs(os.path.dirname(self.video_path), exist_ok=True)
+        command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            self.pix_fmt,
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(self.frame_rate),
+            "-i",
+            "-",
+            "-vf",
+            "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-c:v",
+            self.codec,
+            "-crf",
+            str(self.crf),
+            "-pix_fmt",
+            "yuv420p",
+            "-movflags",
+            "+faststart",
+            self.video_path,
+        ]
+        logger.info(" ".join(command))
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self.stderr)
+
+    def _error(self):
+        self.process.wait()
+        self.stderr.seek(0)
+        message = self.stderr.read().decode(errors="replace")
+        self.stderr.close()
+        return RuntimeError(f"ffmpeg failed for {self.video_path} with exit code {self.process.returncode}: {message}")
+
+    def write(self, cv_image):
+        if self.process is None:
+            self._start(cv_image.shape[1], cv_image.shape[0])
+        try:
+            self.process.stdin.write(cv_image.tobytes())
+        except BrokenPipeError:
+            raise self._error() from None
+        self.frames += 1
+
+    def close(self):
+        if self.process is None:
+            return False
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise self._error()
+        self.stderr.close()
+        logger.info(f"Encoded {self.frames} frames into {self.video_path}")
+        return True
+
+
 class VideoFromBag:
-    def __init__(self, topic, images_path):
+    """Encode every frame of a topic into `output_path/<topic>/video.mp4` without writing intermediate images"""
+
+    def __init__(self, topic, encoding, bag_path, output_path, codec="libx264", crf=25, frame_rate=20):
         self.bridge = CvBridge()
-        output_dir = os.path.join(images_path, topic.replace("/", "_"))
-        self.video = f'/tmp/{topic.replace("/", "_")}/video.mp4'
+        self.video = os.path.join(output_path, topic.replace("/", "_"), "video.mp4")
         logger.info("Get video for topic {}".format(topic))
+        writer = VideoWriter(self.video, encoding, codec, crf, frame_rate)
+        with rosbag.Bag(bag_path) as bag:
+            for _, msg, _ in bag.read_messages(topics=[topic]):
+                writer.write(self.bridge.imgmsg_to_cv2(msg, desired_encoding=encoding))
+        writer.close()
+
+
+def encode_variants(cv_image, outputs, metrics=metrics):
+    """Resize `cv_image` for each `(size, path, image_format)` in `outputs` and return the encoded images in order.
+
+    A `None` size means the raw image, `image_format` is an `(extension, params)` tuple from `parse_image_format`.
+    """
+    buffers = []
+    for size, im_out_path, image_format in outputs:
+        out_image = cv_image
+        if size is not None:
+            with metrics.timer("resize"):
+                out_image = cv2.resize(cv_image, size)
+        with metrics.timer("encode") as timer:
+            buffers.append(encode_image(out_image, *image_format))
+            timer.bytes = len(buffers[-1])
+    return buffers
+
+
+def write_variants(cv_image, outputs, metrics=metrics):
+    """Resize and encode `cv_image` like `encode_variants` and write each image to its path"""
+    for (_, im_out_path, _), buffer in zip(outputs, encode_variants(cv_image, outputs, metrics)):
+        with metrics.timer("write", len(buffer)):
+            with open(im_out_path, "wb") as f:
+                f.write(buffer)
+
+
+def encode_in_worker(func, cv_image, outputs):
+    """Run `func` in an encoder process and return its result with the metrics it recorded there"""
+    worker_metrics = StageMetrics()
+    return func(cv_image, outputs, worker_metrics), worker_metrics
+
+
+class FrameEncoderPool:
+    """Resize and encode decoded frames in a pool of worker processes.
+
+    The bag reader is the producer; at most `max_pending` frames are queued or in flight at any time so memory stays
+    bounded when encoding is slower than decoding. `on_done` callbacks run on the producer thread, in submission
+    order, with the result of `func` (see `write_variants` and `encode_variants`). With a single worker frames are
+    encoded inline. Metrics recorded by the workers are merged into the job's `metrics`.
+
+    Workers are spawned rather than forked, as the pool starts while download and upload threads are running and a
+    forked child would inherit locks they hold.
+    """
+
+    def __init__(self, workers=1, max_pending=None):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending or 2 * self.workers
+        self.executor = None
+        if self.workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self.pending = collections.deque()
+
+    def submit(self, func, cv_image, outputs, on_done=None):
+        if self.executor is None:
+            result = func(cv_image, outputs)
+            if on_done is not None:
+                on_done(result)
+            return
+        while len(self.pending) >= self.max_pending:
+            self._complete_oldest()
+        self.pending.append((self.executor.submit(encode_in_worker, func, cv_image, outputs), on_done))
+        while self.pending and self.pending[0][0].done():
+            self._complete_oldest()
+
+    def _complete_oldest(self):
+        future, on_done = self.pending.popleft()
+        result, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        if on_done is not None:
+            on_done(result)
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            while self.pending:
+                self._complete_oldest()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for future, _ in self.pending:
+                future.cancel()
+            self.pending.clear()
+        self.close()
+
+
+class ProgressLogger:
+    """Log the extraction progress of a job every `every_frames` frames or `every_seconds` seconds.
+
+    A single line with the frame count and rate replaces a line per frame, whose formatting and log ingestion are
+    material at 100k+ frames per bag. When DEBUG logging is on, `add` returns True for one frame out of every
+    `debug_sample_frames` (`1` for every frame), whose files are then logged individually. `clock` returns the
+    current time in seconds.
+    """
+
+    def __init__(self, every_frames=1000, every_seconds=30, debug_sample_frames=100, clock=time.monotonic):
+        self.every_frames = every_frames
+        self.every_seconds = every_seconds
+        self.debug_sample_frames = max(1, int(debug_sample_frames or 1))
+        self.debug = logger.isEnabledFor(logging.DEBUG)
+        self.frames = 0
+        self.skipped_frames = 0
+        self.clock = clock
+        self.start_time = clock()
+        self.last_time = self.start_time
+        self.last_frames = 0
+
+    def add(self, skipped=False):
+        """Count a frame and log the progress when due, returns whether the frame is sampled for DEBUG logging"""
+        self.frames += 1
+        self.skipped_frames += skipped
+        now = self.clock()
+        if self.frames - self.last_frames >= self.every_frames or now - self.last_time >= self.every_seconds:
+            self.log(now)
+        return self.debug and self.frames % self.debug_sample_frames == 1 % self.debug_sample_frames
+
+    def log(self, now=None):
+        now = self.clock() if now is None else now
+        elapsed = max(now - self.start_time, 1e-6)
+        recent_rate = (self.frames - self.last_frames) / max(now - self.last_time, 1e-6)
         logger.info(
-            f"""ffmpeg -r 20 -f image2 -i {output_dir}/frame_%06d.png \
-            -vcodec libx264 -crf 25  -pix_fmt yuv420p {self.video}"""
+            f"Extracted {self.frames} frames ({self.skipped_frames} already uploaded) in {elapsed:.1f}s - "
+            f"{self.frames / elapsed:.1f} frames/s, {recent_rate:.1f} frames/s since the last report"
         )
+        self.last_time = now
+        self.last_frames = self.frames
+
+
+class ImageTopicSink:
+    """Write the raw image and all resized variants of every frame received for one topic.
+
+    `sizes` is a list of `(width, height)` tuples, where `None` stands for the raw (non-resized) image. Raw images are
+    encoded with `image_format` and resized images with `resized_image_format` (see `parse_image_format`).
+    When `shard_size_mb` is set, frames are packed into tar shards per variant (see `FrameArchiveWriter`) and
+    `on_shard_closed(variant_topic, shard_path, index_path)` is called for each completed shard.
+    When `video_options` (`codec`, `crf`, `frame_rate`) are given, the raw frames are also streamed into a
+    `<topic>_video/video.mp4` and `on_video_closed(topic, video_path)` is called once it is complete.
+    `on_frame_written` is called with the file dicts of each frame as soon as they are written to disk, and with
+    the encoded images as a second argument (`None` when written to disk). With `in_memory` nothing is written to
+    local disk. `sampling` (`stride`, `target_hz`, `time_windows`) selects which frames are extracted, see
+    `FrameSampler`. `is_frame_uploaded` is called with the file dicts of each frame before it is decoded; frames
+    for which it returns True are listed in `files` without being encoded or written again, so a retried job only
+    redoes the missing frames. Every frame is counted by `progress`, a `ProgressLogger` shared by the sinks of a bag.
+    """
 
+    def __init__(
+        self,
+        topic,
+        encoding,
+        output_path,
+        sizes,
+        bridge,
+        encoder,
+        on_frame_written=None,
+        in_memory=False,
+        shard_size_mb=None,
+        on_shard_closed=None,
+        video_options=None,
+        on_video_closed=None,
+        image_format=None,
+        resized_image_format=None,
+        sampling=None,
+        is_frame_uploaded=None,
+        progress=None,
+    ):
+        self.topic = topic
+        self.sampler = FrameSampler(**sampling) if sampling else None
+        self.progress = progress or ProgressLogger()
+        self.is_frame_uploaded = is_frame_uploaded
+        self.skipped_frames = 0
+        self.bridge = bridge
+        self.encoder = encoder
+        self.on_frame_written = on_frame_written
+        self.in_memory = in_memory
+        self.encoding = encoding
+        self.variants = []
+        self.archives = [] if shard_size_mb else None
+        for size in sizes:
+            output_dir = os.path.join(output_path, topic.replace("/", "_"))
+            variant_topic = topic
+            variant_format = parse_image_format(image_format)
+            if size is not None:
+                output_dir = output_dir + f"_resized_{size[0]}_{size[1]}"
+                variant_topic = topic + f"_resized_{size[0]}_{size[1]}"
+                variant_format = parse_image_format(resized_image_format or image_format)
+            logger.info(output_dir)
+            if self.archives is not None:
+                on_closed = functools.partial(on_shard_closed, variant_topic) if on_shard_closed else None
+                self.archives.append(FrameArchiveWriter(output_dir, shard_size_mb * 1024 * 1024, on_closed))
+            elif not in_memory:
+                os.makedirs(output_dir, exist_ok=True)
+            self.variants.append((size, output_dir, variant_topic, variant_format))
+        self.files = []
+        self.video = None
+        self.on_video_closed = on_video_closed
+        if video_options is not None:
+            video_path = os.path.join(output_path, topic.replace("/", "_") + "_video", "video.mp4")
+            self.video = VideoWriter(video_path, encoding, **video_options)
+
+    def write(self, msg):
+        if self.sampler is not None and not self.sampler.keep(msg.header.stamp):
+            return
+        timestamp = "{}_{}".format(msg.header.stamp.secs, msg.header.stamp.nsecs)
+        seq = "{:07d}".format(msg.header.seq)
+        outputs = []
+        frame_files = []
+        for size, output_dir, variant_topic, variant_format in self.variants:
+            local_image_name = "frame_{}{}".format(seq, variant_format[0])
+            s3_image_name = "frame_{}_{}{}".format(seq, timestamp, variant_format[0])
+            im_out_path = os.path.join(output_dir, local_image_name)
+            outputs.append((size, im_out_path, variant_format))
+            frame_files.append(
+                {
+                    "local_image_path": im_out_path,
+                    "timestamp": timestamp,
+                    "seq": seq,
+                    "topic": variant_topic,
+                    "s3_image_name": s3_image_name,
+                }
+            )
+        self.files += frame_files
+        uploaded = self.is_frame_uploaded is not None and self.is_frame_uploaded(frame_files)
+        if self.progress.add(skipped=uploaded):
+            for file in frame_files:
+                action = "Skip uploaded image" if uploaded else "Write image"
+                logger.debug("%s: %s to %s", action, file["s3_image_name"], file["local_image_path"])
+        if uploaded and self.video is None:
+            self.skipped_frames += 1
+            return
+        with metrics.timer("decode", len(msg.data)):
+            cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding=self.encoding)
+        if self.video is not None:
+            self.video.write(cv_image)
+        if uploaded:
+            self.skipped_frames += 1
+            return
+        if self.archives is not None:
+            on_done = functools.partial(self._archive, frame_files)
+            self.encoder.submit(encode_variants, cv_image, outputs, on_done)
+            return
+        on_done = None
+        if self.on_frame_written is not None:
+            on_done = functools.partial(self.on_frame_written, frame_files)
+        self.encoder.submit(encode_variants if self.in_memory else write_variants, cv_image, outputs, on_done)
+
+    def _archive(self, frame_files, buffers):
+        for archive, file, buffer in zip(self.archives, frame_files, buffers):
+            archive.add(file["s3_image_name"], buffer)
+
+    def close(self):
+        if self.skipped_frames:
+            logger.info(f"Skipped {self.skipped_frames} frames of {self.topic} that were already uploaded")
+        for archive in self.archives or []:
+            archive.close()
+        if self.video is not None and self.video.close() and self.on_video_closed is not None:
+            self.on_video_closed(self.topic, self.video.video_path)
+
+
+class ImagesFromBag:
+    """Extract all image topics with a single sweep over the bag, routing each message to its topic's sink.
+
+    `files` maps each topic to the same list of file dicts a per-topic extraction would produce. Resizing and
+    encoding run in `encode_workers` processes with at most `max_pending_frames` decoded frames waiting.
+    `sink_options` are passed to each topic's `ImageTopicSink`, which documents them. `bag_path` can also be an
+    opened bag, e.g. a `StreamingBag` reading a bag that is still downloading. `sensor_sinks` maps further topics to
+    sinks with `write(msg, t)` and `close()`, such as `ParquetTopicSink`, which are fed from the same sweep.
+    Progress is logged periodically by a `ProgressLogger` created with `progress_options`.
+    """
 
-class ImageFromBag:
+    def __init__(
+        self,
+        topics,
+        encoding,
+        bag_path,
+        output_path,
+        sizes,
+        encode_workers=1,
+        max_pending_frames=None,
+        sensor_sinks=None,
+        progress_options=None,
+        **sink_options,
+    ):
+        self.bridge = CvBridge()
+        sensor_sinks = sensor_sinks or {}
+        progress = ProgressLogger(**(progress_options or {}))
+        with FrameEncoderPool(encode_workers, max_pending_frames) as encoder:
+            sinks = {
+                topic: ImageTopicSink(
+                    topic, encoding, output_path, sizes, self.bridge, encoder, progress=progress, **sink_options
+                )
+                for topic in topics
+            }
+            with open_bag(bag_path) as bag:
+                for topic, msg, t in bag.read_messages(topics=list(set(sinks) | set(sensor_sinks))):
+                    if topic in sinks:
+                        sinks[topic].write(msg)
+                    if topic in sensor_sinks:
+                        sensor_sinks[topic].write(msg, t)
+        progress.log()
+        for sink in sinks.values():
+            sink.close()
+        for sink in sensor_sinks.values():
+            sink.close()
+        self.files = {topic: sink.files for topic, sink in sinks.items()}
+
+
+class MultiResolutionImageFromBag:
+    """Extract every frame of a topic once and write the raw image and all resized variants from it."""
+
+    def __init__(self, topic, encoding, bag_path, output_path, sizes):
+        self.files = ImagesFromBag([topic], encoding, bag_path, output_path, sizes).files[topic]
+
+
+class ImageFromBag(MultiResolutionImageFromBag):
     def __init__(
         self,
         topic,
@@ -56,144 +488,245 @@ class ImageFromBag:
         resized_width=None,
         resized_height=None,
     ):
-        self.bridge = CvBridge()
-        output_dir = os.path.join(output_path, topic.replace("/", "_"))
-
         resize = resized_width is not None and resized_height is not None
-        if resize:
-            output_dir = output_dir + f"_resized_{resized_width}_{resized_height}"
+        size = (resized_width, resized_height) if resize else None
+        super().__init__(topic, encoding, bag_path, output_path, sizes=[size])
 
-        logger.info(output_dir)
-        os.makedirs(output_dir, exist_ok=True)
-        files = []
-        with rosbag.Bag(bag_path) as bag:
-            for idx, (topic, msg, t) in enumerate(bag.read_messages(topics=[topic])):
-                timestamp = "{}_{}".format(msg.header.stamp.secs, msg.header.stamp.nsecs)
-                seq = "{:07d}".format(msg.header.seq)
-                cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding=encoding)
-                if resize:
-                    cv_image = cv2.resize(cv_image, (resized_width, resized_height))
-                local_image_name = "frame_{}.png".format(seq)
-                s3_image_name = "frame_{}_{}.png".format(seq, timestamp)
-                im_out_path = os.path.join(output_dir, local_image_name)
-                logger.info("Write image: {} to {}".format(local_image_name, im_out_path))
-                cv2.imwrite(im_out_path, cv_image)
-
-                topic = topic + f"_resized_{resized_width}_{resized_height}" if resize else topic
-                files.append(
-                    {
-                        "local_image_path": im_out_path,
-                        "timestamp": timestamp,
-                        "seq": seq,
-                        "topic": topic,
-                        "s3_image_name": s3_image_name,
-                    }
-                )
-        self.files = files
 
+def get_s3_client(max_pool_connections=10):
+    """Return an S3 client whose connection pool can serve `max_pool_connections` concurrent threads"""
+    config = botocore.config.Config(max_pool_connections=max_pool_connections, retries={"mode": "standard"})
+    return boto3.client("s3", config=config)
 
-def upload_file(client, local_image_path, bucket_name, target):
-    client.upload_file(local_image_path, bucket_name, target)
 
+def get_transfer_config(multipart_threshold_mb=64, max_concurrency=1):
+    """Return the s3transfer configuration for uploading a single frame.
 
-def upload(client, bucket_name, drive_id, file_id, files):
-    uploaded_files = []
-    target_prefixes = set()
-    items = []
-    for file in files:
-        topic = file["topic"].replace("/", "_")
-        target_prefix = os.path.join(drive_id, file_id.replace(".bag", ""), topic)
-        target = os.path.join(target_prefix, file["s3_image_name"])
-        items.append(
-            {
-                "local_image_path": file["local_image_path"],
-                "bucket_name": bucket_name,
-                "target": target,
-            }
-        )
-        uploaded_files.append(target)
-        target_prefixes.add(target_prefix)
-
-    executor = concurrent.futures.ThreadPoolExecutor(100)
-    futures = [
-        executor.submit(
-            upload_file,
-            client,
-            item["local_image_path"],
-            item["bucket_name"],
-            item["target"],
-        )
-        for item in items
-    ]
-    concurrent.futures.wait(futures)
+    Frames are small, so by default each upload runs on the calling uploader thread instead of spawning its own
+    transfer threads.
+    """
+    return TransferConfig(
+        multipart_threshold=multipart_threshold_mb * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1,
+    )
 
-    return list(target_prefixes)
 
+class StreamingUploader:
+    """Upload files to S3 from a fixed pool of threads as soon as they are submitted.
 
-def get_log_path():
-    response = requests.get(f"{os.environ['ECS_CONTAINER_METADATA_URI_V4']}")
-    task_region = response.json()["LogOptions"]["awslogs-region"]
-    return task_region, response.json()["LogOptions"]["awslogs-stream"].replace("/", "$252F")
+    At most `max_pending` files are queued or in flight; `submit` blocks beyond that so local disk usage (or memory,
+    for `submit_bytes`) is capped to a window of files. Uploaded files are deleted from local disk when
+    `delete_uploaded` is set.
 
+    Each file is retried up to `retries` times with exponential backoff. Files that still fail are collected in
+    `errors` and reported when the uploader is closed, together with the upload throughput.
+    """
 
-def save_job_url_and_logs(table, drive_id, file_id, batch_id, index):
-    job_region, log_path = get_log_path()
-    job_url = (
-        f"https://{job_region}.console.aws.amazon.com/batch/home?region={job_region}#jobs/detail/"
-        f"{os.environ['AWS_BATCH_JOB_ID']}"
-    )
+    def __init__(
+        self,
+        client,
+        bucket_name,
+        workers=100,
+        max_pending=1000,
+        delete_uploaded=True,
+        transfer_config=None,
+        retries=3,
+    ):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.delete_uploaded = delete_uploaded
+        self.transfer_config = transfer_config or get_transfer_config()
+        self.retries = retries
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="uploader")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.start_time = time.time()
+
+    def submit(self, local_path, target):
+        self._submit(self._upload, local_path, target)
+
+    def submit_bytes(self, data, target):
+        self._submit(self._upload_bytes, data, target)
+
+    def _submit(self, fn, source, target):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._upload_with_retries, fn, source, target)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _upload_with_retries(self, fn, source, target):
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.perf_counter()
+                size = fn(source, target)
+                metrics.record("upload", time.perf_counter() - start, size)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Failed to upload {target} after {attempt + 1} attempts: {e}")
+                    with self.lock:
+                        self.errors.append((target, e))
+                    return
+                logger.warning(f"Retrying upload of {target} after error: {e}")
+                time.sleep(min(2**attempt * 0.1, 5))
+        with self.lock:
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+
+    def _upload(self, local_path, target):
+        size = os.path.getsize(local_path)
+        self.client.upload_file(local_path, self.bucket_name, target, Config=self.transfer_config)
+        if self.delete_uploaded:
+            os.remove(local_path)
+        return size
+
+    def _upload_bytes(self, data, target):
+        self.client.upload_fileobj(io.BytesIO(data), self.bucket_name, target, Config=self.transfer_config)
+        return len(data)
+
+    def _done(self, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            with self.lock:
+                self.errors.append((None, future.exception()))
+
+    def log_metrics(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        megabytes = self.uploaded_bytes / (1024 * 1024)
+        logger.info(
+            f"Uploaded {self.uploaded_files} files ({megabytes:.1f} MB) in {elapsed:.1f}s - "
+            f"{self.uploaded_files / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s, {len(self.errors)} failed"
+        )
 
-    job_cloudwatch_logs = (
-        f"https://{job_region}.console.aws.amazon.com/cloudwatch/home?region={job_region}#"
-        f"logsV2:log-groups/log-group/$252Faws$252Fbatch$252Fjob/log-events/{log_path}"
-    )
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.log_metrics()
+        if self.errors:
+            failed = sorted(str(target) for target, _ in self.errors)
+            listed = ", ".join(failed[:10]) + (f" and {len(failed) - 10} more" if len(failed) > 10 else "")
+            raise RuntimeError(
+                f"{len(self.errors)} files failed to upload ({listed}), first error: {self.errors[0][1]!r}"
+            )
 
-    table.update_item(
-        Key={"pk": drive_id, "sk": file_id},
-        UpdateExpression="SET "
-        "image_extraction_batch_job = :batch_url, "
-        "image_extraction_job_logs = :cloudwatch_logs",
-        ExpressionAttributeValues={
-            ":cloudwatch_logs": job_cloudwatch_logs,
-            ":batch_url": job_url,
-        },
-    )
+    def __enter__(self):
+        return self
 
-    table.update_item(
-        Key={"pk": batch_id, "sk": index},
-        UpdateExpression="SET "
-        "image_extraction_batch_job = :batch_url, "
-        "image_extraction_job_logs = :cloudwatch_logs",
-        ExpressionAttributeValues={
-            ":cloudwatch_logs": job_cloudwatch_logs,
-            ":batch_url": job_url,
-        },
-    )
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True)
+            self.log_metrics()
 
 
-def extract_images(bag_path, topic, resized_width, resized_height, encoding, images_path):
-    all_files = []
-    logger.info(f"Getting images from topic: {topic} with encoding {encoding}")
-    try:
-        bag_obj = ImageFromBag(topic, encoding, bag_path, images_path)
-        all_files += bag_obj.files
-        logger.info(f"Raw Images extracted from topic: {topic} with encoding {encoding}")
-
-        if resized_width and resized_height:
-            logger.info(
-                f"Resized Images extracted from topic: {topic} with encoding {encoding}"
-                f" with new size {resized_width} x {resized_height}"
-            )
-            bag_obj = ImageFromBag(topic, encoding, bag_path, images_path, resized_width, resized_height)
-            all_files += bag_obj.files
-            logger.info(f"Images extracted from topic: {topic} with encoding {encoding}")
+def get_target_prefix(drive_id, file_id, file):
+    return os.path.join(drive_id, file_id.replace(".bag", ""), file["topic"].replace("/", "_"))
 
-    except rospy.ROSInterruptException:
-        pass
-    return all_files
+
+def get_upload_target(drive_id, file_id, file):
+    return os.path.join(get_target_prefix(drive_id, file_id, file), file["s3_image_name"])
 
 
-def main(table_name, index, batch_id, bag_path, images_path, topics, encoding, target_bucket) -> int:
+def list_uploaded_keys(client, bucket_name, drive_id, file_id, since=None):
+    """Keys uploaded for a bag, at or after the epoch seconds `since` when given"""
+    prefix = os.path.join(drive_id, file_id.replace(".bag", ""), "")
+    keys = set()
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.update(
+            obj["Key"] for obj in page.get("Contents", []) if since is None or obj["LastModified"].timestamp() >= since
+        )
+    logger.info(f"Found {len(keys)} objects uploaded under s3://{bucket_name}/{prefix} since {since}")
+    return keys
+
+
+def get_is_frame_uploaded(client, bucket_name, drive_id, file_id, job_attempt, first_attempt_start):
+    """`is_frame_uploaded(files)` of a retried job, true when every file of a frame was uploaded by an earlier attempt.
+
+    Objects under the bag's prefix are only trusted when uploaded since `first_attempt_start`, the epoch seconds at
+    which the first attempt of this job started, as a fresh run may write other images to the same keys, e.g. with
+    another IMAGE_FORMAT. Returns `None` for a first attempt, which extracts every frame.
+    """
+    if job_attempt <= 1 or first_attempt_start is None:
+        return None
+    uploaded_keys = list_uploaded_keys(client, bucket_name, drive_id, file_id, since=first_attempt_start)
+
+    def is_frame_uploaded(files):
+        return all(get_upload_target(drive_id, file_id, file) in uploaded_keys for file in files)
+
+    return is_frame_uploaded
+
+
+def get_resize_targets(resized_width, resized_height):
+    """Return the list of `(width, height)` resize targets from RESIZE_WIDTH/RESIZE_HEIGHT and RESIZE_TARGETS
+
+    RESIZE_TARGETS is an optional comma separated list of additional sizes, e.g. "640x360,320x180"
+    """
+    targets = []
+    if resized_width and resized_height:
+        targets.append((resized_width, resized_height))
+    for target in os.environ.get("RESIZE_TARGETS", "").split(","):
+        if not target.strip():
+            continue
+        width, height = target.strip().lower().split("x")
+        if (int(width), int(height)) not in targets:
+            targets.append((int(width), int(height)))
+    return targets
+
+
+def extract_images(
+    bag_path,
+    topics,
+    resize_targets,
+    encoding,
+    images_path,
+    encode_workers=1,
+    max_pending_frames=None,
+    sensor_sinks=None,
+    **sink_options,
+):
+    files_by_topic = {}
+    logger.info(f"Getting images from topics: {topics} with encoding {encoding}")
+    try:
+        bag_obj = ImagesFromBag(
+            topics,
+            encoding,
+            bag_path,
+            images_path,
+            sizes=[None] + resize_targets,
+            encode_workers=encode_workers,
+            max_pending_frames=max_pending_frames,
+            sensor_sinks=sensor_sinks,
+            **sink_options,
+        )
+        files_by_topic = bag_obj.files
+        logger.info(
+            f"Raw and resized images extracted from topics: {topics} with encoding {encoding}"
+            f" with new sizes {resize_targets}"
+        )
+    except rospy.ROSInterruptException:
+        pass
+    return files_by_topic
+
+
+def main(
+    table_name,
+    index,
+    batch_id,
+    bag_path,
+    images_path,
+    topics,
+    encoding,
+    target_bucket,
+    parquet_path=None,
+    sensor_topics=None,
+) -> int:
     logger.info("batch_id: %s", batch_id)
     logger.info("index: %s", index)
     logger.info("table_name: %s", table_name)
@@ -202,11 +735,86 @@ def main(table_name, index, batch_id, bag_path, images_path, topics, encoding, t
     logger.info("topics: %s", topics)
     logger.info("encoding: %s", encoding)
     logger.info("target_bucket: %s", target_bucket)
+    logger.info("parquet_path: %s", parquet_path)
+    logger.info("sensor_topics: %s", sensor_topics)
 
     resized_width = int(os.environ["RESIZE_WIDTH"])
     resized_height = int(os.environ["RESIZE_HEIGHT"])
     logger.info("resized_width: %s", resized_width)
     logger.info("resized_height: %s", resized_height)
+    resize_targets = get_resize_targets(resized_width, resized_height)
+    logger.info("resize_targets: %s", resize_targets)
+    encode_workers = int(os.environ.get("ENCODE_WORKERS", 1))
+    max_pending_frames = int(os.environ.get("MAX_PENDING_FRAMES", 2 * encode_workers))
+    logger.info("encode_workers: %s", encode_workers)
+    logger.info("max_pending_frames: %s", max_pending_frames)
+    upload_workers = int(os.environ.get("UPLOAD_WORKERS", 100))
+    max_pending_uploads = int(os.environ.get("MAX_PENDING_UPLOADS", 1000))
+    logger.info("upload_workers: %s", upload_workers)
+    logger.info("max_pending_uploads: %s", max_pending_uploads)
+    upload_retries = int(os.environ.get("UPLOAD_RETRIES", 3))
+    upload_max_concurrency = int(os.environ.get("UPLOAD_MAX_CONCURRENCY", 1))
+    transfer_config = get_transfer_config(
+        multipart_threshold_mb=int(os.environ.get("UPLOAD_MULTIPART_THRESHOLD_MB", 64)),
+        max_concurrency=upload_max_concurrency,
+    )
+    logger.info("upload_retries: %s", upload_retries)
+    logger.info("upload_max_concurrency: %s", upload_max_concurrency)
+    in_memory = os.environ.get("IN_MEMORY_UPLOAD", "False").lower() in ["true", "yes", "1"]
+    logger.info("in_memory: %s", in_memory)
+    shard_size_mb = int(os.environ.get("ARCHIVE_SHARD_SIZE_MB", 0)) or None
+    logger.info("shard_size_mb: %s", shard_size_mb)
+    video_options = None
+    if os.environ.get("VIDEO_OUTPUT", "False").lower() in ["true", "yes", "1"]:
+        video_options = {
+            "codec": os.environ.get("VIDEO_CODEC", "libx264"),
+            "crf": int(os.environ.get("VIDEO_CRF", 25)),
+            "frame_rate": float(os.environ.get("VIDEO_FRAME_RATE", 20)),
+        }
+    logger.info("video_options: %s", video_options)
+    image_format = os.environ.get("IMAGE_FORMAT")
+    resized_image_format = os.environ.get("RESIZED_IMAGE_FORMAT")
+    logger.info("image_format: %s", image_format)
+    logger.info("resized_image_format: %s", resized_image_format)
+    sampling = {
+        "stride": int(os.environ.get("SAMPLE_STRIDE", 1)),
+        "target_hz": float(os.environ.get("SAMPLE_TARGET_HZ", 0)) or None,
+        "time_windows": json.loads(os.environ.get("SAMPLE_TIME_WINDOWS", "[]")),
+    }
+    logger.info("sampling: %s", sampling)
+    progress_options = {
+        "every_frames": int(os.environ.get("PROGRESS_LOG_FRAMES", 1000)),
+        "every_seconds": float(os.environ.get("PROGRESS_LOG_SECONDS", 30)),
+        "debug_sample_frames": int(os.environ.get("DEBUG_SAMPLE_FRAMES", 100)),
+    }
+    logger.info("progress_options: %s", progress_options)
+    download_workers = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+    download_part_size_mb = float(os.environ.get("DOWNLOAD_PART_SIZE_MB", 32))
+    logger.info("download_workers: %s", download_workers)
+    logger.info("download_part_size_mb: %s", download_part_size_mb)
+    bag_cache_dir = os.environ.get("BAG_CACHE_DIR")
+    bag_cache_max_gb = float(os.environ.get("BAG_CACHE_MAX_GB", 100))
+    logger.info("bag_cache_dir: %s", bag_cache_dir)
+    logger.info("bag_cache_max_gb: %s", bag_cache_max_gb)
+    bag_cache = BagCache(bag_cache_dir, bag_cache_max_gb) if bag_cache_dir else None
+    skip_uploaded_frames = os.environ.get("SKIP_UPLOADED_FRAMES", "True").lower() in ["true", "yes", "1"]
+    logger.info("skip_uploaded_frames: %s", skip_uploaded_frames)
+    job_attempt = int(os.environ.get("AWS_BATCH_JOB_ATTEMPT", 1))
+    logger.info("job_attempt: %s", job_attempt)
+    indexed_read_max_fraction = float(os.environ.get("INDEXED_READ_MAX_FRACTION", 0.5))
+    logger.info("indexed_read_max_fraction: %s", indexed_read_max_fraction)
+    parquet_options = {
+        "row_group_size": int(os.environ.get("PARQUET_ROW_GROUP_SIZE", 100000)),
+        "compression": os.environ.get("PARQUET_COMPRESSION", "snappy").lower(),
+        "use_dictionary": os.environ.get("PARQUET_DICTIONARY", "True").lower() in ["true", "yes", "1"],
+        "sort_by_time": os.environ.get("PARQUET_SORT_BY_TIME", "False").lower() in ["true", "yes", "1"],
+        "partition_seconds": int(os.environ.get("PARQUET_TIME_PARTITION_SECONDS", 0)) or None,
+        "max_open_partitions": int(os.environ.get("PARQUET_MAX_OPEN_PARTITIONS", 4)),
+    }
+    logger.info("parquet_options: %s", parquet_options)
+    metrics_namespace = os.environ.get("METRICS_NAMESPACE", "SensorExtraction")
+    logger.info("metrics_namespace: %s", metrics_namespace)
+    job_start = time.perf_counter()
 
     dynamodb = boto3.resource("dynamodb")
     table = dynamodb.Table(table_name)
@@ -222,76 +830,137 @@ def main(table_name, index, batch_id, bag_path, images_path, topics, encoding, t
 
     drive_id = item["drive_id"]
     file_id = item["file_id"]
-    s3 = boto3.client("s3")
-
-    save_job_url_and_logs(table, drive_id, file_id, batch_id, index)
+    s3 = get_s3_client(max_pool_connections=max(upload_workers * upload_max_concurrency, download_workers))
+
+    # The combined extraction reads the bag once for both images and sensor topics and reports both stages
+    stages = ["image_extraction", "parquet_extraction"] if sensor_topics else ["image_extraction"]
+    drive_key = {"pk": drive_id, "sk": file_id}
+    batch_key = {"pk": batch_id, "sk": index}
+    status = JobStatusWriter(table, [drive_key, batch_key])
+    status.set_job_urls(stages)
+    # Retries of this job skip the frames uploaded since its first attempt started, as read from the batch item
+    first_attempt_start = item.get("image_extraction_started_at") if job_attempt > 1 else None
+    if first_attempt_start is None:
+        status.set({"image_extraction_started_at": int(time.time())}, key=batch_key)
+    status.flush()
+    sensor_sinks = {
+        topic: ParquetTopicSink(topic, parquet_path, drive_id, file_id, **parquet_options)
+        for topic in sensor_topics or []
+    }
+
+    is_frame_uploaded = None
+    # Shards are numbered in frame order, so only jobs uploading individual frames can skip some of them
+    if skip_uploaded_frames and not shard_size_mb:
+        is_frame_uploaded = get_is_frame_uploaded(
+            s3,
+            target_bucket,
+            drive_id,
+            file_id,
+            job_attempt,
+            float(first_attempt_start) if first_attempt_start is not None else None,
+        )
 
-    logger.info("Downloading Bag")
-    s3.download_file(item["s3_bucket"], item["s3_key"], bag_path)
-    logger.info(f"Bag downloaded to {bag_path}")
+    def upload_frame(files, buffers):
+        for idx, file in enumerate(files):
+            target = get_upload_target(drive_id, file_id, file)
+            if buffers is None:
+                uploader.submit(file["local_image_path"], target)
+            else:
+                uploader.submit_bytes(buffers[idx], target)
+
+    def upload_shard(variant_topic, shard_path, index_path):
+        target_prefix = get_target_prefix(drive_id, file_id, {"topic": variant_topic})
+        for path in [shard_path, index_path]:
+            uploader.submit(path, os.path.join(target_prefix, os.path.basename(path)))
+
+    def upload_video(topic, video_path):
+        target_prefix = get_target_prefix(drive_id, file_id, {"topic": topic + "_video"})
+        uploader.submit(video_path, os.path.join(target_prefix, os.path.basename(video_path)))
+
+    logger.info(f"Extracting and uploading results - {target_bucket}")
+    with StreamingUploader(
+        s3,
+        target_bucket,
+        upload_workers,
+        max_pending_uploads,
+        transfer_config=transfer_config,
+        retries=upload_retries,
+    ) as uploader, fetch_bag(
+        s3,
+        item["s3_bucket"],
+        item["s3_key"],
+        bag_path,
+        cache=bag_cache,
+        topics=topics + (sensor_topics or []),
+        max_indexed_fraction=indexed_read_max_fraction,
+        part_size_mb=download_part_size_mb,
+        workers=download_workers,
+    ) as bag:
+        files_by_topic = extract_images(
+            bag,
+            topics,
+            resize_targets,
+            encoding,
+            images_path,
+            encode_workers,
+            max_pending_frames,
+            on_frame_written=None if shard_size_mb else upload_frame,
+            in_memory=in_memory,
+            shard_size_mb=shard_size_mb,
+            on_shard_closed=upload_shard,
+            video_options=video_options,
+            on_video_closed=upload_video,
+            image_format=image_format,
+            resized_image_format=resized_image_format,
+            sampling=sampling,
+            is_frame_uploaded=is_frame_uploaded,
+            progress_options=progress_options,
+            sensor_sinks=sensor_sinks,
+        )
+        parquet_directories = set()
+        for sink in sensor_sinks.values():
+            for file in sink.files:
+                target_prefix, target = get_parquet_target(drive_id, file_id, file)
+                uploader.submit(file["local_parquet_path"], target)
+                parquet_directories.add(target_prefix)
+    logger.info("Uploaded results")
 
     uploaded_directories = []
-    for topic in topics:
-        all_files = extract_images(bag_path, topic, resized_width, resized_height, encoding, images_path)
-        logger.info(f"Uploading results - {target_bucket}")
-        topic_uploaded_directories = upload(s3, target_bucket, drive_id, file_id, all_files)
-        uploaded_directories += topic_uploaded_directories
-        logger.info("Uploaded results")
+    for all_files in files_by_topic.values():
+        uploaded_directories += list({get_target_prefix(drive_id, file_id, file) for file in all_files})
 
     raw_image_dirs = [d for d in uploaded_directories if "resized" not in d]
     resized_image_dirs = [d for d in uploaded_directories if "resized" in d]
 
-    logger.info("Writing job status to DynamoDB")
-    table.update_item(
-        Key={"pk": item["drive_id"], "sk": item["file_id"]},
-        UpdateExpression="SET "
-        "image_extraction_status = :status, "
-        "raw_image_dirs = :raw_image_dirs, "
-        "resized_image_dirs = :resized_image_dirs, "
-        "raw_image_bucket = :raw_image_bucket, "
-        "s3_key = :s3_key, "
-        "s3_bucket = :s3_bucket,"
-        "batch_id = :batch_id,"
-        "array_index = :index,"
-        "drive_id = :drive_id,"
-        "file_id = :file_id",
-        ExpressionAttributeValues={
-            ":status": "success",
-            ":raw_image_dirs": raw_image_dirs,
-            ":resized_image_dirs": resized_image_dirs,
-            ":raw_image_bucket": target_bucket,
-            ":batch_id": batch_id,
-            ":index": index,
-            ":s3_key": item["s3_key"],
-            ":s3_bucket": item["s3_bucket"],
-            ":drive_id": item["drive_id"],
-            ":file_id": item["file_id"],
-        },
-    )
+    metrics.record("job", time.perf_counter() - job_start)
+    logger.info("Stage metrics: %s", metrics.summary())
+    metrics.log_emf(metrics_namespace, {"Module": "ros-to-png"})
 
-    table.update_item(
-        Key={"pk": batch_id, "sk": index},
-        UpdateExpression="SET "
-        "image_extraction_status = :status, "
-        "raw_image_dirs = :raw_image_dirs, "
-        "resized_image_dirs = :resized_image_dirs, "
-        "raw_image_bucket = :raw_image_bucket, "
-        "s3_key = :s3_key, "
-        "s3_bucket = :s3_bucket,"
-        "batch_id = :batch_id,"
-        "array_index = :index",
-        ExpressionAttributeValues={
-            ":status": "success",
-            ":raw_image_dirs": raw_image_dirs,
-            ":resized_image_dirs": resized_image_dirs,
-            ":raw_image_bucket": target_bucket,
-            ":batch_id": batch_id,
-            ":index": index,
-            ":s3_key": item["s3_key"],
-            ":s3_bucket": item["s3_bucket"],
-        },
+    logger.info("Writing job status to DynamoDB")
+    for stage in stages:
+        status.set({f"{stage}_metrics": metrics.to_item()})
+    status.set(
+        {
+            "image_extraction_status": "success",
+            "raw_image_dirs": raw_image_dirs,
+            "resized_image_dirs": resized_image_dirs,
+            "raw_image_bucket": target_bucket,
+            "s3_key": item["s3_key"],
+            "s3_bucket": item["s3_bucket"],
+            "batch_id": batch_id,
+            "array_index": index,
+        }
     )
-    shutil.rmtree(local_dir)
+    status.set({"drive_id": item["drive_id"], "file_id": item["file_id"]}, key=drive_key)
+    if sensor_topics:
+        status.set(
+            {
+                "parquet_extraction_status": "success",
+                "raw_parquet_dirs": sorted(parquet_directories),
+                "raw_parquet_bucket": target_bucket,
+            }
+        )
+    status.flush()
     return 0
 
 
@@ -304,14 +973,15 @@ if __name__ == "__main__":
     parser.add_argument("--imagetopics", required=True)
     parser.add_argument("--desiredencoding", required=True)
     parser.add_argument("--targetbucket", required=True)
+    parser.add_argument("--sensortopics", required=False, help="sensor topics to also convert to parquet")
     args = parser.parse_args()
 
     unique_id = f"{args.index}_{str(int(time.time()))}"
     local_dir = f"/mnt/ebs/{unique_id}"
     logger.debug("ARGS: %s", args)
     os.mkdir(local_dir)
-    sys.exit(
-        main(
+    try:
+        exit_code = main(
             batch_id=args.batchid,
             index=args.index,
             table_name=args.tablename,
@@ -320,5 +990,10 @@ if __name__ == "__main__":
             topics=json.loads(args.imagetopics),
             encoding=args.desiredencoding,
             target_bucket=args.targetbucket,
+            parquet_path=f"{local_dir}/parquet/",
+            sensor_topics=json.loads(args.sensortopics) if args.sensortopics else None,
         )
-    )
+    finally:
+        # Failed and retried jobs must not leave their bag and frames behind either
+        shutil.rmtree(local_dir, ignore_errors=True)
+    sys.exit(exit_code)
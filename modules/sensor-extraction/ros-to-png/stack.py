@@ -3,6 +3,8 @@
 
 import logging
 import os
+import shutil
+import tempfile
 from typing import Any, Dict, cast
 
 import aws_cdk.aws_batch as batch
@@ -18,6 +20,30 @@ from constructs import Construct, IConstruct
 
 _logger: logging.Logger = logging.getLogger(__name__)
 
+# The sources shared by the sensor extraction images, next to this module in the repository and in the `dataFiles` of
+# the module once bundled by seedfarmer, which places them under the project path next to the module directory
+COMMON_SOURCE_PATHS = [
+    os.path.join("..", "common", "src"),
+    os.path.join("..", "modules", "sensor-extraction", "common", "src"),
+]
+
+
+def get_image_directory() -> str:
+    """Stage the Docker build context of the image: the `src` directory of this module and the shared sources"""
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    common_dirs = [os.path.join(module_dir, path) for path in COMMON_SOURCE_PATHS]
+    common_dir = next((path for path in common_dirs if os.path.isdir(path)), None)
+    if common_dir is None:
+        raise ValueError("modules/sensor-extraction/common/src is missing, add it to the dataFiles of the module")
+    image_dir = tempfile.mkdtemp(prefix="ros-to-png-image-")
+    shutil.copytree(
+        os.path.join(module_dir, "src"), image_dir, dirs_exist_ok=True, ignore=shutil.ignore_patterns("__pycache__")
+    )
+    for name in os.listdir(common_dir):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(common_dir, name), image_dir)
+    return image_dir
+
 
 class RosToPngBatchJob(Stack):
     def __init__(
@@ -53,7 +79,7 @@ class RosToPngBatchJob(Stack):
         local_image = DockerImageAsset(
             self,
             "RosToPng",
-            directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"),
+            directory=get_image_directory(),
         )
 
         image_uri = f"{repo.repository_uri}:latest"
@@ -100,7 +126,9 @@ class RosToPngBatchJob(Stack):
         batch_env = {
             "AWS_DEFAULT_REGION": self.region,
             "AWS_ACCOUNT_ID": self.account,
-            "DEBUG": "true",
+            "DEBUG": "false",
+            "ENCODE_WORKERS": str(batch_config["vcpus"]),
+            "BAG_CACHE_DIR": "/mnt/bag-cache",
         }
         if batch_config.get("resized_width"):
             batch_env["RESIZE_WIDTH"] = str(batch_config["resized_width"])
@@ -108,6 +136,9 @@ class RosToPngBatchJob(Stack):
         if batch_config.get("resized_height"):
             batch_env["RESIZE_HEIGHT"] = str(batch_config["resized_height"])
 
+        if batch_config.get("resize_targets"):
+            batch_env["RESIZE_TARGETS"] = batch_config["resize_targets"]
+
         self.batch_job = batch.EcsJobDefinition(
             self,
             "batch-job-def-from-ecr",
@@ -122,11 +153,19 @@ class RosToPngBatchJob(Stack):
                 memory=Size.mebibytes(batch_config["memory_limit_mib"]),
                 cpu=batch_config["vcpus"],
                 volumes=[
+                    # Per-job scratch space, removed with the container however the job ends
                     batch.EcsVolume.host(
                         name="scratch",
                         container_path="/mnt/ebs",
                         readonly=False,
                     ),
+                    # Only the bag cache is shared with the other jobs of the host
+                    batch.EcsVolume.host(
+                        name="bag-cache",
+                        container_path="/mnt/bag-cache",
+                        host_path="/mnt/ebs/bag-cache",
+                        readonly=False,
+                    ),
                 ],
             ),
             job_definition_name=repo.repository_name,
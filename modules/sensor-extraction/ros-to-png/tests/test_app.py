@@ -24,6 +24,7 @@ def stack_defaults():
     os.environ["SEEDFARMER_PARAMETER_PLATFORM"] = "FARGATE"
     os.environ["SEEDFARMER_PARAMETER_RESIZED_HEIGHT"] = "720"
     os.environ["SEEDFARMER_PARAMETER_RESIZED_WIDTH"] = "1280"
+    os.environ["SEEDFARMER_PARAMETER_RESIZE_TARGETS"] = "640x360,320x180"
     os.environ["SEEDFARMER_PARAMETER_RETRIES"] = "1"
     os.environ["SEEDFARMER_PARAMETER_TIMEOUT_SECONDS"] = "1800"
     os.environ["SEEDFARMER_PARAMETER_VCPUS"] = "2"
@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import json
+import os
+import tarfile
+
+from frame_archive import INDEX_SUFFIX, FrameArchiveWriter, read_frame
+
+
+class ShardClient:
+    """S3 client stub serving the local shards of `output_dir` to ranged GETs"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(value) for value in Range[len("bytes=") :].split("-"))
+        with open(os.path.join(self.output_dir, Key), "rb") as f:
+            f.seek(start)
+            return {"Body": io.BytesIO(f.read(end - start + 1))}
+
+
+def get_frames(count):
+    # Frame sizes that are not multiples of the 512 byte tar blocks
+    return [("frame{:04d}.png".format(i), bytes([i]) * (700 + 100 * i)) for i in range(count)]
+
+
+def test_frames_roll_over_into_shards(tmp_path):
+    closed = []
+    writer = FrameArchiveWriter(
+        str(tmp_path), max_shard_bytes=4096, on_shard_closed=lambda *paths: closed.append(paths)
+    )
+    frames = get_frames(10)
+    for name, data in frames:
+        writer.add(name, data)
+    writer.close()
+
+    shards = sorted(name for name in os.listdir(tmp_path) if name.endswith(".tar"))
+    assert len(shards) > 2
+    assert shards == ["shard-{:06d}.tar".format(i) for i in range(len(shards))]
+    assert closed == [(str(tmp_path / shard), str(tmp_path / shard) + INDEX_SUFFIX) for shard in shards]
+
+    indexed = []
+    for shard in shards:
+        with open(tmp_path / (shard + INDEX_SUFFIX)) as f:
+            index = json.load(f)
+        assert index["shard"] == shard
+        with open(tmp_path / shard, "rb") as f:
+            data = f.read()
+        for frame in index["frames"]:
+            indexed.append((frame["name"], data[frame["offset"] : frame["offset"] + frame["size"]]))
+        # The shards are valid tar files listing the same frames
+        with tarfile.open(tmp_path / shard) as tar:
+            assert tar.getnames() == [frame["name"] for frame in index["frames"]]
+    assert indexed == frames
+
+
+def test_read_frame_fetches_a_frame_by_its_offset(tmp_path):
+    writer = FrameArchiveWriter(str(tmp_path), max_shard_bytes=4096)
+    frames = get_frames(6)
+    for name, data in frames:
+        writer.add(name, data)
+    writer.close()
+
+    client = ShardClient(str(tmp_path))
+    fetched = []
+    for shard in sorted(name for name in os.listdir(tmp_path) if name.endswith(".tar")):
+        with open(tmp_path / (shard + INDEX_SUFFIX)) as f:
+            for frame in json.load(f)["frames"]:
+                fetched.append((frame["name"], read_frame(client, "extracted", shard, frame)))
+    assert fetched == frames
+
+
+def test_closing_an_empty_writer_writes_no_shard(tmp_path):
+    writer = FrameArchiveWriter(str(tmp_path), max_shard_bytes=4096)
+    writer.close()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+from frame_sampling import FrameSampler
+
+START_TIME = 1650000000
+
+
+class Stamp:
+    """The `to_sec()` of the `genpy.Time` header stamp of a frame"""
+
+    def __init__(self, secs):
+        self.secs = secs
+
+    def to_sec(self):
+        return self.secs
+
+
+def sample(sampler, offsets):
+    return [offset for offset in offsets if sampler.keep(Stamp(START_TIME + offset))]
+
+
+@pytest.mark.parametrize("stride", [None, 0, 1])
+def test_keeps_every_frame_by_default(stride):
+    offsets = [i * 0.1 for i in range(10)]
+    assert sample(FrameSampler(stride=stride), offsets) == offsets
+
+
+def test_keeps_every_stride_th_frame():
+    offsets = [i * 0.1 for i in range(10)]
+    assert sample(FrameSampler(stride=3), offsets) == offsets[::3]
+
+
+def test_caps_the_rate_despite_jitter():
+    # 30 Hz frames with up to 2 ms of jitter, sampled at 10 Hz
+    offsets = [i / 30 + (0.002 if i % 2 else -0.002) for i in range(1, 31)]
+    assert sample(FrameSampler(target_hz=10), offsets) == offsets[::3]
+
+
+def test_keeps_frames_in_time_windows_before_striding():
+    offsets = [i * 0.1 for i in range(20)]
+    windows = [[START_TIME + 0.2, START_TIME + 0.5], [START_TIME + 1.5, START_TIME + 1.8]]
+    in_windows = [offset for offset in offsets if 0.2 <= offset <= 0.5 or 1.5 <= offset <= 1.8]
+    assert sample(FrameSampler(stride=2, time_windows=windows), offsets) == in_windows[::2]
+
+
+def test_applies_the_rate_after_the_stride():
+    offsets = [i * 0.1 for i in range(20)]
+    assert sample(FrameSampler(stride=2, target_hz=2), offsets) == offsets[::6]
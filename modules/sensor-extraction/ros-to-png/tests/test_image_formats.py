@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from image_formats import parse_image_format  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        (None, (".png", [])),
+        ("", (".png", [])),
+        ("png", (".png", [])),
+        ("PNG:0", (".png", [cv2.IMWRITE_PNG_COMPRESSION, 0])),
+        ("png:9", (".png", [cv2.IMWRITE_PNG_COMPRESSION, 9])),
+        ("webp", (".webp", [cv2.IMWRITE_WEBP_QUALITY, 101])),
+        ("webp:1", (".webp", [cv2.IMWRITE_WEBP_QUALITY, 1])),
+        ("webp:80", (".webp", [cv2.IMWRITE_WEBP_QUALITY, 80])),
+        ("jpg", (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 95])),
+        ("jpeg:0", (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 0])),
+        ("jpg:100", (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 100])),
+        ("npy", (".npy", [])),
+    ],
+)
+def test_parse_image_format(spec, expected):
+    assert parse_image_format(spec) == expected
+
+
+@pytest.mark.parametrize("spec", ["png:10", "png:-1", "webp:0", "webp:102", "jpg:101", "jpg:high", "png:1.5"])
+def test_parse_image_format_rejects_levels_out_of_bounds(spec):
+    with pytest.raises(ValueError, match="Invalid level in image format"):
+        parse_image_format(spec)
+
+
+@pytest.mark.parametrize("spec", ["tiff", "bmp:1", "npy:1", "png9"])
+def test_parse_image_format_rejects_unsupported_formats(spec):
+    with pytest.raises(ValueError, match="Unsupported image format"):
+        parse_image_format(spec)
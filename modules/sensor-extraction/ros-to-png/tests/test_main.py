@@ -0,0 +1,255 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+# The container code needs the ROS and OpenCV packages of its image
+pytest.importorskip("rosbag")
+pytest.importorskip("cv2")
+pytest.importorskip("cv_bridge")
+
+import cv2  # noqa: E402
+import main  # noqa: E402
+import numpy as np  # noqa: E402
+from synthetic_bag import FileSystemS3Client, write_synthetic_bag  # noqa: E402
+
+DRIVE_ID = "drive1"
+FILE_ID = "file1.bag"
+TARGET_BUCKET = "extracted"
+
+
+@pytest.fixture(scope="function")
+def bag_path(tmp_path):
+    path = str(tmp_path / "ros.bag")
+    write_synthetic_bag(path, duration=1.0, image_topics=1, width=64, height=48, image_rate=5.0, sensor_topics=0)
+    return path
+
+
+def extract(bag_path, images_path, client, image_format, is_frame_uploaded=None):
+    """Extract and upload the frames of `bag_path` like a job, returning the uploaded objects"""
+    with main.StreamingUploader(client, TARGET_BUCKET, workers=2, max_pending=10) as uploader:
+
+        def upload_frame(files, buffers):
+            for file in files:
+                uploader.submit(file["local_image_path"], main.get_upload_target(DRIVE_ID, FILE_ID, file))
+
+        main.extract_images(
+            bag_path,
+            ["/cam/0/image_raw"],
+            [(32, 24)],
+            "bgr8",
+            images_path,
+            on_frame_written=upload_frame,
+            image_format=image_format,
+            is_frame_uploaded=is_frame_uploaded,
+        )
+    keys = client.list_keys(TARGET_BUCKET)
+    return {key: client.get_object(Bucket=TARGET_BUCKET, Key=key)["Body"].read() for key in keys}
+
+
+def test_fresh_run_rewrites_frames_of_earlier_runs(tmp_path, bag_path):
+    client = FileSystemS3Client(str(tmp_path / "s3"))
+    earlier = extract(bag_path, str(tmp_path / "earlier"), client, "png:1")
+    assert len(earlier) == 10
+
+    # A first attempt with another compression level writes the same keys
+    is_frame_uploaded = main.get_is_frame_uploaded(client, TARGET_BUCKET, DRIVE_ID, FILE_ID, 1, time.time() - 60)
+    assert is_frame_uploaded is None
+    fresh = extract(bag_path, str(tmp_path / "fresh"), client, "png:9", is_frame_uploaded)
+    assert fresh.keys() == earlier.keys()
+    assert all(fresh[key] != earlier[key] for key in fresh)
+
+
+def test_retry_skips_only_frames_uploaded_since_its_first_attempt(tmp_path, bag_path):
+    client = FileSystemS3Client(str(tmp_path / "s3"))
+    earlier = extract(bag_path, str(tmp_path / "earlier"), client, "png:1")
+    first_attempt_start = time.time()
+    # The first attempt uploaded the first frames before it was interrupted, the others are from an earlier run
+    frames = sorted({os.path.basename(key) for key in earlier})
+    retried = [key for key in earlier if os.path.basename(key) in frames[: len(frames) // 2]]
+    for key in earlier:
+        uploaded_at = first_attempt_start + 1 if key in retried else first_attempt_start - 60
+        os.utime(os.path.join(client.root, TARGET_BUCKET, key), (uploaded_at, uploaded_at))
+
+    is_frame_uploaded = main.get_is_frame_uploaded(client, TARGET_BUCKET, DRIVE_ID, FILE_ID, 2, first_attempt_start)
+    retry = extract(bag_path, str(tmp_path / "retry"), client, "png:9", is_frame_uploaded)
+    assert all(retry[key] == earlier[key] for key in retried)
+    assert all(retry[key] != earlier[key] for key in retry if key not in retried)
+
+
+class FlakyS3Client:
+    """S3 client stub whose uploads of each key fail `failures[key]` times before they succeed"""
+
+    def __init__(self, failures):
+        self.failures = dict(failures)
+        self.attempts = collections.Counter()
+        self.uploaded = {}
+        self.lock = threading.Lock()
+
+    def upload_file(self, local_path, bucket_name, key, Config=None):
+        with open(local_path, "rb") as f:
+            self.upload_fileobj(f, bucket_name, key, Config)
+
+    def upload_fileobj(self, f, bucket_name, key, Config=None):
+        with self.lock:
+            self.attempts[key] += 1
+            if self.attempts[key] <= self.failures.get(key, 0):
+                raise ConnectionError(f"Upload of {key} failed")
+            self.uploaded[key] = f.read()
+
+
+def test_streaming_uploader_retries_failed_uploads(tmp_path):
+    client = FlakyS3Client({"a.png": 2, "b.png": 3})
+    with main.StreamingUploader(client, TARGET_BUCKET, workers=2, max_pending=2, retries=3) as uploader:
+        for name in ["a.png", "b.png", "c.png"]:
+            path = tmp_path / name
+            path.write_bytes(name.encode())
+            uploader.submit(str(path), name)
+        uploader.submit_bytes(b"d", "d.png")
+
+    assert client.uploaded == {"a.png": b"a.png", "b.png": b"b.png", "c.png": b"c.png", "d.png": b"d"}
+    assert client.attempts == {"a.png": 3, "b.png": 4, "c.png": 1, "d.png": 1}
+    assert uploader.errors == []
+    assert uploader.uploaded_files == 4
+    # Uploaded files are deleted
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_streaming_uploader_close_raises_with_the_failed_keys(tmp_path):
+    client = FlakyS3Client({"a.png": 10, "c.png": 10})
+    uploader = main.StreamingUploader(client, TARGET_BUCKET, workers=2, max_pending=2, retries=1)
+    for name in ["a.png", "b.png", "c.png"]:
+        uploader.submit_bytes(name.encode(), name)
+    with pytest.raises(RuntimeError, match=r"2 files failed to upload \(a.png, c.png\)"):
+        uploader.close()
+
+    assert client.attempts == {"a.png": 2, "b.png": 1, "c.png": 2}
+    assert sorted(target for target, _ in uploader.errors) == ["a.png", "c.png"]
+    assert all(isinstance(e, ConnectionError) for _, e in uploader.errors)
+    assert uploader.uploaded_files == 1
+
+
+def test_frame_encoder_pool_completes_frames_in_order_with_bounded_pending():
+    image_format = main.parse_image_format("png:1")
+    results = []
+    pending = []
+    with main.FrameEncoderPool(workers=2, max_pending=3) as pool:
+        for i in range(10):
+            # Earlier frames are larger, so workers tend to finish later frames first
+            size = 400 - 30 * i
+            cv_image = np.full((size, size, 3), i, dtype=np.uint8)
+            pool.submit(main.encode_variants, cv_image, [(None, None, image_format)], results.append)
+            pending.append(len(pool.pending))
+        assert pool.executor is not None
+
+    assert max(pending) <= 3
+    assert len(results) == 10
+    for i, buffers in enumerate(results):
+        decoded = cv2.imdecode(np.frombuffer(buffers[0], dtype=np.uint8), cv2.IMREAD_COLOR)
+        assert decoded.shape == (400 - 30 * i, 400 - 30 * i, 3)
+        assert (decoded == i).all()
+
+
+def test_frame_encoder_pool_with_a_single_worker_encodes_inline():
+    image_format = main.parse_image_format("png")
+    results = []
+    with main.FrameEncoderPool(workers=1) as pool:
+        pool.submit(
+            main.encode_variants, np.zeros((8, 8, 3), dtype=np.uint8), [((4, 4), None, image_format)], results.append
+        )
+        assert pool.executor is None
+        assert len(results) == 1
+    assert cv2.imdecode(np.frombuffer(results[0][0], dtype=np.uint8), cv2.IMREAD_COLOR).shape == (4, 4, 3)
+
+
+def test_video_writer_rejects_unsupported_encodings(tmp_path):
+    with pytest.raises(ValueError, match="Cannot encode 32FC1 frames"):
+        main.VideoWriter(str(tmp_path / "video.mp4"), "32FC1")
+
+
+def test_video_writer_without_frames_writes_no_video(tmp_path):
+    writer = main.VideoWriter(str(tmp_path / "video.mp4"), "bgr8")
+    assert writer.close() is False
+    assert not (tmp_path / "video.mp4").exists()
+
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize("encoding", ["bgr8", "mono8"])
+def test_video_writer_encodes_frames(tmp_path, encoding):
+    video_path = tmp_path / "topic" / "video.mp4"
+    writer = main.VideoWriter(str(video_path), encoding, frame_rate=10)
+    # An odd frame size, which ffmpeg scales to even dimensions for yuv420p
+    shape = (25, 33, 3) if encoding == "bgr8" else (25, 33)
+    for i in range(10):
+        writer.write(np.full(shape, 20 * i, dtype=np.uint8))
+    assert writer.close() is True
+    assert writer.frames == 10
+
+    video = cv2.VideoCapture(str(video_path))
+    assert int(video.get(cv2.CAP_PROP_FRAME_COUNT)) == 10
+    ok, frame = video.read()
+    assert ok and frame.shape == (24, 32, 3)
+    video.release()
+
+
+@requires_ffmpeg
+def test_video_writer_reports_ffmpeg_errors(tmp_path):
+    writer = main.VideoWriter(str(tmp_path / "video.mp4"), "bgr8", codec="no-such-codec")
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    # ffmpeg exits at once, the error surfaces as a broken pipe on a later write or when closing
+    with pytest.raises(RuntimeError, match="(?s)ffmpeg failed for .*video.mp4 with exit code .*no-such-codec"):
+        for _ in range(100):
+            writer.write(frame)
+        writer.close()
+    assert writer.process.returncode != 0
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def progress_lines(caplog):
+    return [record.getMessage() for record in caplog.records if record.getMessage().startswith("Extracted ")]
+
+
+def test_progress_logger_logs_once_per_interval(caplog):
+    clock = FakeClock()
+    progress = main.ProgressLogger(every_frames=1000, every_seconds=30, clock=clock)
+    with caplog.at_level(logging.INFO, logger=main.logger.name):
+        # 8 frames per second for two minutes
+        for _ in range(960):
+            clock.now += 0.125
+            progress.add()
+    lines = progress_lines(caplog)
+    assert len(lines) == 4
+    assert lines[0].startswith("Extracted 240 frames (0 already uploaded) in 30.0s - 8.0 frames/s")
+    assert lines[-1].startswith("Extracted 960 frames (0 already uploaded) in 120.0s")
+
+
+def test_progress_logger_logs_every_frames(caplog):
+    clock = FakeClock()
+    progress = main.ProgressLogger(every_frames=100, every_seconds=300, clock=clock)
+    with caplog.at_level(logging.INFO, logger=main.logger.name):
+        for i in range(250):
+            clock.now += 0.25
+            progress.add(skipped=i % 2 == 0)
+        progress.log()
+    lines = progress_lines(caplog)
+    assert len(lines) == 3
+    assert lines[0].startswith("Extracted 100 frames (50 already uploaded) in 25.0s")
+    assert lines[1].startswith("Extracted 200 frames (100 already uploaded) in 50.0s")
+    assert lines[2].startswith("Extracted 250 frames (125 already uploaded) in 62.5s")
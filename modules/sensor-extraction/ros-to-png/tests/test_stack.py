@@ -6,7 +6,7 @@ import sys
 
 import aws_cdk as cdk
 import pytest
-from aws_cdk.assertions import Template
+from aws_cdk.assertions import Match, Template
 
 
 @pytest.fixture(scope="function")
@@ -36,6 +36,7 @@ def test_synthesize_stack(stack_defaults):
         "memory_limit_mib": 8192,
         "resized_width": 1280,
         "resized_height": 720,
+        "resize_targets": "640x360,320x180",
     }
 
     ros_to_png = stack.RosToPngBatchJob(
@@ -68,14 +69,36 @@ def test_synthesize_stack(stack_defaults):
                         "ContainerPath": "/mnt/ebs",
                         "ReadOnly": False,
                         "SourceVolume": "scratch",
-                    }
+                    },
+                    {
+                        "ContainerPath": "/mnt/bag-cache",
+                        "ReadOnly": False,
+                        "SourceVolume": "bag-cache",
+                    },
                 ],
                 "ReadonlyRootFilesystem": False,
                 "ResourceRequirements": [
                     {"Type": "MEMORY", "Value": "8192"},
                     {"Type": "VCPU", "Value": "2"},
                 ],
-                "Volumes": [{"Name": "scratch"}],
+                "Volumes": [
+                    {"Name": "scratch", "Host": {}},
+                    {"Name": "bag-cache", "Host": {"SourcePath": "/mnt/ebs/bag-cache"}},
+                ],
+            }
+        },
+    )
+    template.has_resource_properties(
+        type="AWS::Batch::JobDefinition",
+        props={
+            "ContainerProperties": {
+                "Environment": Match.array_with(
+                    [
+                        {"Name": "ENCODE_WORKERS", "Value": "2"},
+                        {"Name": "BAG_CACHE_DIR", "Value": "/mnt/bag-cache"},
+                        {"Name": "RESIZE_TARGETS", "Value": "640x360,320x180"},
+                    ]
+                ),
             }
         },
     )